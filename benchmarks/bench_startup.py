@@ -0,0 +1,89 @@
+""" Cold start of dbu.py: time to import it (and to print --help) in a fresh interpreter, no network
+    - every case runs --runs times in a new process, the best and median wall times are reported
+    - -X importtime of one extra run lists the slowest modules, so a heavy import sneaking back in shows up
+    - results are appended to --results (JSON lines) with the git revision and compared with the previous run
+    - python benchmarks/bench_startup.py --runs 20 [--top 10]
+"""
+
+import os, sys, json, time, shutil, argparse, tempfile, statistics, subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_suite import git_revision, previous_results
+
+DEFAULT_RESULTS = os.path.join(BENCH_DIR, 'startup_results.jsonl')
+CASES = [
+    ('import', ['-c', 'import dbu']),
+    ('help', [os.path.join(REPO_DIR, 'dbu.py'), '--help']),
+]
+
+
+def run_once(argv, cwd, env):
+    since = time.perf_counter()
+    subprocess.run([sys.executable] + argv, cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - since
+
+
+def slowest_imports(cwd, env, top):
+    """ [(module, self microseconds, cumulative microseconds)] of import dbu, slowest self time first """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import dbu'], cwd=cwd, env=env,
+                            check=True, capture_output=True, text=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return sorted(modules, key=lambda m: -m[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10, help='processes started per case')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules listed')
+    parser.add_argument('--results', type=str, default=DEFAULT_RESULTS, help='JSON lines file the results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as a regression, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    results_path = os.path.abspath(args.results)
+    try:
+        with open(os.path.join(work_dir, '.env_dropbox'), 'w') as f:  # only read once a client is needed
+            f.write('APP_KEY=bench\nAPP_SECRET=bench\nREFRESH_TOKEN=bench\n')
+        run_once(CASES[0][1], work_dir, env)  # warm the page cache and the .pyc files
+        revision = git_revision()
+        records = []
+        print('{:<10}{:>10}{:>10}'.format('case', 'best ms', 'median ms'))
+        for name, argv in CASES:
+            times = [run_once(argv, work_dir, env) for _ in range(args.runs)]
+            records.append({'case': name, 'seconds': round(min(times), 4), 'median': round(statistics.median(times), 4),
+                            'runs': args.runs, 'python': sys.version.split()[0], 'revision': revision, 'time': time.time()})
+            print('{:<10}{:>10.1f}{:>10.1f}'.format(name, min(times) * 1000, statistics.median(times) * 1000))
+
+        print('\nSlowest imports (self ms, cumulative ms)')
+        for module, self_us, cumulative_us in slowest_imports(work_dir, env, args.top):
+            print('{:<40}{:>10.1f}{:>10.1f}'.format(module, self_us / 1000, cumulative_us / 1000))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    history = previous_results(results_path)
+    with open(results_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+    print('\nCompared with the previous run ({})'.format(results_path))
+    for record in records:
+        before = [r for r in history if (r['case'], r['python']) == (record['case'], record['python'])]
+        if not before:
+            continue
+        change = record['seconds'] / before[-1]['seconds'] - 1
+        flag = '  <= REGRESSION' if change > args.tolerance else ''
+        print('{:<10}{:>8.1f}ms vs {:>8.1f}ms ({}){:>+8.1%}{}'.format(
+            record['case'], record['seconds'] * 1000, before[-1]['seconds'] * 1000, before[-1]['revision'], change, flag))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+""" Benchmarks of the backup pipeline against the local fake Dropbox (see fake_dropbox.py), no network, no account
+    - datasets: COUNTxSIZE synthetic daily backups (SQL-dump-like, compressible), e.g. 20x1M,4x64M
+    - cases: FileHash, ZipFile, UpLoadFile, FileNeedUpload (cold: no cache, no remote state) and the full
+      monthly main() flow, with the API requests each case made
+    - results are appended to --results (JSON lines) with the git revision and compared with the previous
+      result of the same case, dataset and link settings => regressions show up between versions
+    - python benchmarks/bench_suite.py --datasets 20x1M,4x64M --latency 0.05 --bandwidth 20M [--main-args '--workers 4']
+"""
+
+import os, sys, json, time, random, shlex, shutil, argparse, tempfile, subprocess
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dropbox import FakeDropboxServer, install
+from throttle import parse_rate
+
+DEFAULT_RESULTS = os.path.join(BENCH_DIR, 'results.jsonl')
+
+
+def parse_datasets(value):
+    """ '20x1M,4x64M' => [('20x1M', 20, 1048576), ('4x64M', 4, 67108864)] """
+    datasets = []
+    for part in filter(None, (p.strip() for p in value.split(','))):
+        count, size = part.lower().split('x')
+        datasets.append((part, int(count), int(parse_rate(size))))
+    return datasets
+
+
+def make_dataset(folder, count, size, seed=0):
+    """ count daily files db_YYYYMMDD.bak of size bytes, every file has its own content """
+    os.makedirs(folder, exist_ok=True)
+    rnd = random.Random(seed)
+    rows = ''.join("INSERT INTO ledger VALUES ({}, '2023-{:02d}-{:02d}', 'ACC{:06d}', {:.2f});\n".format(
+        i, rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 999999), rnd.random() * 1e6) for i in range(20000))
+    block = rows.encode()[:1024 * 1024]
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, 'db_{}.bak'.format((date(2023, 1, 1) + timedelta(days=i)).strftime('%Y%m%d')))
+        with open(path, 'wb') as f:
+            written = 0
+            while written < size:
+                data = bytearray(block[:size - written])
+                for _ in range(64):  # a few digits changed per block => no two blocks are equal
+                    data[rnd.randrange(len(data))] = 0x30 + rnd.randrange(10)
+                f.write(data)
+                written += len(data)
+        paths.append(path)
+    return paths
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def previous_results(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class Suite:
+    def __init__(self, server, work_dir, main_args):
+        self.server = server
+        self.work_dir = work_dir
+        self.main_args = main_args
+        import dbu
+        self.dbu = dbu
+
+    def uploader(self, **kwargs):
+        return self.dbu.DropBoxUpload(show_pbar=False, **kwargs)
+
+    def run(self, name, dataset, paths, fn):
+        """ Time fn(), return the result record """
+        before = self.server.requests.copy()
+        since = time.time()
+        fn()
+        seconds = time.time() - since
+        total = sum(os.path.getsize(p) for p in paths)
+        requests = sum((self.server.requests - before).values())
+        print('{:<16}{:<10}{:>10.2f}{:>10.1f}{:>10}'.format(name, dataset, seconds, total / 1024 / 1024 / seconds, requests))
+        return {'case': name, 'dataset': dataset, 'seconds': round(seconds, 4), 'bytes': total, 'requests': requests}
+
+    def cases(self, dataset, folder, paths):
+        remote = f'/bench/{dataset}'
+        temp_zip = os.path.join(self.work_dir, 'bench.zip')
+
+        def file_hash():
+            dbu = self.uploader()
+            for p in paths:
+                dbu.FileHash(p)
+
+        def zip_files():
+            dbu = self.uploader()
+            for p in paths:
+                dbu.ZipFile(p, temp_zip)
+            os.remove(temp_zip)
+
+        def upload():
+            dbu = self.uploader()
+            for p in paths:
+                dbu.UpLoadFile(remote + '/upload', p)
+
+        def main_flow():
+            argv = sys.argv
+            sys.argv = ['dbu.py', remote + '/monthly', folder, '--mode', 'monthly', '--no-pbar',
+                        '--cache', os.path.join(self.work_dir, f'{dataset}.sqlite'),
+                        '--history-dir', os.path.join(self.work_dir, f'{dataset}-history')] + self.main_args
+            try:
+                self.dbu.main()
+            finally:
+                sys.argv = argv
+
+        def need_upload():
+            dbu = self.uploader(history_dir=tempfile.mkdtemp(dir=self.work_dir))
+            dbu.FileNeedUpload(remote + '/monthly', folder)
+
+        return [('FileHash', file_hash), ('ZipFile', zip_files), ('UpLoadFile', upload),
+                ('main', main_flow), ('FileNeedUpload', need_upload)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', type=str, default='20x1M,4x32M', help='COUNTxSIZE list, e.g. 20x1M,4x64M')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every API request')
+    parser.add_argument('--bandwidth', type=str, default='0', help='link bytes/s in each direction, e.g. 20M, 0 = unlimited')
+    parser.add_argument('--cases', type=str, nargs='+', help='subset of FileHash ZipFile UpLoadFile main FileNeedUpload')
+    parser.add_argument('--main-args', type=str, default='', help='extra dbu.py arguments for the main case')
+    parser.add_argument('--results', type=str, default=DEFAULT_RESULTS, help='JSON lines file the results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as a regression, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    cwd = os.getcwd()
+    results_path = os.path.abspath(args.results)
+    server = FakeDropboxServer(latency=args.latency, bandwidth=parse_rate(args.bandwidth)).start()
+    try:
+        os.chdir(work_dir)  # dbu reads ./.env_dropbox and keeps its temp zips in the working directory
+        with open('.env_dropbox', 'w') as f:
+            f.write('APP_KEY=bench\nAPP_SECRET=bench\nREFRESH_TOKEN=bench\n')
+        import dropbox_client
+        clients = dropbox_client.DropboxClients('bench', 'bench', 'bench', token_cache_path='')
+        install(clients.session, server.url)
+        dropbox_client._clients = clients
+
+        suite = Suite(server, work_dir, shlex.split(args.main_args))
+        link = {'latency': args.latency, 'bandwidth': args.bandwidth, 'main_args': args.main_args}
+        history = previous_results(results_path)
+        revision = git_revision()
+        records = []
+        print('{:<16}{:<10}{:>10}{:>10}{:>10}'.format('case', 'dataset', 'seconds', 'MB/s', 'requests'))
+        for dataset, count, size in parse_datasets(args.datasets):
+            folder = os.path.join(work_dir, dataset)
+            paths = make_dataset(folder, count, size)
+            for name, fn in suite.cases(dataset, folder, paths):
+                if args.cases and name not in args.cases:
+                    continue
+                record = dict(suite.run(name, dataset, paths, fn), revision=revision, time=time.time(), **link)
+                records.append(record)
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(results_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+    def key(r):
+        return r['case'], r['dataset'], r['latency'], r['bandwidth'], r.get('main_args', '')
+
+    print('\nCompared with the previous run ({})'.format(results_path))
+    for record in records:
+        before = [r for r in history if key(r) == key(record)]
+        if not before:
+            continue
+        change = record['seconds'] / before[-1]['seconds'] - 1
+        flag = '  <= REGRESSION' if change > args.tolerance else ''
+        print('{:<16}{:<10}{:>10.2f}s vs {:>8.2f}s ({}){:>+8.1%}{}'.format(
+            record['case'], record['dataset'], record['seconds'], before[-1]['seconds'], before[-1]['revision'], change, flag))
+
+
+if __name__ == '__main__':
+    main()
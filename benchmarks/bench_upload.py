@@ -0,0 +1,56 @@
+""" Throughput of the sequential upload session (UpLoadFile) against the concurrent one (UpLoadFileParallel)
+    - Needs ./.env_dropbox, uploads a random file to remote_folder then deletes it
+    - python benchmarks/bench_upload.py '/bench' --size 256 --chunk 8 --parallel 2 4 8
+"""
+
+import os, sys, time, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dbu import DropBoxUpload
+
+
+def make_file(size_mb):
+    fd, path = tempfile.mkstemp(prefix='bench-', suffix='.bin')
+    with os.fdopen(fd, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+    return path
+
+
+def timed_upload(dbu, remote_folder, path, name, parallel):
+    since = time.time()
+    if parallel > 1:
+        meta = dbu.UpLoadFileParallel(remote_folder, path, name, parallel=parallel)
+    else:
+        meta = dbu.UpLoadFile(remote_folder, path, name)
+    elapsed = time.time() - since
+    dbu.dbx.files_delete_v2(meta.path_lower)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('remote_folder', type=str, help='scratch folder in dropbox')
+    parser.add_argument('--size', type=int, default=256, help='test file size in MB')
+    parser.add_argument('--chunk', type=int, default=8, help='chunk size in MB')
+    parser.add_argument('--parallel', type=int, nargs='+', default=[2, 4, 8], help='chunks in flight to compare')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    path = make_file(args.size)
+    try:
+        dbu = DropBoxUpload(chunk=args.chunk, show_pbar=False)
+        print('{:<12}{:>10}{:>12}{:>10}'.format('mode', 'seconds', 'MB/s', 'speedup'))
+        baseline = None
+        for parallel in [1] + args.parallel:
+            elapsed = min(timed_upload(dbu, args.remote_folder, path, f'bench-{parallel}.bin', parallel) for _ in range(args.repeat))
+            baseline = baseline or elapsed
+            mode = 'sequential' if parallel == 1 else f'parallel {parallel}'
+            print('{:<12}{:>10.2f}{:>12.2f}{:>9.2f}x'.format(mode, elapsed, args.size / elapsed, baseline / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
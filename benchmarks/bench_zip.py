@@ -0,0 +1,72 @@
+""" Compression speed of the single-threaded ZipFile path against parallel_zip
+    - Local only, compresses a synthetic SQL-dump-like file (or --file) and checks every zip with testzip
+    - python benchmarks/bench_zip.py --size 256 --level 5 --workers 2 4 8
+"""
+
+import os, sys, time, random, argparse, tempfile
+from zipfile import ZipFile, ZIP_DEFLATED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parallel_zip import parallel_zip
+
+
+def make_file(size_mb):
+    """ INSERT statements with a bit of entropy, roughly as compressible as a database dump """
+    fd, path = tempfile.mkstemp(prefix='bench-', suffix='.sql')
+    rnd = random.Random(0)
+    with os.fdopen(fd, 'w') as f:
+        row = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            row += 1
+            f.write("INSERT INTO ledger VALUES ({}, '2023-{:02d}-{:02d}', 'ACC{:06d}', {:.2f}, '{}');\n".format(
+                row, rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 999999), rnd.random() * 1e6,
+                os.urandom(rnd.randint(0, 12)).hex()))
+    return path
+
+
+def timed_zip(path, level, workers):
+    fd, zip_path = tempfile.mkstemp(prefix='bench-', suffix='.zip')
+    os.close(fd)
+    since = time.time()
+    if workers > 1:
+        parallel_zip(path, zip_path, level=level, workers=workers)
+    else:
+        with ZipFile(zip_path, 'w', ZIP_DEFLATED, compresslevel=level) as _zip:
+            _zip.write(path, os.path.basename(path))
+    elapsed = time.time() - since
+    with ZipFile(zip_path) as _zip:
+        bad = _zip.testzip()
+    size = os.path.getsize(zip_path)
+    os.remove(zip_path)
+    if bad is not None:
+        raise RuntimeError(f'corrupted member {bad} with {workers} workers')
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', type=str, help='file to compress instead of a synthetic one')
+    parser.add_argument('--size', type=int, default=256, help='synthetic file size in MB')
+    parser.add_argument('--level', type=int, default=5)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8], help='process counts to compare')
+    args = parser.parse_args()
+
+    path = args.file or make_file(args.size)
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    try:
+        print('{:<12}{:>10}{:>12}{:>10}{:>10}'.format('mode', 'seconds', 'MB/s', 'ratio', 'speedup'))
+        baseline = None
+        for workers in [1] + args.workers:
+            elapsed, size = timed_zip(path, args.level, workers)
+            baseline = baseline or elapsed
+            mode = 'zipfile' if workers == 1 else f'parallel {workers}'
+            print('{:<12}{:>10.2f}{:>12.2f}{:>10.3f}{:>9.2f}x'.format(
+                mode, elapsed, size_mb / elapsed, size / 1024 / 1024 / size_mb, baseline / elapsed))
+    finally:
+        if not args.file:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
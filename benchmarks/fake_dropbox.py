@@ -0,0 +1,578 @@
+""" Local stand-in for the Dropbox API v2, for benchmarks (no network, no account)
+    - upload (simple, sessions incl. concurrent and finish_batch), list_folder (+continue, longpoll),
+      list_revisions, get_metadata, download, get_temporary_link (Range requests), move, copy, delete
+      (single and batch, batches always answer with an async job id) and the OAuth token refresh
+    - file contents are kept on disk in a temp folder, every upload is a new revision
+    - latency (seconds added to every request) and bandwidth (bytes/s, each direction) are configurable
+    - install(session, url) mounts an adapter on a requests session (e.g. DropboxClients.session):
+      every https://*.dropboxapi.com call is sent to the local server instead
+    - python benchmarks/fake_dropbox.py --port 8765 --latency 0.05 --bandwidth 10M
+"""
+
+import os, sys, json, time, shutil, hashlib, argparse, tempfile, threading
+from collections import Counter
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dropbox_content_hasher import DropboxContentHasher
+from throttle import TokenBucket, parse_rate
+
+IO_CHUNK = 1024 * 1024
+PAGE_SIZE = 500  # list_folder entries per page
+
+
+class ApiError(Exception):
+    """ Route error => HTTP 409 with the Dropbox error body """
+
+    def __init__(self, summary, error):
+        super().__init__(summary)
+        self.summary = summary
+        self.error = error
+
+
+def _not_found(tag='path'):
+    return ApiError(f'{tag}/not_found/', {'.tag': tag, tag: {'.tag': 'not_found'}})
+
+
+def _timestamp(t):
+    return datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parent(path_lower):
+    return path_lower.rsplit('/', 1)[0]
+
+
+class FakeDropbox:
+    """ In-process state of the fake account """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._lock = threading.Condition()
+        self.files = {}  # path_lower => list of revision metadata (oldest first)
+        self.ids = {}  # id => path_lower
+        self.revs = {}  # rev => revision metadata
+        self.blobs = {}  # rev => blob path
+        self.folders = {''}
+        self.log = []  # (seq, path_lower), changes seen by list_folder_continue / longpoll
+        self.listings = {}  # paging cursor => (remaining entries, final cursor)
+        self.sessions = {}
+        self.links = {}
+        self._counter = 0
+
+    def _next(self):
+        self._counter += 1
+        return self._counter
+
+    # --- paths
+
+    def _resolve(self, path, tag='path'):
+        """ Return (path_lower, revision metadata) of a path, id: or rev: """
+        if path.startswith('rev:'):
+            meta = self.revs.get(path[4:])
+            if meta is None:
+                raise _not_found(tag)
+            return meta['path_lower'], meta
+        path_lower = self.ids.get(path) if path.startswith('id:') else path.lower()
+        revisions = self.files.get(path_lower)
+        if not revisions:
+            raise _not_found(tag)
+        return path_lower, revisions[-1]
+
+    def _add_folders(self, path_lower):
+        parent = _parent(path_lower)
+        while parent not in self.folders:
+            self.folders.add(parent)
+            parent = _parent(parent)
+
+    def _changed(self, path_lower):
+        self.log.append((self._next(), path_lower))
+        self._lock.notify_all()
+
+    # --- writes
+
+    def commit(self, blob_path, path, mode='overwrite', client_modified=None):
+        """ Store blob_path (moved into the store) as a new revision of path, return its metadata """
+        hasher = DropboxContentHasher()
+        with open(blob_path, 'rb') as f:
+            for data in iter(lambda: f.read(IO_CHUNK), b''):
+                hasher.update(data)
+        content_hash = hasher.hexdigest()
+        with self._lock:
+            path_lower = path.lower()
+            revisions = self.files.get(path_lower)
+            if revisions and mode == 'add':
+                os.remove(blob_path)
+                if revisions[-1]['content_hash'] == content_hash:
+                    return revisions[-1]
+                raise ApiError('path/conflict/file/', {'.tag': 'path', 'reason': {'.tag': 'conflict', 'conflict': {'.tag': 'file'}},
+                                                       'upload_session_id': ''})
+            rev = '{:016x}'.format(self._next())
+            file_id = revisions[-1]['id'] if revisions else f'id:fake{self._next():012d}'
+            now = time.time()
+            meta = {'name': path.rsplit('/', 1)[-1], 'id': file_id, 'rev': rev, 'size': os.path.getsize(blob_path),
+                    'path_lower': path_lower, 'path_display': path, 'content_hash': content_hash, 'is_downloadable': True,
+                    'server_modified': _timestamp(now), 'client_modified': client_modified or _timestamp(now)}
+            blob = os.path.join(self.data_dir, rev)
+            os.replace(blob_path, blob)
+            self.blobs[rev] = blob
+            self.revs[rev] = meta
+            self.files.setdefault(path_lower, []).append(meta)
+            self.ids[file_id] = path_lower
+            self._add_folders(path_lower)
+            self._changed(path_lower)
+            return meta
+
+    def relocate(self, from_path, to_path, copy=False):
+        with self._lock:
+            from_lower, meta = self._resolve(from_path, 'from_lookup')
+            to_lower = to_path.lower()
+            if to_lower in self.files:
+                raise ApiError('to/conflict/file/', {'.tag': 'to', 'to': {'.tag': 'conflict', 'conflict': {'.tag': 'file'}}})
+            if copy:
+                rev = '{:016x}'.format(self._next())
+                blob = os.path.join(self.data_dir, rev)
+                shutil.copyfile(self.blobs[meta['rev']], blob)
+                new = dict(meta, rev=rev, id=f'id:fake{self._next():012d}', server_modified=_timestamp(time.time()))
+                revisions = [new]
+                self.blobs[rev] = blob
+                self.revs[rev] = new
+            else:
+                revisions = self.files.pop(from_lower)
+                self._changed(from_lower)
+            for revision in revisions:
+                revision.update(name=to_path.rsplit('/', 1)[-1], path_lower=to_lower, path_display=to_path)
+            self.files[to_lower] = revisions
+            self.ids[revisions[-1]['id']] = to_lower
+            self._add_folders(to_lower)
+            self._changed(to_lower)
+            return revisions[-1]
+
+    def delete(self, path):
+        with self._lock:
+            path_lower, meta = self._resolve(path, 'path_lookup')
+            self.files.pop(path_lower)
+            self._changed(path_lower)
+            return meta
+
+    # --- reads
+
+    def _entry(self, path_lower):
+        revisions = self.files.get(path_lower)
+        if revisions:
+            return dict(revisions[-1], **{'.tag': 'file'})
+        name = path_lower.rsplit('/', 1)[-1]
+        if path_lower in self.folders:
+            return {'.tag': 'folder', 'name': name, 'id': 'id:folder' + path_lower, 'path_lower': path_lower, 'path_display': path_lower}
+        return {'.tag': 'deleted', 'name': name, 'path_lower': path_lower, 'path_display': path_lower}
+
+    def _page(self, entries, final_cursor):
+        if len(entries) <= PAGE_SIZE:
+            return {'entries': entries, 'cursor': final_cursor, 'has_more': False}
+        token = f'page:{self._next()}'
+        self.listings[token] = (entries[PAGE_SIZE:], final_cursor)
+        return {'entries': entries[:PAGE_SIZE], 'cursor': token, 'has_more': True}
+
+    def list_folder(self, path):
+        with self._lock:
+            folder = path.lower().rstrip('/')
+            if folder not in self.folders:
+                raise _not_found()
+            children = [p for p in list(self.files) + list(self.folders) if p and _parent(p) == folder]
+            seq = self.log[-1][0] if self.log else 0
+            return self._page([self._entry(p) for p in children], f'{folder}|{seq}')
+
+    def list_folder_continue(self, cursor):
+        with self._lock:
+            if cursor in self.listings:
+                entries, final_cursor = self.listings.pop(cursor)
+                return self._page(entries, final_cursor)
+            folder, seq = self._parse_cursor(cursor)
+            changed = list(dict.fromkeys(p for s, p in self.log if s > seq and _parent(p) == folder))
+            last = self.log[-1][0] if self.log else 0
+            return self._page([self._entry(p) for p in changed], f'{folder}|{last}')
+
+    def _parse_cursor(self, cursor):
+        try:
+            folder, seq = cursor.rsplit('|', 1)
+            return folder, int(seq)
+        except ValueError:
+            raise ApiError('reset/', {'.tag': 'reset'})
+
+    def longpoll(self, cursor, timeout):
+        folder, seq = self._parse_cursor(cursor)
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                if any(s > seq and _parent(p) == folder for s, p in self.log):
+                    return {'changes': True}
+                if time.time() >= deadline:
+                    return {'changes': False}
+                self._lock.wait(deadline - time.time())
+
+    def list_revisions(self, path, limit=10):
+        with self._lock:
+            path_lower, _ = self._resolve(path)
+            revisions = list(reversed(self.files[path_lower]))
+            return {'is_deleted': False, 'entries': revisions[:limit], 'has_more': len(revisions) > limit}
+
+    def metadata(self, path):
+        with self._lock:
+            path_lower = path.lower().rstrip('/')
+            if not path.startswith(('id:', 'rev:')) and path_lower in self.folders and path_lower not in self.files:
+                return self._entry(path_lower)
+            return self._resolve(path)[1]
+
+    def blob(self, path):
+        with self._lock:
+            meta = self._resolve(path)[1]
+            return meta, self.blobs[meta['rev']]
+
+    # --- upload sessions
+
+    def session_start(self, blob_path, concurrent, close):
+        with self._lock:
+            session_id = f'session{self._next()}'
+            self.sessions[session_id] = {'path': blob_path, 'size': os.path.getsize(blob_path),
+                                         'concurrent': concurrent, 'closed': close}
+            return session_id
+
+    def session_append(self, cursor, data_path, close=False):
+        with self._lock:
+            session = self.sessions.get(cursor['session_id'])
+            if session is None:
+                raise ApiError('not_found/', {'.tag': 'not_found'})
+            if session['closed']:
+                raise ApiError('closed/', {'.tag': 'closed'})
+            if not session['concurrent'] and cursor['offset'] != session['size']:
+                raise ApiError('incorrect_offset/', {'.tag': 'incorrect_offset', 'correct_offset': session['size']})
+        with open(data_path, 'rb') as src, open(session['path'], 'r+b') as dst:
+            dst.seek(cursor['offset'])
+            shutil.copyfileobj(src, dst, IO_CHUNK)
+        os.remove(data_path)
+        with self._lock:
+            session['size'] = max(session['size'], os.path.getsize(session['path']))
+            session['closed'] = session['closed'] or close
+            return session
+
+    def session_finish(self, cursor, commit, data_path=None):
+        length = os.path.getsize(data_path) if data_path else 0
+        try:
+            if length:
+                self.session_append(cursor, data_path)
+            elif data_path:
+                os.remove(data_path)
+            with self._lock:
+                session = self.sessions.get(cursor['session_id'])
+                if session is None:
+                    raise ApiError('not_found/', {'.tag': 'not_found'})
+                if not session['concurrent'] and session['size'] != cursor['offset'] + length:
+                    raise ApiError('incorrect_offset/', {'.tag': 'incorrect_offset', 'correct_offset': session['size']})
+                self.sessions.pop(cursor['session_id'])
+        except ApiError as e:
+            raise ApiError('lookup_failed/' + e.summary, {'.tag': 'lookup_failed', 'lookup_failed': e.error})
+        return self.commit(session['path'], commit['path'], _tag(commit.get('mode', 'overwrite')), commit.get('client_modified'))
+
+    def temporary_link(self, path, base_url):
+        meta, blob = self.blob(path)
+        with self._lock:
+            token = f'{self._next()}{hashlib.sha1(blob.encode()).hexdigest()[:12]}'
+            self.links[token] = (meta, blob)
+        return {'metadata': meta, 'link': f'{base_url}/link/{token}'}
+
+
+def _tag(value):
+    return value if isinstance(value, str) else value['.tag']
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def log_message(self, *args):
+        pass
+
+    # --- transport
+
+    def _read_body(self, to_file=False):
+        length = int(self.headers.get('Content-Length') or 0)
+        out = tempfile.NamedTemporaryFile(dir=self.server.state.data_dir, delete=False) if to_file else None
+        chunks = []
+        while length:
+            data = self.rfile.read(min(IO_CHUNK, length))
+            if not data:
+                break
+            length -= len(data)
+            self.server.upload_bucket.consume(len(data))
+            out.write(data) if out else chunks.append(data)
+        if out:
+            out.close()
+            return out.name
+        return b''.join(chunks)
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Dropbox-Request-Id', str(time.time_ns()))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self._write(body)
+
+    def _write(self, body):
+        for i in range(0, len(body), IO_CHUNK):
+            data = body[i:i + IO_CHUNK]
+            self.server.download_bucket.consume(len(data))
+            self.wfile.write(data)
+
+    def _send_json(self, obj, status=200):
+        self._send(status, json.dumps(obj).encode())
+
+    def _send_file(self, blob, start=0, end=None, status=200, headers=None):
+        size = os.path.getsize(blob)
+        end = size - 1 if end is None else min(end, size - 1)
+        length = max(0, end - start + 1)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        with open(blob, 'rb') as f:
+            f.seek(start)
+            while length:
+                data = f.read(min(IO_CHUNK, length))
+                if not data:
+                    break
+                self.server.download_bucket.consume(len(data))
+                self.wfile.write(data)
+                length -= len(data)
+
+    # --- dispatch
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = urlsplit(self.path).path
+        self.server.count(path)
+        link = self.server.state.links.get(path.rsplit('/', 1)[-1]) if path.startswith('/link/') else None
+        if link is None:
+            return self._send(404, b'not found', 'text/plain')
+        blob = link[1]
+        byte_range = self.headers.get('Range')
+        if not byte_range:
+            return self._send_file(blob)
+        start, end = byte_range.split('=', 1)[1].split('-')
+        start, end = int(start), int(end) if end else None
+        size = os.path.getsize(blob)
+        end_shown = size - 1 if end is None else min(end, size - 1)
+        self._send_file(blob, start, end, 206, {'Content-Range': f'bytes {start}-{end_shown}/{size}'})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        path = urlsplit(self.path).path
+        self.server.count(path)
+        route = self.server.routes.get(path)
+        if route is None:
+            self._read_body()
+            return self._send(404, b'unknown route ' + path.encode(), 'text/plain')
+        style, fn = route
+        arg = self.headers.get('Dropbox-API-Arg')
+        try:
+            if style == 'upload':
+                result = fn(self, json.loads(arg), self._read_body(to_file=True))
+            elif style == 'oauth':
+                self._read_body()  # form encoded, not checked
+                result = fn(self, None)
+            elif style == 'download':
+                self._read_body()
+                meta, blob = fn(self, json.loads(arg))
+                return self._send_file(blob, headers={'Dropbox-API-Result': json.dumps(meta)})
+            else:
+                body = self._read_body()
+                result = fn(self, json.loads(body) if body.strip() else None)
+        except ApiError as e:
+            return self._send_json({'error_summary': e.summary, 'error': e.error}, 409)
+        self._send_json(result)
+
+
+def _routes(state):
+    """ path => (style, handler(request, arg[, body_path])) """
+
+    def upload(h, arg, body):
+        return state.commit(body, arg['path'], _tag(arg.get('mode', 'overwrite')), arg.get('client_modified'))
+
+    def start(h, arg, body):
+        concurrent = _tag((arg or {}).get('session_type') or 'sequential') == 'concurrent'
+        return {'session_id': state.session_start(body, concurrent, (arg or {}).get('close', False))}
+
+    def append_v2(h, arg, body):
+        state.session_append(arg['cursor'], body, arg.get('close', False))
+        return None
+
+    def append(h, arg, body):
+        state.session_append(arg, body)
+        return None
+
+    def finish(h, arg, body):
+        return state.session_finish(arg['cursor'], arg['commit'], body)
+
+    def finish_entries(arg):
+        entries = []
+        for entry in arg['entries']:
+            try:
+                entries.append(dict(state.session_finish(entry['cursor'], entry['commit']), **{'.tag': 'success'}))
+            except ApiError as e:
+                entries.append({'.tag': 'failure', 'failure': e.error})
+        return entries
+
+    jobs = {}
+
+    def finish_batch(h, arg):
+        job_id = f'job{len(jobs)}'
+        jobs[job_id] = finish_entries(arg)
+        return {'.tag': 'complete', 'entries': jobs[job_id]}
+
+    def finish_batch_v2(h, arg):
+        return {'entries': finish_entries(arg)}
+
+    def finish_batch_check(h, arg):
+        if arg['async_job_id'] not in jobs:
+            raise ApiError('invalid_async_job_id/', {'.tag': 'invalid_async_job_id'})
+        return {'.tag': 'complete', 'entries': jobs[arg['async_job_id']]}
+
+    def batch_job(run_entry, entries):
+        """ Run the entries of a batch, the result is only returned by the check route (async job) """
+        results = []
+        for entry in entries:
+            try:
+                results.append(run_entry(entry))
+            except ApiError as e:
+                results.append({'.tag': 'failure', 'failure': e.error})
+        job_id = f'job{len(jobs)}'
+        jobs[job_id] = results
+        return {'.tag': 'async_job_id', 'async_job_id': job_id}
+
+    def relocate_batch(arg, copy=False):
+        return batch_job(lambda e: {'.tag': 'success', 'success': tagged(state.relocate(e['from_path'], e['to_path'], copy=copy))},
+                         arg['entries'])
+
+    def relocation_error(e):
+        return {'.tag': 'relocation_error', 'relocation_error': e}
+
+    def relocate_batch_check(h, arg):
+        if arg['async_job_id'] not in jobs:
+            raise ApiError('invalid_async_job_id/', {'.tag': 'invalid_async_job_id'})
+        return {'.tag': 'complete', 'entries': [dict(r, failure=relocation_error(r['failure'])) if r['.tag'] == 'failure' else r
+                                                for r in jobs[arg['async_job_id']]]}
+
+    def delete_batch(h, arg):
+        return batch_job(lambda e: {'.tag': 'success', 'metadata': tagged(state.delete(e['path']))}, arg['entries'])
+
+    def download(h, arg):
+        return state.blob(arg['path'])
+
+    def get_metadata(h, arg):
+        meta = state.metadata(arg['path'])
+        return meta if '.tag' in meta else dict(meta, **{'.tag': 'file'})
+
+    def tagged(meta):
+        return dict(meta, **{'.tag': 'file'})
+
+    return {
+        '/oauth2/token': ('oauth', lambda h, arg: {'access_token': 'fake-token', 'expires_in': 14400, 'token_type': 'bearer'}),
+        '/2/files/upload': ('upload', upload),
+        '/2/files/upload_session/start': ('upload', start),
+        '/2/files/upload_session/append': ('upload', append),
+        '/2/files/upload_session/append_v2': ('upload', append_v2),
+        '/2/files/upload_session/finish': ('upload', finish),
+        '/2/files/upload_session/finish_batch': ('rpc', finish_batch),
+        '/2/files/upload_session/finish_batch_v2': ('rpc', finish_batch_v2),
+        '/2/files/upload_session/finish_batch/check': ('rpc', finish_batch_check),
+        '/2/files/download': ('download', download),
+        '/2/files/get_temporary_link': ('rpc', lambda h, arg: state.temporary_link(arg['path'], h.server.url)),
+        '/2/files/get_metadata': ('rpc', get_metadata),
+        '/2/files/list_folder': ('rpc', lambda h, arg: state.list_folder(arg['path'])),
+        '/2/files/list_folder/continue': ('rpc', lambda h, arg: state.list_folder_continue(arg['cursor'])),
+        '/2/files/list_folder/longpoll': ('rpc', lambda h, arg: state.longpoll(arg['cursor'], min(arg.get('timeout', 30), h.server.max_longpoll))),
+        '/2/files/list_revisions': ('rpc', lambda h, arg: state.list_revisions(arg['path'], arg.get('limit', 10))),
+        '/2/files/move': ('rpc', lambda h, arg: tagged(state.relocate(arg['from_path'], arg['to_path']))),
+        '/2/files/move_v2': ('rpc', lambda h, arg: {'metadata': tagged(state.relocate(arg['from_path'], arg['to_path']))}),
+        '/2/files/copy_v2': ('rpc', lambda h, arg: {'metadata': tagged(state.relocate(arg['from_path'], arg['to_path'], copy=True))}),
+        '/2/files/move_batch_v2': ('rpc', lambda h, arg: relocate_batch(arg)),
+        '/2/files/move_batch/check_v2': ('rpc', relocate_batch_check),
+        '/2/files/copy_batch_v2': ('rpc', lambda h, arg: relocate_batch(arg, copy=True)),
+        '/2/files/copy_batch/check_v2': ('rpc', relocate_batch_check),
+        '/2/files/delete_batch': ('rpc', delete_batch),
+        '/2/files/delete_batch/check': ('rpc', finish_batch_check),
+        '/2/files/delete': ('rpc', lambda h, arg: tagged(state.delete(arg['path']))),
+        '/2/files/delete_v2': ('rpc', lambda h, arg: {'metadata': tagged(state.delete(arg['path']))}),
+    }
+
+
+class FakeDropboxServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, bandwidth=None, data_dir=None, max_longpoll=30):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.latency = latency
+        self.upload_bucket = TokenBucket(bandwidth)
+        self.download_bucket = TokenBucket(bandwidth)
+        self.max_longpoll = max_longpoll  # seconds, keeps benchmarks short
+        self._own_dir = data_dir is None
+        self.state = FakeDropbox(data_dir or tempfile.mkdtemp(prefix='fake-dropbox-'))
+        self.routes = _routes(self.state)
+        self.requests = Counter()
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    def count(self, path):
+        with self._count_lock:
+            self.requests['/link' if path.startswith('/link/') else path] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._own_dir:
+            shutil.rmtree(self.state.data_dir, ignore_errors=True)
+
+
+def install(session, url):
+    """ Send the https calls of a requests session (Dropbox API hosts) to the fake server at url """
+    from requests.adapters import HTTPAdapter
+
+    class LocalAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            parts = urlsplit(request.url)
+            request.url = url + parts.path + ('?' + parts.query if parts.query else '')
+            return super().send(request, **kwargs)
+
+    session.mount('https://', LocalAdapter())
+    return session
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=str, default='0', help='bytes/s in each direction, e.g. 10M, 0 = unlimited')
+    args = parser.parse_args()
+    server = FakeDropboxServer(args.port, args.latency, parse_rate(args.bandwidth))
+    print(f'Fake Dropbox API on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
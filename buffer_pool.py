@@ -0,0 +1,78 @@
+""" Bounded pool of reusable read buffers
+    - a fixed number of bytearrays is handed out, a reader blocks while all of them are in use
+      => peak memory of the upload read path is about count * chunk size, whatever the number of workers
+    - chunks are read straight into a buffer (readinto / preadv) and exposed as memoryview slices,
+      buffers only grow to the largest chunk asked (e.g. with --chunk auto)
+    - the SDK only accepts request bodies as bytes: payload() makes that one copy at the last moment,
+      it lives only while its buffer is checked out
+"""
+
+import os, threading
+from contextlib import contextmanager
+
+DEFAULT_BUFFERS = 4
+
+
+class BufferPool:
+    def __init__(self, count=DEFAULT_BUFFERS):
+        self.count = max(1, count)
+        self._free = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """ Return a bytearray of at least size bytes, block while count buffers are checked out """
+        with self._cond:
+            while not self._free and self._created >= self.count:
+                self._cond.wait()
+            if self._free:
+                buf = self._free.pop()
+            else:
+                buf = bytearray()
+                self._created += 1
+        if len(buf) < size:
+            buf = bytearray(size)
+        return buf
+
+    def release(self, buf):
+        with self._cond:
+            self._free.append(buf)
+            self._cond.notify()
+
+    @contextmanager
+    def read(self, f, length, offset=None):
+        """ Yield a memoryview of up to length bytes read from f
+            - f: file object read at its position, or a file descriptor read at offset (preadv)
+        """
+        buf = self.acquire(length)
+        try:
+            view = memoryview(buf)[:length]
+            filled = 0
+            while filled < length:
+                if offset is None:
+                    n = f.readinto(view[filled:])
+                else:
+                    n = os.preadv(f, [view[filled:]], offset + filled)
+                if not n:
+                    break
+                filled += n
+            yield view[:filled]
+        finally:
+            self.release(buf)
+
+
+def payload(chunk):
+    """ bytes copy of a chunk, for the SDK calls """
+    return bytes(chunk)
+
+
+_pool = BufferPool()
+
+
+def set_buffer_pool(pool):
+    global _pool
+    _pool = pool
+
+
+def buffer_pool():
+    return _pool
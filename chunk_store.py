@@ -0,0 +1,422 @@
+""" Deduplicated storage of near-identical backups in content-defined chunks
+    - files are cut where the crc32 of the 64 bytes ending on a 0x0A byte (a line end in dumps, any byte
+      value in binary data) matches a mask, between min_size and max_size => an inserted or deleted row only
+      changes the chunks around it, the cuts after it fall on the same content again
+    - chunks are named by sha256, new ones are zlib compressed into packs uploaded with their index:
+      {folder}/.chunks/packs/{pack}.pack + {pack}.json, every backup gets {folder}/.chunks/manifests/{name}.json
+      (size, mtime, content hash, ordered chunk list) => a daily dump sends only its changed chunks
+    - upload order pack => pack index => manifest: an interrupted run leaves unreferenced packs, never a
+      manifest pointing to missing chunks; gc() deletes them
+    - the chunk index and the manifests are cached in sqlite (same file as the hash cache), a run only
+      downloads the pack indexes it does not know yet
+    - restore fetches byte ranges of the packs (neighbour chunks in one request), checks every chunk against
+      its name and the whole file against the Dropbox content hash before moving it in place
+"""
+
+import os, json, time, uuid, zlib, sqlite3, calendar, hashlib, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import dropbox
+
+from dropbox_content_hasher import DropboxContentHasher
+from hash_cache import DEFAULT_CACHE_PATH
+from metrics import phase, count
+from remote_ops import delete_batch, is_gone
+from retry import call_with_retry
+from up_to_dropbox import dropbox_list_folder
+
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+ANCHOR_MASK = 0xfff  # 1 candidate in 4096 is a cut => ~1 MB chunks with 0x0A every ~256 bytes
+WINDOW = 64
+READ_SIZE = 8 * 1024 * 1024
+DEFAULT_PACK_SIZE = 64 * 1024 * 1024
+MAX_RANGE = 16 * 1024 * 1024  # neighbour chunks fetched in one request up to this size
+
+
+def _find_cut(buf, min_size, max_size, mask, eof):
+    """ End of the next chunk in buf, None when more data is needed to decide """
+    end = min(len(buf), max_size)
+    with memoryview(buf) as view:
+        pos = buf.find(b'\n', min_size - 1, end)
+        while pos != -1:
+            if not zlib.crc32(view[pos + 1 - WINDOW:pos + 1]) & mask:
+                return pos + 1
+            pos = buf.find(b'\n', pos + 1, end)
+    if len(buf) >= max_size or eof:
+        return end
+    return None
+
+
+def split_chunks(f, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=ANCHOR_MASK):
+    """ Yield the content-defined chunks (bytes) of a binary file object """
+    buf = bytearray()
+    eof = False
+    while True:
+        cut = _find_cut(buf, min_size, max_size, mask, eof) if buf else None
+        if cut is None:
+            if eof:
+                return
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf += data
+            continue
+        with memoryview(buf) as view:
+            chunk = bytes(view[:cut])
+        del buf[:cut]
+        yield chunk
+
+
+class ChunkStore:
+    def __init__(self, dbx, session, remote_folder_path, upload, db_path=DEFAULT_CACHE_PATH, level=5,
+                 pack_size=DEFAULT_PACK_SIZE, retries=5, workers=4, timeout=100, work_dir='.'):
+        """
+            - upload(local_path, remote_folder, name) uploads a pack and returns its FileMetadata
+              (DropBoxUpload.UpLoadFile: chunked sessions, retries, bandwidth limit, resume)
+            - session: requests session fetching pack ranges from temporary links
+        """
+        self.dbx = dbx
+        self.session = session
+        self.remote_folder_path = remote_folder_path
+        self.packs_path = f'{remote_folder_path}/.chunks/packs'
+        self.manifests_path = f'{remote_folder_path}/.chunks/manifests'
+        self.upload = upload
+        self.level = level
+        self.pack_size = pack_size
+        self.retries = retries
+        self.workers = workers
+        self.timeout = timeout
+        self.work_dir = work_dir  # temp packs
+        self.store = remote_folder_path.rstrip('/').lower()
+        self._synced = False
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS chunk_index (
+                store TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                pack TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                raw_size INTEGER NOT NULL,
+                PRIMARY KEY (store, chunk_id))''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS chunk_index_pack ON chunk_index (store, pack)')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS chunk_packs (
+                store TEXT NOT NULL,
+                pack TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (store, pack))''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS chunk_manifests (
+                store TEXT NOT NULL,
+                name TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (store, name))''')
+
+    # Remote files
+
+    def _put_json(self, remote_path, value):
+        data = json.dumps(value, separators=(',', ':')).encode()
+        return call_with_retry(self.dbx.files_upload, data, remote_path, mode=dropbox.files.WriteMode('overwrite'), retries=self.retries)
+
+    def _get_json(self, remote_path):
+        meta, response = call_with_retry(self.dbx.files_download, remote_path, retries=self.retries)
+        with response:
+            return meta, json.loads(response.content)
+
+    def _list(self, remote_path):
+        try:
+            return list(dropbox_list_folder(remote_path, self.dbx))
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return []
+            raise
+
+    def _delete(self, remote_paths):
+        """ Delete remote_paths in one batch, return those deleted (or already missing) """
+        results = delete_batch(self.dbx, remote_paths, retries=self.retries)
+        for remote_path, result in zip(remote_paths, results):
+            if not is_gone(result):
+                print(f'Error deleting {remote_path}: {result}')
+        return [remote_path for remote_path, result in zip(remote_paths, results) if is_gone(result)]
+
+    # Local chunk index
+
+    def _add_pack(self, pack, size, chunks):
+        """ chunks: [[chunk_id, offset, length, raw_size]] as stored in the pack index """
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO chunk_index VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(self.store, c[0], pack, c[1], c[2], c[3]) for c in chunks])
+            self._conn.execute('INSERT OR REPLACE INTO chunk_packs VALUES (?, ?, ?)', (self.store, pack, size))
+
+    def _drop_pack(self, pack):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM chunk_index WHERE store = ? AND pack = ?', (self.store, pack))
+            self._conn.execute('DELETE FROM chunk_packs WHERE store = ? AND pack = ?', (self.store, pack))
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _known(self, chunk_id):
+        return bool(self._query('SELECT 1 FROM chunk_index WHERE store = ? AND chunk_id = ?', self.store, chunk_id))
+
+    def _locate(self, chunk_id):
+        rows = self._query('SELECT pack, offset, length, raw_size FROM chunk_index WHERE store = ? AND chunk_id = ?', self.store, chunk_id)
+        return rows[0] if rows else None
+
+    def sync_index(self):
+        """ Bring the local chunk index up to date with the remote packs (once per run) """
+        if self._synced:
+            return
+        with phase('chunk_index'):
+            files = self._list(self.packs_path)
+            indexes = set(f.name[:-len('.json')] for f in files if f.name.endswith('.json'))
+            packs = {f.name[:-len('.pack')]: f.size for f in files if f.name.endswith('.pack')}
+            known = set(row[0] for row in self._query('SELECT pack FROM chunk_packs WHERE store = ?', self.store))
+            for pack in known - indexes:
+                self._drop_pack(pack)  # deleted by gc on another machine
+            missing = [p for p in indexes if p not in known and p in packs]
+            if missing:
+                print(f'Getting {len(missing)} chunk pack indexes...')
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    for pack, (meta, index) in zip(missing, executor.map(lambda p: self._get_json(f'{self.packs_path}/{p}.json'), missing)):
+                        self._add_pack(pack, packs[pack], index['chunks'])
+        self._synced = True
+
+    # Manifests
+
+    def manifests(self):
+        """ {name: FileMetadata} of the manifests on Dropbox """
+        return {f.name[:-len('.json')]: f for f in self._list(self.manifests_path) if f.name.endswith('.json')}
+
+    def manifest(self, name, meta=None):
+        """ Manifest of a backup, from the local cache when the remote file did not change """
+        meta = meta or call_with_retry(self.dbx.files_get_metadata, f'{self.manifests_path}/{name}.json', retries=self.retries)
+        rows = self._query('SELECT content_hash, body FROM chunk_manifests WHERE store = ? AND name = ?', self.store, name)
+        if rows and rows[0][0] == meta.content_hash:
+            return json.loads(rows[0][1])
+        meta, manifest = self._get_json(f'{self.manifests_path}/{name}.json')
+        self._cache_manifest(name, meta.content_hash, manifest)
+        return manifest
+
+    def _cache_manifest(self, name, content_hash, manifest):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO chunk_manifests VALUES (?, ?, ?, ?)',
+                               (self.store, name, content_hash, json.dumps(manifest, separators=(',', ':'))))
+
+    # Backup
+
+    def _new_pack(self):
+        pack = uuid.uuid4().hex
+        return pack, os.path.join(self.work_dir, f'temp-pack-{pack}.pack')
+
+    def _upload_pack(self, pack, pack_path, entries):
+        """ Upload a written pack then its index, index it locally """
+        meta = self.upload(pack_path, self.packs_path, f'{pack}.pack')
+        if not isinstance(meta, dropbox.files.FileMetadata):
+            raise IOError(f'Upload of chunk pack {pack} failed')
+        self._put_json(f'{self.packs_path}/{pack}.json', {'pack': pack, 'chunks': entries})
+        self._add_pack(pack, os.path.getsize(pack_path), entries)
+        os.remove(pack_path)
+        count('chunk_packs')
+
+    def backup(self, local_path, name=None):
+        """ Store local_path as the backup name (default: its file name), return its manifest """
+        name = name or os.path.basename(local_path)
+        self.sync_index()
+        hasher = DropboxContentHasher()
+        chunks = []
+        pending = set()  # chunks written to the current pack, not indexed yet
+        new_bytes = reused_bytes = 0
+        pack = pack_path = pack_file = None
+        entries = []
+        st = os.stat(local_path)
+        try:
+            with open(local_path, 'rb') as f, phase('chunk', local_path, st.st_size):
+                for data in split_chunks(f):
+                    hasher.update(data)
+                    chunk_id = hashlib.sha256(data).hexdigest()
+                    chunks.append([chunk_id, len(data)])
+                    if chunk_id in pending or self._known(chunk_id):
+                        reused_bytes += len(data)
+                        continue
+                    if pack_file is None:
+                        pack, pack_path = self._new_pack()
+                        pack_file = open(pack_path, 'wb')
+                        entries = []
+                    compressed = zlib.compress(data, self.level)
+                    entries.append([chunk_id, pack_file.tell(), len(compressed), len(data)])
+                    pack_file.write(compressed)
+                    pending.add(chunk_id)
+                    new_bytes += len(data)
+                    if pack_file.tell() >= self.pack_size:
+                        pack_file.close()
+                        pack_file = None
+                        self._upload_pack(pack, pack_path, entries)
+                        pending.clear()
+            if pack_file is not None:
+                pack_file.close()
+                pack_file = None
+                self._upload_pack(pack, pack_path, entries)
+        finally:
+            if pack_file is not None:
+                pack_file.close()
+            if pack_path and os.path.exists(pack_path):
+                os.remove(pack_path)
+
+        manifest = {'version': 1, 'name': name, 'size': st.st_size, 'mtime': st.st_mtime, 'created': time.time(),
+                    'content_hash': hasher.hexdigest(), 'chunks': chunks}
+        meta = self._put_json(f'{self.manifests_path}/{name}.json', manifest)
+        self._cache_manifest(name, meta.content_hash, manifest)
+        count('chunks_new_bytes', new_bytes)
+        count('bytes_saved', reused_bytes)
+        print(f'{name}: {len(chunks)} chunks, {new_bytes / 1024 / 1024:.1f} MB new, {reused_bytes / 1024 / 1024:.1f} MB already stored')
+        return manifest
+
+    # Restore
+
+    def _link(self, pack, links):
+        if pack not in links:
+            links[pack] = call_with_retry(self.dbx.files_get_temporary_link, f'{self.packs_path}/{pack}.pack', retries=self.retries).link
+        return links[pack]
+
+    def _fetch(self, link, start, end):
+        def get():
+            response = self.session.get(link, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=self.timeout)
+            response.raise_for_status()
+            if len(response.content) != end - start:
+                raise IOError(f'Short range read {len(response.content)} != {end - start}')
+            return response.content
+        return call_with_retry(get, retries=self.retries)
+
+    def _ranges(self, chunks):
+        """ [(pack, start, end, [(chunk_id, offset in range, length, raw_size)])], neighbour chunks merged, file order kept """
+        ranges = []
+        for chunk_id, raw_size in chunks:
+            location = self._locate(chunk_id)
+            if location is None:
+                raise KeyError(f'Chunk {chunk_id} is not in any pack')
+            pack, offset, length, _ = location
+            last = ranges[-1] if ranges else None
+            if last and last[0] == pack and last[2] == offset and offset + length - last[1] <= MAX_RANGE:
+                last[3].append((chunk_id, offset - last[1], length, raw_size))
+                last[2] = offset + length
+            else:
+                ranges.append([pack, offset, offset + length, [(chunk_id, 0, length, raw_size)]])
+        return ranges
+
+    def restore(self, name, local_path):
+        """ Rebuild the backup name into local_path (a folder keeps the name), return its manifest """
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, name)
+        manifest = self.manifest(name)
+        self.sync_index()
+        ranges = self._ranges(manifest['chunks'])
+        links = {}
+        for pack in set(r[0] for r in ranges):
+            self._link(pack, links)
+        temp_path = local_path + '.part'
+        hasher = DropboxContentHasher()
+        print(f'Restore {name} ({len(manifest["chunks"])} chunks, {len(ranges)} requests) => {local_path}')
+        with open(temp_path, 'wb') as f, phase('download', local_path, manifest['size']), \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            window = deque()
+            todo = iter(ranges)
+
+            def submit():
+                r = next(todo, None)
+                if r is not None:
+                    window.append((r, executor.submit(self._fetch, links[r[0]], r[1], r[2])))
+
+            for _ in range(self.workers * 2):  # bounded read-ahead
+                submit()
+            while window:
+                (pack, start, end, members), future = window.popleft()
+                data = future.result()
+                submit()
+                for chunk_id, offset, length, raw_size in members:
+                    chunk = zlib.decompress(data[offset:offset + length])
+                    if len(chunk) != raw_size or hashlib.sha256(chunk).hexdigest() != chunk_id:
+                        raise IOError(f'Chunk {chunk_id} of pack {pack} is corrupted')
+                    hasher.update(chunk)
+                    f.write(chunk)
+        if hasher.hexdigest() != manifest['content_hash']:
+            os.remove(temp_path)
+            raise IOError(f'Content hash mismatch restoring {name}')
+        os.utime(temp_path, (manifest['mtime'], manifest['mtime']))
+        os.replace(temp_path, local_path)
+        print(f'Restored {local_path}, content hash verified')
+        return manifest
+
+    # Garbage collection
+
+    def gc(self, keep_days=None, repack_ratio=0.5):
+        """
+            - keep_days: delete the manifests uploaded more than keep_days ago first
+            - packs without any chunk referenced by a manifest are deleted, packs with less than
+              repack_ratio of live bytes are rewritten with their live chunks only
+            - Return a dict of counters
+        """
+        stats = {'manifests_deleted': 0, 'packs_deleted': 0, 'packs_repacked': 0, 'bytes_freed': 0}
+        manifests = self.manifests()
+        if keep_days is not None:
+            limit = time.time() - keep_days * 86400
+            expired = {meta.path_display: name for name, meta in manifests.items()
+                       if calendar.timegm(meta.server_modified.utctimetuple()) < limit}  # naive UTC datetimes
+            for remote_path in self._delete(list(expired)):
+                with self._lock, self._conn:
+                    self._conn.execute('DELETE FROM chunk_manifests WHERE store = ? AND name = ?', (self.store, expired[remote_path]))
+                del manifests[expired[remote_path]]
+                stats['manifests_deleted'] += 1
+        self._synced = False
+        self.sync_index()
+        live = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for manifest in executor.map(lambda item: self.manifest(*item), manifests.items()):
+                live.update(c[0] for c in manifest['chunks'])
+
+        remote_packs = set(f.name.rsplit('.', 1)[0] for f in self._list(self.packs_path))
+        indexed = dict(self._query('SELECT pack, size FROM chunk_packs WHERE store = ?', self.store))
+        dead = sorted(remote_packs - set(indexed))  # upload interrupted before its index (or the opposite)
+        stats['packs_deleted'] += len(dead)
+        for pack, size in indexed.items():
+            rows = self._query('SELECT chunk_id, offset, length, raw_size FROM chunk_index WHERE store = ? AND pack = ? ORDER BY offset',
+                               self.store, pack)
+            live_rows = [r for r in rows if r[0] in live]
+            live_bytes = sum(r[2] for r in live_rows)
+            if live_rows and live_bytes >= size * repack_ratio:
+                continue
+            if live_rows:
+                self._repack(pack, live_rows)
+                stats['packs_repacked'] += 1
+            else:
+                stats['packs_deleted'] += 1
+            self._drop_pack(pack)  # a pack whose delete fails below is unindexed => deleted by the next gc
+            dead.append(pack)
+            stats['bytes_freed'] += size - live_bytes
+        # old packs go in one batch, once every repacked chunk is in its new pack
+        self._delete([f'{self.packs_path}/{pack}.{ext}' for pack in dead for ext in ('json', 'pack')])
+        print('Chunk store gc: {manifests_deleted} manifests, {packs_deleted} packs deleted, {packs_repacked} repacked, '
+              '{freed:.1f} MB freed'.format(freed=stats['bytes_freed'] / 1024 / 1024, **stats))
+        return stats
+
+    def _repack(self, pack, live_rows):
+        """ Copy the live chunks of pack into a new pack (uploaded and indexed before the old one is deleted) """
+        link = self._link(pack, {})
+        new_pack, pack_path = self._new_pack()
+        entries = []
+        try:
+            with open(pack_path, 'wb') as pack_file:
+                for chunk_id, offset, length, raw_size in live_rows:
+                    entries.append([chunk_id, pack_file.tell(), length, raw_size])
+                    pack_file.write(self._fetch(link, offset, offset + length))
+            self._upload_pack(new_pack, pack_path, entries)  # the new entries replace the old ones (same chunk ids)
+        finally:
+            if os.path.exists(pack_path):
+                os.remove(pack_path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
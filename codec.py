@@ -0,0 +1,120 @@
+""" Per-file codec selection
+    - a few evenly spaced blocks of the file are deflated at level 1 to estimate its compressibility
+    - the estimate is blended with the ratios measured on past runs for the same extension (sqlite)
+    - already compressed data (zip, gz, media, natively compressed .bak...) is stored or not archived
+      at all instead of burning CPU for ~0% gain, very compressible data (text, SQL dumps) gets a high level
+"""
+
+import os, time, zlib, sqlite3, threading
+
+from hash_cache import DEFAULT_CACHE_PATH
+
+SAMPLES = 4
+SAMPLE_SIZE = 256 * 1024
+CODEC_LEVELS = {'skip': None, 'store': 0, 'fast': 1, 'high': 9}
+
+
+def extension(local_file_path):
+    return os.path.splitext(local_file_path)[1].lower()
+
+
+def sample_ratio(local_file_path, samples=SAMPLES, sample_size=SAMPLE_SIZE):
+    """ Compressed / original size of samples blocks spread over the file (1.0 = incompressible) """
+    size = os.path.getsize(local_file_path)
+    if size <= samples * sample_size:
+        offsets = [0]
+        sample_size = size
+    else:
+        step = (size - sample_size) // (samples - 1)
+        offsets = [i * step for i in range(samples)]
+    original = compressed = 0
+    with open(local_file_path, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            data = f.read(sample_size)
+            c = zlib.compressobj(1, zlib.DEFLATED, -15)
+            compressed += len(c.compress(data)) + len(c.flush())
+            original += len(data)
+    return compressed / original if original else 1.0
+
+
+class CodecStats:
+    """ Compression ratio per file extension, moving average over the past runs """
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, weight=0.3):
+        self.weight = weight  # share of the latest run in the average
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS codec_stats (
+                ext TEXT PRIMARY KEY,
+                runs INTEGER NOT NULL,
+                ratio REAL NOT NULL,
+                updated REAL NOT NULL)''')
+
+    def lookup(self, ext):
+        """ Return (runs, ratio) of an extension, None if never seen """
+        with self._lock:
+            row = self._conn.execute('SELECT runs, ratio FROM codec_stats WHERE ext = ?', (ext,)).fetchone()
+        return tuple(row) if row else None
+
+    def record(self, ext, ratio):
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT runs, ratio FROM codec_stats WHERE ext = ?', (ext,)).fetchone()
+            if row is None:
+                self._conn.execute('INSERT INTO codec_stats VALUES (?, 1, ?, ?)', (ext, ratio, time.time()))
+            else:
+                self._conn.execute('UPDATE codec_stats SET runs = ?, ratio = ?, updated = ? WHERE ext = ?',
+                                   (row[0] + 1, row[1] * (1 - self.weight) + ratio * self.weight, time.time(), ext))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CodecSelector:
+    """ Pick skip (upload as is), store, fast, deflate (default level) or high for each file """
+
+    def __init__(self, stats=None, default_level=5, skip_ratio=0.98, store_ratio=0.92, fast_ratio=0.6,
+                 high_ratio=0.25, min_size=64 * 1024, history_weight=5):
+        self.stats = stats
+        self.default_level = default_level
+        self.skip_ratio = skip_ratio
+        self.store_ratio = store_ratio
+        self.fast_ratio = fast_ratio
+        self.high_ratio = high_ratio
+        self.min_size = min_size  # smaller files are zipped at the default level, nothing to save
+        self.history_weight = history_weight  # max weight of the past runs against the fresh sample
+
+    def estimate(self, local_file_path):
+        """ Return (blended ratio, sampled ratio) """
+        sampled = sample_ratio(local_file_path)
+        learned = self.stats.lookup(extension(local_file_path)) if self.stats is not None else None
+        if learned is None:
+            return sampled, sampled
+        weight = min(learned[0], self.history_weight)
+        return (sampled + learned[1] * weight) / (1 + weight), sampled
+
+    def choose(self, local_file_path):
+        """ Return (codec, level, estimated ratio), level 0 means stored, None not archived """
+        if os.path.getsize(local_file_path) < self.min_size:
+            return 'deflate', self.default_level, None
+        ratio, sampled = self.estimate(local_file_path)
+        if ratio >= self.skip_ratio:
+            codec = 'skip'
+        elif ratio >= self.store_ratio:
+            codec = 'store'
+        elif ratio >= self.fast_ratio:
+            codec = 'fast'
+        elif ratio < self.high_ratio:
+            codec = 'high'
+        else:
+            codec = 'deflate'
+        if codec in ('skip', 'store'):
+            self.learn(local_file_path, sampled)  # nothing is deflated, the sample is the only measure
+        return codec, CODEC_LEVELS.get(codec, self.default_level), ratio
+
+    def learn(self, local_file_path, ratio):
+        """ Record the ratio measured on the real compressed output """
+        if self.stats is not None:
+            self.stats.record(extension(local_file_path), ratio)
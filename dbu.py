@@ -1,110 +1,539 @@
-import os, argparse, dropbox, time, re
+import os, argparse, dropbox, time, re, tempfile, hashlib
+from datetime import datetime
 from os import walk
 from os.path import basename
-from dotenv import dotenv_values
-import csv
+import csv, signal, threading
 import types
 from functools import partial
-from zipfile import ZipFile, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 from up_to_dropbox import *
-from dropbox_content_hasher import DropboxContentHasher
-
-from tqdm import tqdm
-
-keys = dotenv_values('./.env_dropbox')
-APP_KEY = keys['APP_KEY']
-APP_SECRET = keys['APP_SECRET']
-REFRESH_TOKEN = keys['REFRESH_TOKEN']
+from dropbox_content_hasher import DropboxContentHasher, StreamHasher
+from parallel_hasher import content_hash_file
+from hash_cache import HashCache, DEFAULT_CACHE_PATH
+from stream_upload import UploadSessionWriter
+from remote_state import RemoteState
+from history_store import HistoryStore, DEFAULT_HISTORY_DIR
+from dropbox_client import get_clients, DEFAULT_TOKEN_CACHE_PATH
+from upload_journal import UploadJournal, correct_offset
+from retry import call_with_retry
+from dedup import Deduplicator
+from parallel_zip import parallel_zip
+from download import download_file
+from codec import CodecSelector, CodecStats
+from buffer_pool import BufferPool, buffer_pool, set_buffer_pool, payload
+from metrics import Metrics, set_metrics, get_metrics, instrument_session, phase, count, timed
+from watch import Watcher
+from sync_manifest import SyncManifest, scan_tree
+from chunk_store import ChunkStore
+from remote_ops import move_batch, delete_batch, is_gone
+from scheduler import Scheduler, JobRunning, DEFAULT_SCHEDULER_DIR, job_key, parse_deadline, set_job, admission
+from throttle import ChunkSizer, TokenBucket, throttle, set_limiter, parse_rate, parse_schedule
+from progress import progress_bar
 
 class DropBoxUpload:
-    def __init__(self,timeout=900,chunk=8, monthly_mode=False, monthly_regex='', show_pbar=True):
-        self.APP_KEY = APP_KEY
-        self.APP_SECRET = APP_SECRET
-        self.REFRESH_TOKEN = REFRESH_TOKEN
+    def __init__(self,timeout=900,chunk=8, monthly_mode=False, monthly_regex='', show_pbar=True, hash_jobs=None, cache=None, parallel_chunks=1, list_workers=8, remote_state=None, history_dir=DEFAULT_HISTORY_DIR, compact_every=50, journal=None, retries=5, dedup=None, auto_chunk=False, zip_level=5, zip_workers=1, codec=None, keep=0, work_dir='.'):
         self.timeout = timeout
         self.chunk = chunk
         self.monthly_mode = monthly_mode  # Upload override daily backup file for a month (using dropbox version to restore)
         self.monthly_regex = monthly_regex or '(.*)(\d{8}).*(\..*)'
-        self.dbx = dropbox.Dropbox(app_key=self.APP_KEY, app_secret=self.APP_SECRET, oauth2_refresh_token=self.REFRESH_TOKEN)
         self.show_pbar = show_pbar
+        self.hash_jobs = hash_jobs  # threads for FileHash, None => number of cores
+        self.cache = cache  # HashCache, local hash/upload cache keyed on path, size, mtime_ns and inode
+        self.parallel_chunks = parallel_chunks  # > 1 => chunks of one file are appended concurrently (UpLoadFileParallel)
+        self.list_workers = list_workers  # concurrent files_list_revisions calls in FileNeedUpload
+        self.remote_state = remote_state  # RemoteState, local mirror of remote folders refreshed with list_folder cursors
+        self.history_dir = history_dir  # local mirror of the history base and segments
+        self.compact_every = compact_every  # merge history segments into history.csv once there are this many
+        self._histories = {}
+        self._chunk_stores = {}
+        self.journal = journal  # UploadJournal, checkpoints of chunked upload sessions => resumable uploads
+        self.retries = retries  # retries of transient errors per API call
+        self.dedup = dedup  # Deduplicator, skip or server-side copy content already on Dropbox
+        self.auto_chunk = auto_chunk  # grow/shrink the chunk size of upload sessions from the measured throughput
+        self.zip_level = zip_level  # deflate level of ZipFile
+        self.zip_workers = zip_workers  # > 1 => ZipFile compresses blocks on a process pool
+        self.codec = codec  # CodecSelector, per-file choice of skip/store/fast/high from sampled compressibility
+        self.keep = keep  # retention: newest dated backups of each name kept on Dropbox (Prune), 0 => all
+        self.work_dir = work_dir  # temp zips, one folder per scheduler job
+
+    @property
+    def dbx(self):
+        """ Dropbox client of the current thread, all clients share one keep-alive session and access token """
+        return get_clients().client(timeout=self.timeout)
 
-    def UpLoadFile(self, upload_path, file_path, new_file_path=None):
+    @timed('upload', 'file_path')
+    def UpLoadFile(self, upload_path, file_path, new_file_path=None, finish=True, origin_path=None):
+        """
+            - Upload a file, chunked in an upload session when bigger than chunk MB
+            - finish=False: the last chunk closes the session without committing it and an
+              UploadSessionFinishArg is returned instead of the metadata => commit with FinishUploadBatch
+            - with a journal, session_id and acknowledged offset are checkpointed after every chunk and an
+              interrupted upload of the same (unchanged) file resumes from there; origin_path is the file
+              that was zipped into file_path
+            - transient errors are retried with backoff, an offset mismatch resyncs to the server offset
+            - every request pays the process wide rate limiter (throttle), auto_chunk adapts the chunk size
+              to the measured throughput
+            - chunks are read into the process wide buffer pool (see buffer_pool), no bytes object per read
+        """
         dbx = self.dbx
         file_size = os.path.getsize(file_path)
         CHUNK_SIZE = self.chunk * 1024 * 1024
-        dest_path = upload_path + '/' + os.path.basename(new_file_path or file_path)
+        if self.parallel_chunks > 1 and file_size > CHUNK_SIZE:
+            return self.UpLoadFileParallel(upload_path, file_path, new_file_path, finish=finish, origin_path=origin_path)
+        dest_path = upload_path + '/' + (new_file_path or os.path.basename(file_path))  # new names may hold a relative folder
         since = time.time()
         meta = None
+        journal = self.journal
+        sizer = ChunkSizer(CHUNK_SIZE, auto=self.auto_chunk)
+        buffers = buffer_pool()
+
+        def send(fn, length, *args, **kwargs):
+            # the next length bytes of f are the request body
+            with buffers.read(f, length) as chunk:
+                throttle(chunk)
+                started = time.time()
+                result = call_with_retry(fn, payload(chunk), *args, retries=self.retries, on_retry=lambda e: sizer.failed(), **kwargs)
+                sizer.update(len(chunk), time.time() - started)
+            return result
+
         with open(file_path, 'rb') as f:
-            uploaded_size = 0
             if file_size <= CHUNK_SIZE:
-                meta = dbx.files_upload(f.read(), dest_path, mode=dropbox.files.WriteMode("overwrite"))
+                meta = send(dbx.files_upload, file_size, dest_path, mode=dropbox.files.WriteMode("overwrite"))
                 time_elapsed = time.time() - since
                 print('Uploaded {} {:.2f}%'.format(file_path, 100).ljust(15) + ' --- {:.0f}m {:.0f}s'.format(time_elapsed//60,time_elapsed%60).rjust(15))
             else:
-                pbar = tqdm(unit='M', unit_scale=True, unit_divisor=1024, total=file_size, disable=not self.show_pbar)
+                pbar = progress_bar(file_size, 'M', self.show_pbar)
                 # pbar.clear()
-                upload_session_start_result = dbx.files_upload_session_start(f.read(CHUNK_SIZE))
-                cursor = dropbox.files.UploadSessionCursor(session_id=upload_session_start_result.session_id,
-                                                        offset=f.tell())
                 commit = dropbox.files.CommitInfo(path=dest_path, mode=dropbox.files.WriteMode("overwrite"))
-                pbar.update(CHUNK_SIZE)
-                while f.tell() <= file_size:
-                    if ((file_size - f.tell()) <= CHUNK_SIZE):
-                        pbar_update = file_size - f.tell()
-                        meta = dbx.files_upload_session_finish(f.read(CHUNK_SIZE), cursor, commit)
-                        pbar.update(pbar_update)
-                        # time_elapsed = time.time() - since
-                        # print('Uploaded {:.2f}%'.format(100).ljust(15) + ' --- {:.0f}m {:.0f}s'.format(time_elapsed//60,time_elapsed%60).rjust(15))
-                        break
-                    else:
-                        dbx.files_upload_session_append_v2(f.read(CHUNK_SIZE),cursor)
-                        cursor.offset = f.tell()
-                        uploaded_size += CHUNK_SIZE
-                        pbar.update(CHUNK_SIZE)
-                        # uploaded_percent = 100*uploaded_size/file_size
-                        # time_elapsed = time.time() - since
-                        # print('Uploaded {} {:.2f}%'.format(file_path, uploaded_percent).ljust(15) + ' --- {:.0f}m {:.0f}s'.format(time_elapsed//60,time_elapsed%60).rjust(15), end='\r')
+                entry = journal.lookup(dest_path, file_path) if journal is not None else None
+                if entry and entry['chunk_size'] is None:  # not a concurrent session of UpLoadFileParallel
+                    session_id, offset, closed = entry['session_id'], entry['offset'], bool(entry['closed'])
+                    print('Resume {} from {:.2f}%'.format(file_path, 100 * offset / file_size))
+                else:
+                    session_id = send(dbx.files_upload_session_start, sizer.size).session_id
+                    offset, closed = f.tell(), False
+                    if journal is not None:
+                        journal.start(dest_path, file_path, session_id, offset, origin_path)
+                pbar.update(offset)
+                while True:
+                    cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset)
+                    f.seek(offset)
+                    remaining = file_size - offset
+                    chunk_size = sizer.size
+                    try:
+                        if remaining <= chunk_size:
+                            if not finish:
+                                if not closed:
+                                    send(dbx.files_upload_session_append_v2, chunk_size, cursor, close=True)
+                                    if journal is not None:
+                                        journal.update(dest_path, file_size, closed=True)
+                                cursor.offset = file_size
+                                meta = dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=commit)
+                            else:
+                                meta = send(dbx.files_upload_session_finish, chunk_size, cursor, commit)
+                                if journal is not None:
+                                    journal.remove(dest_path)
+                            pbar.update(remaining)
+                            # time_elapsed = time.time() - since
+                            # print('Uploaded {:.2f}%'.format(100).ljust(15) + ' --- {:.0f}m {:.0f}s'.format(time_elapsed//60,time_elapsed%60).rjust(15))
+                            break
+                        send(dbx.files_upload_session_append_v2, chunk_size, cursor)
+                        offset += chunk_size
+                        if journal is not None:
+                            journal.update(dest_path, offset)
+                        pbar.update(chunk_size)
+                    except dropbox.exceptions.ApiError as e:
+                        server_offset = correct_offset(e)
+                        if server_offset is None:
+                            if journal is not None:
+                                journal.remove(dest_path)  # session expired or unusable => next run starts over
+                            raise
+                        print(f'Offset mismatch => resync from {server_offset}')
+                        pbar.update(server_offset - offset)
+                        offset = server_offset
+                        if journal is not None:
+                            journal.update(dest_path, offset)
                 pbar.close()
         return meta
 
-    def RenameFile(self, remote_folder_path, remote_name, remote_new_name):
-        # Delete new_name if exists
-        # Rename to new_name
+    def UpLoadFileParallel(self, upload_path, file_path, new_file_path=None, parallel=None, finish=True, origin_path=None):
+        """
+            - Upload a big file through a concurrent upload session: chunks at known offsets are appended in parallel
+            - parallel (default self.parallel_chunks) chunks are in flight at once, each worker reads its own
+              chunk into a buffer of the pool => memory is bounded to parallel * chunk size
+            - chunks are 4 MB aligned (required by concurrent sessions), the last one closes the session
+              once every other chunk is acknowledged, then the session is committed
+            - finish=False: return the UploadSessionFinishArg instead of committing (see FinishUploadBatch)
+            - with a journal, the session and every acknowledged chunk are checkpointed, an interrupted upload of
+              the same (unchanged) file with the same chunk size only sends the missing chunks
+        """
+        parallel = parallel or self.parallel_chunks
+        file_size = os.path.getsize(file_path)
+        BLOCK = DropboxContentHasher.BLOCK_SIZE
+        CHUNK_SIZE = max(1, -(-self.chunk * 1024 * 1024 // BLOCK)) * BLOCK
+        dest_path = upload_path + '/' + (new_file_path or os.path.basename(file_path))
+        offsets = list(range(0, file_size, CHUNK_SIZE)) or [0]
+        last_offset = offsets.pop()
+        journal = self.journal
 
-        remote_name_path = f'{remote_folder_path}/{remote_name}'
-        remote_new_name_path = f'{remote_folder_path}/{remote_new_name}'
+        entry = journal.lookup(dest_path, file_path) if journal is not None else None
+        pbar = progress_bar(file_size, 'M', self.show_pbar)
+        if entry and entry['chunk_size'] == CHUNK_SIZE:
+            done = journal.chunks(dest_path)
+            session_id, closed = entry['session_id'], bool(entry['closed']) or last_offset in done
+            offsets = [offset for offset in offsets if offset not in done]
+            sent = file_size if closed else sum(min(CHUNK_SIZE, file_size - offset) for offset in done)
+            print('Resume {} from {:.2f}%'.format(file_path, 100 * sent / file_size))
+            pbar.update(sent)
+        else:
+            session_id = call_with_retry(self.dbx.files_upload_session_start, b'', session_type=dropbox.files.UploadSessionType.concurrent, retries=self.retries).session_id
+            closed = False
+            if journal is not None:
+                journal.start(dest_path, file_path, session_id, 0, origin_path, chunk_size=CHUNK_SIZE)
+        buffers = buffer_pool()
+        fd = os.open(file_path, os.O_RDONLY)
         try:
-            rename_meta = self.dbx.files_move(remote_name_path, remote_new_name_path)
-        except dropbox.exceptions.ApiError as e:
-            if isinstance(e.error, dropbox.files.RelocationError):
-                print('File exists => Delete first')
-                delete_meta = self.dbx.files_delete(remote_new_name_path)
-                if delete_meta.name == remote_new_name:
-                    rename_meta = self.dbx.files_move(remote_name_path, remote_new_name_path)
-        if rename_meta.name == remote_new_name:
-            print('Rename done!')
+            def append(offset, close=False):
+                with buffers.read(fd, CHUNK_SIZE, offset) as chunk:
+                    throttle(chunk)
+                    cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset)
+                    call_with_retry(self.dbx.files_upload_session_append_v2, payload(chunk), cursor, close=close, retries=self.retries)
+                    if journal is not None:
+                        journal.add_chunk(dest_path, offset)
+                    pbar.update(len(chunk))
 
-    def FileHash(self, local_file_path):
-        print(f'Compute {local_file_path} content hash -- It may take a long time!')
+            if not closed:
+                with ThreadPoolExecutor(max_workers=parallel) as executor:
+                    for _ in executor.map(append, offsets):
+                        pass
+                append(last_offset, close=True)
+                if journal is not None:
+                    journal.update(dest_path, file_size, closed=True)
+
+            cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=file_size)
+            commit = dropbox.files.CommitInfo(path=dest_path, mode=dropbox.files.WriteMode("overwrite"))
+            if not finish:
+                return dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=commit)
+            meta = call_with_retry(self.dbx.files_upload_session_finish, b'', cursor, commit, retries=self.retries)
+            if journal is not None:
+                journal.remove(dest_path)
+            return meta
+        except dropbox.exceptions.ApiError:
+            if journal is not None:
+                journal.remove(dest_path)  # session expired or unusable => next run starts over
+            raise
+        finally:
+            os.close(fd)
+            pbar.close()
+
+    @timed('stream_upload', 'local_file_path')
+    def ZipUpLoadFile(self, upload_path, local_file_path, new_file_name, level=None):
+        """
+            - Zip a file or a folder straight into an upload session, no temp zip on disk
+            - compression and upload overlap: chunks are sent while the next ones are compressed
+            - the content hash is computed in-flight and checked against the returned metadata
+        """
+        dest_path = upload_path + '/' + new_file_name
+        writer = UploadSessionWriter(self.dbx, dest_path, self.chunk * 1024 * 1024, show_pbar=self.show_pbar, retries=self.retries)
         hasher = DropboxContentHasher()
-        file_size = os.path.getsize(local_file_path)
-        chunked_size = 0
-        with open(local_file_path, 'rb') as f:  # Slow for big file
-            pbar = tqdm(unit='G', unit_scale=True, unit_divisor=1024, total=file_size, disable=not self.show_pbar)
-            pbar.clear()
-            while True:
-                chunk = f.read(1024)
-                chunked_size += 1024
-                pbar.update(1024)
-                if len(chunk) == 0:
+        try:
+            self.ZipFile(local_file_path, StreamHasher(writer, hasher), level=level)
+        except Exception:
+            writer.abort()
+            raise
+        meta = writer.close()
+        local_hash = hasher.hexdigest()
+        if meta.content_hash != local_hash:
+            raise ValueError(f'Content hash mismatch for {dest_path}: local {local_hash}, Dropbox {meta.content_hash}')
+        print(f'Uploaded {dest_path}, content hash verified')
+        return meta
+
+    def Deduplicate(self, payload_path, dest_path, local_hash=True):
+        """
+            - Return the FileMetadata of dest_path when uploading payload_path is not needed, else None
+            - same content at dest_path (or in one of its revisions) => skip, at another path => files_copy_v2
+            - local_hash: payload_path is a local backup file => its hash goes through the hash cache
+        """
+        if self.dedup is None:
+            return None
+        content_hash = self.FileHash(payload_path) if local_hash else content_hash_file(payload_path, jobs=self.hash_jobs)
+        return self._Deduplicated(content_hash, dest_path, os.path.getsize(payload_path))
+
+    def DeduplicateZip(self, local_file_path, dest_path):
+        """
+            - Deduplicate the zip of local_file_path before zipping it: zips of the same content are not byte identical
+              (arcname, mtime), the zips uploaded for the content hash of the local file are looked up instead
+              (this run: Deduplicator.payloads, earlier runs: uploaded_hash in the hash cache)
+            - Return (FileMetadata of dest_path or None, content hash of local_file_path)
+        """
+        if self.dedup is None:
+            return None, None
+        source_hash = self.FileHash(local_file_path)
+        payload_hashes = self.dedup.payloads(source_hash)
+        if self.cache is not None:
+            payload_hashes |= self.cache.uploaded_hashes(source_hash)
+        for payload_hash in sorted(payload_hashes):
+            meta = self._Deduplicated(payload_hash, dest_path)
+            if meta is not None:
+                return meta, source_hash
+        return None, source_hash
+
+    def _Deduplicated(self, content_hash, dest_path, size=None):
+        """ Skip or copy content_hash to dest_path as found by the Deduplicator, size: bytes saved (None => remote size) """
+        action, remote = self.dedup.check(content_hash, dest_path)
+        if action is None:
+            return None
+        if action == 'skip':
+            print(f'{dest_path}: same content already on Dropbox => skip upload')
+            meta = remote if isinstance(remote, dropbox.files.FileMetadata) else call_with_retry(self.dbx.files_get_metadata, remote, retries=self.retries)
+        else:
+            print(f'{dest_path}: same content in {remote} => server-side copy')
+            meta = call_with_retry(self.dbx.files_copy_v2, remote, dest_path, retries=self.retries).metadata
+            self.dedup.record(meta)
+        size = meta.size if size is None else size
+        self.dedup.saved(action, size)
+        count(f'dedup_{action}')
+        count('bytes_saved', size)
+        return meta
+
+    @timed('commit')
+    def FinishUploadBatch(self, entries, poll_interval=1):
+        """
+            - Commit closed upload sessions (list of UploadSessionFinishArg) together
+            - Return the FileMetadata of each entry in the same order, None if its commit failed
+        """
+        metas = []
+        for i in range(0, len(entries), 1000):  # Dropbox limit per batch
+            launch = self.dbx.files_upload_session_finish_batch(entries[i:i + 1000])
+            if launch.is_complete():
+                result = launch.get_complete()
+            else:
+                async_job_id = launch.get_async_job_id()
+                while True:
+                    job = self.dbx.files_upload_session_finish_batch_check(async_job_id)
+                    if job.is_complete():
+                        result = job.get_complete()
+                        break
+                    time.sleep(poll_interval)
+            for entry in result.entries:
+                if entry.is_success():
+                    metas.append(entry.get_success())
+                else:
+                    print('Error happen while committing upload session', entry.get_failure())
+                    metas.append(None)
+        return metas
+
+    def UploadFiles(self, upload_path, file_paths, zip_files=True, workers=1, stream=False):
+        """
+            - Zip (optional) and upload a list of (local_path, new_name)
+            - Return a list of (local_path, meta) in the same order, meta is None when the upload failed
+            - workers > 1: a thread pool zips and uploads several files at once, each file with its own temp zip,
+              upload sessions are committed together with files_upload_session_finish_batch
+            - stream: zip straight into the upload session (ZipUpLoadFile), no temp zip
+            - with a codec selector, incompressible files are stored or uploaded without zip (see ChooseCodec)
+            - with a journal, temp zips are named after their source and kept when the upload fails,
+              the next run resumes the upload without compressing again
+        """
+        def journal_zip_path(path):
+            if self.journal is None:
+                return None
+            return os.path.join(self.work_dir, 'temp-{}.zip'.format(hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]))
+
+        source_hashes = {}  # local path => content hash, for the files zipped with dedup on
+
+        def record(path, meta):
+            self.dedup.record(meta)
+            if path in source_hashes:
+                self.dedup.record_payload(source_hashes[path], meta.content_hash)
+
+        def upload(path, new_name, temp_zip_path, finish):
+            meta = zip_and_upload(path, new_name, temp_zip_path, finish)
+            if self.dedup is not None and isinstance(meta, dropbox.files.FileMetadata):
+                record(path, meta)
+            return meta
+
+        def zip_and_upload(path, new_name, temp_zip_path, finish):
+            print(path, '=>', path, 'on Dropbox', '=>', new_name)
+            codec, level = self.ChooseCodec(path) if zip_files else ('skip', None)
+            if codec == 'skip':
+                return self.Deduplicate(path, f'{upload_path}/{new_name}') or self.UpLoadFile(upload_path, path, new_name, finish=finish)
+            meta, source_hashes[path] = self.DeduplicateZip(path, f'{upload_path}/{new_name}.zip')
+            if meta is not None:
+                return meta
+            if stream:
+                meta = self.ZipUpLoadFile(upload_path, path, new_name + '.zip', level=level)
+                self.LearnCodec(path, meta.size, level)
+                return meta
+            resumable_zip = None
+            if self.journal is not None:
+                resumable_zip = self.journal.resumable_zip(f'{upload_path}/{new_name}.zip', path)
+            if resumable_zip == os.path.abspath(temp_zip_path):
+                print(f'Reuse {temp_zip_path} of the interrupted upload')
+            else:
+                self.ZipFile(path, temp_zip_path, level=level)
+                self.LearnCodec(path, os.path.getsize(temp_zip_path), level)
+            return self.UpLoadFile(upload_path, temp_zip_path, new_name + '.zip', finish=finish, origin_path=path)
+
+        if workers <= 1:
+            results = []
+            for path, new_name in file_paths:
+                meta = None
+                temp_zip_path = journal_zip_path(path) or os.path.join(self.work_dir, 'temp.zip')
+                try:
+                    meta = upload(path, new_name, temp_zip_path, True)
+                    if zip_files and not stream and isinstance(meta, dropbox.files.FileMetadata) and os.path.exists(temp_zip_path):
+                        os.remove(temp_zip_path)
+                except Exception as e:
+                    print('Error happen', e)
+                results.append((path, meta))
+            return results
+
+        def work(item):
+            path, new_name = item
+            temp_zip_path = None
+            meta = None
+            if zip_files and not stream:
+                temp_zip_path = journal_zip_path(path)
+                if temp_zip_path is None:
+                    fd, temp_zip_path = tempfile.mkstemp(prefix='temp-', suffix='.zip', dir=self.work_dir)
+                    os.close(fd)
+            try:
+                meta = upload(path, new_name, temp_zip_path, False)
+                return meta
+            except Exception as e:
+                print('Error happen', e)
+                return None
+            finally:
+                keep = self.journal is not None and meta is None  # resumed by the next run
+                if temp_zip_path and os.path.exists(temp_zip_path) and not keep:
+                    os.remove(temp_zip_path)
+
+        # Monthly mode maps several daily files to one remote name: they go in successive rounds
+        # so that each overwrite (and its Dropbox revision) keeps the original order
+        rounds = []
+        for item in file_paths:
+            for round_items in rounds:
+                if item[1] not in (n for _, n in round_items):
+                    round_items.append(item)
                     break
-                hasher.update(chunk)
-            pbar.close()
-        hash_info = hasher.hexdigest()
+            else:
+                rounds.append([item])
+
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for round_items in rounds:
+                metas = list(executor.map(work, round_items))
+                pending = [i for i, meta in enumerate(metas) if isinstance(meta, dropbox.files.UploadSessionFinishArg)]
+                if pending:
+                    print(f'Commit {len(pending)} upload sessions...')
+                    try:
+                        committed = self.FinishUploadBatch([metas[i] for i in pending])
+                    except dropbox.exceptions.ApiError as e:
+                        print('Error happen in FinishUploadBatch', e)
+                        committed = [None] * len(pending)
+                    for i, meta in zip(pending, committed):
+                        if meta is not None and self.journal is not None:
+                            self.journal.remove(metas[i].commit.path)
+                        if meta is not None and self.dedup is not None:
+                            record(round_items[i][0], meta)
+                        metas[i] = meta
+                results += [(path, meta) for (path, _), meta in zip(round_items, metas)]
+        return results
+
+    def RenameFile(self, remote_folder_path, remote_name, remote_new_name):
+        """ Rename remote_name to remote_new_name in remote_folder_path, an existing remote_new_name is replaced """
+        result = self.RenameFiles(remote_folder_path, [(remote_name, remote_new_name)])[0]
+        if isinstance(result, dropbox.files.Metadata):
+            print('Rename done!')
+        return result
+
+    def RenameFiles(self, remote_folder_path, renames):
+        """
+            - Rename [(remote_name, remote_new_name)] in remote_folder_path with batch moves (see remote_ops),
+              existing remote_new_names are replaced
+            - Return the Metadata of each rename in the same order, or its error
+        """
+        pairs = [(f'{remote_folder_path}/{name}', f'{remote_folder_path}/{new_name}') for name, new_name in renames]
+        with phase('rename'):
+            results = move_batch(self.dbx, pairs, overwrite=True, retries=self.retries)
+        for (name, new_name), result in zip(renames, results):
+            if not isinstance(result, dropbox.files.Metadata):
+                print(f'Error renaming {name} to {new_name}: {result}')
+        return results
+
+    def OldBackups(self, names, keep):
+        """
+            - Return the names dated before the keep newest dates of their backup, names without a date are never old
+            - a backup is the name before its YYYYMMDD (or YYYYMM) date: db_20230101.bak and db_202301.bak.zip
+              are daily and monthly dates of the backup 'db_'
+        """
+        dates = {}
+        for name in names:
+            m = re.fullmatch(r'(.*\D|)(\d{8}|\d{6})(\D.*|)', name)
+            if m:
+                dates.setdefault((m.group(1), len(m.group(2))), []).append((m.group(2), name))
+        old = []
+        for backups in dates.values():
+            newest = sorted(set(d for d, _ in backups), reverse=True)[:keep]
+            old += sorted(name for d, name in backups if d not in newest)
+        return old
+
+    def Prune(self, remote_folder_path, keep=None, archive_path=None):
+        """
+            - Retention: of the dated backups in remote_folder_path, only the keep (default self.keep) newest dates
+              of each backup stay (see OldBackups)
+            - the older ones are moved to archive_path (existing archives replaced) or deleted, in a few batch calls
+            - Return [(remote path, Metadata or error)] of the pruned backups
+        """
+        remote_files = {f.name: f for f in self.RemoteFiles(remote_folder_path)}
+        old = [remote_files[name].path_display for name in self.OldBackups(list(remote_files), keep or self.keep)]
+        if not old:
+            return []
+        with phase('prune'):
+            if archive_path:
+                print(f'Move {len(old)} old backups to {archive_path}')
+                results = move_batch(self.dbx, [(path, f'{archive_path}/{basename(path)}') for path in old],
+                                     overwrite=True, retries=self.retries)
+            else:
+                print(f'Delete {len(old)} old backups')
+                results = delete_batch(self.dbx, old, retries=self.retries)
+        count('files_pruned', sum(isinstance(r, dropbox.files.Metadata) for r in results))
+        for path, result in zip(old, results):
+            if not isinstance(result, dropbox.files.Metadata):
+                print(f'Error pruning {path}: {result}')
+        return list(zip(old, results))
+
+    def FileHash(self, local_file_path, jobs=None):
+        """ Dropbox content hash of a local file, 4 MB blocks are hashed in parallel (see parallel_hasher) """
+        if self.cache is not None:
+            hash_info = self.cache.get_hash(local_file_path)
+            if hash_info:
+                return hash_info
+        print(f'Compute {local_file_path} content hash -- It may take a long time!')
+        stat = HashCache.stat_key(local_file_path)  # before reading: a file changed meanwhile is not cached
+        file_size = stat[0]
+        pbar = progress_bar(file_size, 'G', self.show_pbar)
+        pbar.clear()
+        with phase('hash', local_file_path, file_size):
+            hash_info = content_hash_file(local_file_path, jobs=jobs or self.hash_jobs, progress=pbar.update)
+        pbar.close()
+        if self.cache is not None:
+            self.cache.put_hash(local_file_path, hash_info, stat)
         return hash_info
     
+    def RemoteFiles(self, remote_folder_path):
+        """ Files (RemoteFile) of remote_folder_path, from the remote state mirror when there is one """
+        with phase('list'):
+            if self.remote_state is not None:
+                try:
+                    return self.remote_state.sync(self.dbx, remote_folder_path)
+                except Exception as e:
+                    print('Error syncing remote state from Dropbox: ' + str(e))
+                    return []
+            return dropbox_list_files(remote_folder_path) or []
+
     def FileNeedUpload(self, remote_folder_path, local_folder_path):
         """ 
             - Return a list of file_path need to uploads
@@ -115,27 +544,56 @@ class DropBoxUpload:
         # - Get the not_up_load_file in the local_folder_path by comparing file ids in remote_folder_path with that of in csv file
         # - Return the list of orginal_name and new_name
         file_paths = []
-        remote_files_list = dropbox_list_files(remote_folder_path)
-        if remote_files_list is not None:
-           remote_files_list = remote_files_list.to_dict('records')
-        else:
-           remote_files_list = []
+        remote_files_list = self.RemoteFiles(remote_folder_path)
         local_files_list = next(walk(local_folder_path), [])[2]
+        # remote_file_ids = [r['id'] for f in remote_files_list for r in f['revisions'] + [{'id': f['id']}]]  # include the file and its revisions
+        remote_file_hashs = set(f.hash for f in remote_files_list)
+        remote_files_by_name = {f.name: f for f in remote_files_list}
+        remote_files_by_id = {f.id: f for f in remote_files_list}
+        if self.dedup is not None:
+            self.dedup.add_remote_files(remote_files_list)
+
+        # Local cache: unchanged files whose last upload is still on Dropbox are done, no file bytes needed
+        cache_entries = {}
+        if self.cache is not None:
+            for n in local_files_list:
+                entry = self.cache.lookup(f'{local_folder_path}/{n}')
+                if entry and entry['uploaded_hash']:
+                    cache_entries[n] = entry
 
         history = None
         try:
-            print('Getting uploaded history...')
-            dropbox_download_file(f'{remote_folder_path}/history.csv', './temp_history.csv')
-            with open('./temp_history.csv', 'r') as csv_file:
-                history = list(csv.DictReader(csv_file))
-                # remote_file_ids = [r['id'] for f in remote_files_list for r in f['revisions'] + [{'id': f['id']}]]  # include the file and its revisions
-                # remote_file_names = [r['name'] for f in remote_files_list for r in f['revisions'] + [{'name': f['name']}]]
-                remote_file_hashs = [r['hash'] for f in remote_files_list for r in (f['revisions'] + [{'hash': f['hash']}])]
-                uploaded_original_names = [row['original_name'] for row in history if row['hash'] in set(remote_file_hashs)]
-                files_need_to_upload = [n for n in local_files_list if n not in uploaded_original_names]
+            history = self.History(remote_folder_path)
         except dropbox.exceptions.ApiError as e:
             print('Error happen in FileNeedUpload', e)
-            files_need_to_upload = [n for n in local_files_list]
+
+        def uploaded_names():
+            names = set(n for n, entry in cache_entries.items() if entry['uploaded_hash'] in remote_file_hashs)
+            if history is not None:
+                names.update(history.uploaded_names(remote_file_hashs))
+            return names
+
+        # Revisions are fetched lazily: only for remote files that may hold an older upload of a pending local file
+        uploaded_original_names = uploaded_names()
+        pending_names = set(n for n in local_files_list if n not in uploaded_original_names)
+        candidates = set()
+        for n, entry in cache_entries.items():
+            if n in pending_names and entry['uploaded_id'] in remote_files_by_id:
+                candidates.add(remote_files_by_id[entry['uploaded_id']].path_display)
+        for n in pending_names if history is not None else []:
+            for row in history.by_name(n):
+                if row['new_name'] in remote_files_by_name:
+                    candidates.add(remote_files_by_name[row['new_name']].path_display)
+        if candidates:
+            print(f'Getting revisions of {len(candidates)} remote files...')
+            with phase('revisions'):
+                file_revisions = dropbox_list_revisions(candidates, workers=self.list_workers)
+            for file_path, revisions in file_revisions.items():
+                remote_file_hashs.update(r['hash'] for r in revisions)
+                if self.dedup is not None:
+                    self.dedup.add_revisions(file_path, revisions)
+            uploaded_original_names = uploaded_names()
+        files_need_to_upload = [n for n in local_files_list if n not in uploaded_original_names]
 
         new_file_names = []
         if self.monthly_mode:
@@ -145,31 +603,207 @@ class DropBoxUpload:
         # new_file_paths = list(map(lambda p: remote_folder_path + '/' + p, new_file_paths or file_paths))
 
         result = list((pair for pair in zip(file_paths, new_file_names or files_need_to_upload)))
+        if self.keep:  # backups Prune would remove right away are not uploaded
+            old = set(self.OldBackups([f.name for f in remote_files_list] + [new_name for _, new_name in result], self.keep))
+            if any(new_name in old for _, new_name in result):
+                print(f'{sum(new_name in old for _, new_name in result)} backups older than the {self.keep} kept on Dropbox are not uploaded')
+            result = [pair for pair in result if pair[1] not in old]
         return result
 
+    def SyncFolder(self, remote_folder_path, local_folder_path, manifest, zip_files=True, workers=1, stream=False, delete=False, scan_workers=8):
+        """
+            - Upload the new and changed files of the local tree, their relative paths kept under remote_folder_path
+            - changes are found against the manifest (SyncManifest): same size, mtime and inode => skipped unread,
+              stat changed but same content hash => only the manifest is refreshed
+            - delete: files gone from the local tree are deleted on Dropbox too, otherwise they are kept there
+              (and in the manifest, a later run with delete still removes them)
+            - Return (uploaded [(local_path, meta)], failed [local_path], deleted [remote_path])
+        """
+        with phase('scan'):
+            local_files, failed_dirs = scan_tree(local_folder_path, workers=scan_workers)
+        if '' in failed_dirs:
+            raise OSError(f'Cannot scan {local_folder_path}')
+        known = manifest.entries(local_folder_path, remote_folder_path)
+        print(f'{len(local_files)} local files, {len(known)} in the manifest of {local_folder_path} => {remote_folder_path}')
+
+        to_upload = []
+        hashes = {}
+        for rel_path, stat in sorted(local_files.items()):
+            entry = known.get(rel_path)
+            if entry is not None and (entry['size'], entry['mtime_ns'], entry['inode']) == stat:
+                continue
+            path = os.path.join(local_folder_path, rel_path)
+            try:
+                hashes[path] = self.FileHash(path)
+            except OSError as e:
+                print(f'Skip {path}: {e}')
+                continue
+            if entry is not None and entry['content_hash'] == hashes[path]:
+                manifest.touch(local_folder_path, remote_folder_path, rel_path, stat)
+                continue
+            to_upload.append((path, rel_path))
+        print(f'{len(to_upload)} new or changed files to upload')
+
+        uploaded = []
+        failed = []
+        stale = []
+        rel_paths = dict(to_upload)
+        with admission(sum(local_files[rel_path][0] for _, rel_path in to_upload), len(to_upload)):
+            results = self.UploadFiles(remote_folder_path, to_upload, zip_files=zip_files, workers=workers, stream=stream)
+        for path, meta in results:
+            if not isinstance(meta, dropbox.files.FileMetadata):
+                failed.append(path)
+                continue
+            rel_path = rel_paths[path]
+            manifest.put(local_folder_path, remote_folder_path, rel_path, local_files[rel_path], hashes[path], meta.path_display, meta.id)
+            uploaded.append((path, meta))
+            previous = known.get(rel_path)
+            if delete and previous and previous['remote_path'] and previous['remote_path'].lower() != meta.path_lower:
+                stale.append(previous['remote_path'])  # zipped before, not anymore (or the opposite)
+
+        gone = [rel_path for rel_path in known if rel_path not in local_files
+                and not any(rel_path.startswith(d + '/') for d in failed_dirs)]
+        if gone and not delete:
+            print(f'{len(gone)} files deleted locally are kept on Dropbox')
+            gone = []
+        # one batch for the stale copies and the files deleted locally
+        remote_paths = stale + [known[rel_path]['remote_path'] for rel_path in gone]
+        with phase('delete'):
+            results = delete_batch(self.dbx, remote_paths, retries=self.retries)
+        deleted = [p for p, result in zip(remote_paths, results) if isinstance(result, dropbox.files.Metadata)]
+        for remote_path, result in zip(remote_paths, results):
+            if not is_gone(result):
+                print(f'Error deleting {remote_path}: {result}')
+        manifest.remove(local_folder_path, remote_folder_path,
+                        [rel_path for rel_path, result in zip(gone, results[len(stale):]) if is_gone(result)])
+        if deleted:
+            print(f'{len(deleted)} files deleted on Dropbox')
+        return uploaded, failed, deleted
+
+    def Chunks(self, remote_folder_path):
+        """ ChunkStore of a remote folder (deduplicated storage, see chunk_store), kept warm for the run """
+        store = self._chunk_stores.get(remote_folder_path)
+        if store is None:
+            store = ChunkStore(self.dbx, get_clients().session, remote_folder_path,
+                               upload=lambda path, folder, name: self.UpLoadFile(folder, path, name),
+                               db_path=self.cache.db_path if self.cache is not None else ':memory:', level=self.zip_level,
+                               retries=self.retries, workers=max(4, self.parallel_chunks), timeout=self.timeout,
+                               work_dir=self.work_dir)
+            self._chunk_stores[remote_folder_path] = store
+        return store
+
+    def BackupChunks(self, remote_folder_path, local_folder_path):
+        """
+            - Store every file of local_folder_path in the chunk store of remote_folder_path, one manifest per
+              file name => every daily backup stays restorable by name, only its changed chunks are uploaded
+            - files whose manifest has the same size and mtime are skipped
+            - Return a list of (local_path, manifest or None when the backup failed)
+        """
+        store = self.Chunks(remote_folder_path)
+        manifests = store.manifests()
+        names = []
+        for name in sorted(next(walk(local_folder_path), [None, None, []])[2]):
+            path = f'{local_folder_path}/{name}'
+            if name in manifests:
+                manifest = store.manifest(name, manifests[name])
+                st = os.stat(path)
+                if (manifest['size'], manifest['mtime']) == (st.st_size, st.st_mtime):
+                    continue
+            names.append(name)
+        results = []
+        with admission(sum(os.path.getsize(f'{local_folder_path}/{name}') for name in names), len(names)):
+            for name in names:
+                path = f'{local_folder_path}/{name}'
+                print(path, '=>', f'{remote_folder_path}/.chunks', '=>', name)
+                try:
+                    results.append((path, store.backup(path, name)))
+                except Exception as e:
+                    print('Error happen', e)
+                    results.append((path, None))
+        return results
+
+    def RestoreChunks(self, remote_path, local_path, date=None):
+        """
+            - Rebuild a backup of a chunk store: remote_path is {folder}/{file name}, or the folder with a date
+              (the last backup whose name holds YYYYMMDD of that day)
+        """
+        if date is None:
+            remote_folder_path, name = remote_path.rsplit('/', 1)
+            return self.Chunks(remote_folder_path).restore(name, local_path)
+        day = date.strftime('%Y%m%d')
+        store = self.Chunks(remote_path)
+        names = sorted(n for n in store.manifests() if day in n)
+        if not names:
+            raise ValueError(f'No backup of {date} in {remote_path}')
+        return store.restore(names[-1], local_path)
+
+    def History(self, remote_folder_path):
+        """ HistoryStore of a remote folder, synced with Dropbox on first use then kept warm """
+        history = self._histories.get(remote_folder_path)
+        if history is None:
+            history = HistoryStore(self.dbx, remote_folder_path, self.history_dir, compact_every=self.compact_every)
+            with phase('history'):
+                history.load()
+            self._histories[remote_folder_path] = history
+        return history
+
+    @timed('history_update')
     def UpdateHistory(self, remote_folder_path, values):
         """
-            - values: list of dict(id, original_name, new_name)
+            - values: list of dict(id, original_name, new_name, hash, server_modified)
+            - appended as a small segment, history.csv is only rewritten on compaction
         """
-        # - Write to the csv file values
-        rows = []
         try:
             print('Update uploaded history...')
-            with open('./temp_history.csv', 'r') as csv_file:
-                rows = list(csv.DictReader(csv_file))
-            with open(f'./temp_history.csv', 'w') as csv_file:
-                field_names = ['id', 'original_name', 'new_name', 'hash', 'server_modified']
-                writer = csv.DictWriter(csv_file, fieldnames=field_names)
-                writer.writeheader()
-                writer.writerows(rows)
-                for row in values:
-                    writer.writerow(row)
-            meta = self.UpLoadFile(remote_folder_path, './temp_history.csv', 'history.csv')
-            return meta
+            return self.History(remote_folder_path).append(values)
         except Exception as e:
             print('Error happen in UpdateHistory', e)
             return False
 
+    def FindRevision(self, remote_file_path, date):
+        """
+            - Return the revision (FileMetadata) of remote_file_path holding the backup of date, None if not found
+            - monthly mode: the history row whose original_name carries that date => revision with the same hash
+            - otherwise: the last revision uploaded on or before that date
+        """
+        revisions = call_with_retry(self.dbx.files_list_revisions, remote_file_path, limit=100, retries=self.retries).entries
+        remote_folder_path, remote_name = remote_file_path.rsplit('/', 1)
+        try:
+            rows = self.History(remote_folder_path).rows
+        except dropbox.exceptions.ApiError as e:
+            print('Error happen in FindRevision', e)
+            rows = []
+        day = date.strftime('%Y%m%d')
+        hashes = [r['hash'] for r in rows if r['new_name'] == remote_name and day in r['original_name']]
+        for content_hash in reversed(hashes):
+            for revision in revisions:
+                if revision.content_hash == content_hash:
+                    return revision
+        before = [r for r in revisions if r.server_modified.date() <= date]
+        return max(before, key=lambda r: r.server_modified) if before else None
+
+    def Restore(self, remote_file_path, local_path, date=None, rev=None):
+        """
+            - Download remote_file_path (or its revision rev / of date) to local_path, a folder keeps the remote name
+            - streamed to a .part file, ranges fetched in parallel with parallel_chunks > 1, content hash verified
+        """
+        if rev is None and date is not None:
+            revision = self.FindRevision(remote_file_path, date)
+            if revision is None:
+                raise ValueError(f'No revision of {remote_file_path} for {date}')
+            print(f'{remote_file_path}: revision {revision.rev} uploaded {revision.server_modified}')
+            rev = revision.rev
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, basename(remote_file_path))
+        print(f'Restore {remote_file_path} => {local_path}')
+        with phase('download', local_path) as p:
+            meta = download_file(self.dbx, get_clients().session, f'rev:{rev}' if rev else remote_file_path, local_path,
+                                 parallel=self.parallel_chunks, range_size=self.chunk * 1024 * 1024, retries=self.retries,
+                                 timeout=self.timeout, show_pbar=self.show_pbar)
+            p.add(meta.size)
+        print(f'Restored {local_path}, content hash verified')
+        return meta
+
     def MonthlyFileName(self, original_filename):
         """ Return the file name for monthly mode based on the regex pattern"""
         if self.monthly_mode:
@@ -184,13 +818,36 @@ class DropBoxUpload:
             file_name = original_filename
         return file_name
 
-    def ZipFile(self, local_file_path, local_zip_path):
+    def ChooseCodec(self, local_file_path):
+        """
+            - Return (codec, level) of a local file, codec 'skip' => upload it as is, else zip it at level (0 = stored)
+            - without codec selector, or for a folder: always zip at zip_level
+        """
+        if self.codec is None or not os.path.isfile(local_file_path):
+            return 'deflate', self.zip_level
+        codec, level, ratio = self.codec.choose(local_file_path)
+        if ratio is not None:
+            print(f'{local_file_path}: estimated compression ratio {ratio:.2f} => {codec}')
+        return codec, level
+
+    def LearnCodec(self, local_file_path, zip_size, level):
+        """ Record the ratio of a deflated zip for the extension of its source file """
+        if self.codec is not None and level and os.path.isfile(local_file_path):
+            file_size = os.path.getsize(local_file_path)
+            if file_size >= self.codec.min_size:
+                self.codec.learn(local_file_path, zip_size / file_size)
+
+    @timed('zip', 'local_file_path')
+    def ZipFile(self, local_file_path, local_zip_path, level=None):
         """
             - Zipping file with integrated progress bar
             - Inspired: https://stackoverflow.com/questions/28522669/how-to-print-the-percentage-of-zipping-a-file-python/41664456#41664456
             - NOTE: types.MethodType and partial
             - Zip a folder
             - ref: https://stackoverflow.com/a/1855118
+            - local_zip_path can also be a writable file object (see ZipUpLoadFile)
+            - zip_workers > 1: block-parallel compression on a process pool (see parallel_zip)
+            - level: deflate level overriding zip_level, 0 => stored (see ChooseCodec)
         """
         def progress(total_size, original_write, self, buf):
             progress.bytes += len(buf)
@@ -213,15 +870,24 @@ class DropBoxUpload:
             return res
     
         total_size = os.path.getsize(local_file_path) if os.path.isfile(local_file_path) else dirsize(local_file_path)
-        progress.bar = tqdm(unit='G', unit_scale=True, unit_divisor=1024, total=total_size, disable=not self.show_pbar)
+        progress.bar = progress_bar(total_size, 'G', self.show_pbar)
         progress.bar.clear()
         progress.bytes = 0
         progress.obytes = 0
-        print(f'Zipping {local_zip_path} ... -- It may take time!')
+        print(f'Zipping {local_zip_path if isinstance(local_zip_path, str) else local_file_path} ... -- It may take time!')
 
-        if os.path.isfile(local_file_path):
+        level = self.zip_level if level is None else level
+        compression = ZIP_DEFLATED if level else ZIP_STORED
+        if self.zip_workers > 1 and level:
+            try:
+                parallel_zip(local_file_path, local_zip_path, level=level, workers=self.zip_workers, progress=progress.bar.update)
+                progress.bar.close()
+            except Exception as e:
+                print('Error happen while zipping in parallel', e)
+                raise e
+        elif os.path.isfile(local_file_path):
             try:
-                with ZipFile(local_zip_path, 'w', ZIP_DEFLATED, compresslevel=5) as _zip:
+                with ZipFile(local_zip_path, 'w', compression, compresslevel=level or None) as _zip:
                     _zip.fp.write = types.MethodType(partial(progress, total_size, _zip.fp.write), _zip.fp)
                     _zip.write(local_file_path, arcname=basename(local_file_path))  # do NOT keep the absolute directory
                 progress.bar.close()
@@ -230,7 +896,7 @@ class DropBoxUpload:
                 raise e
         else:
             try:
-                with ZipFile(local_zip_path, 'w', ZIP_DEFLATED, compresslevel=5) as _zip:
+                with ZipFile(local_zip_path, 'w', compression, compresslevel=level or None) as _zip:
                     _zip.fp.write = types.MethodType(partial(progress, total_size, _zip.fp.write), _zip.fp)
                     zipdir(local_file_path, _zip)
                 progress.bar.close()
@@ -242,16 +908,27 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('upload_path', type=str, help='path in dropbox, empty if root folder')
     parser.add_argument('file_path', type=str, help='path to file to upload, in monthly_mode this is the folder name')
-    parser.add_argument('--mode', type=str, default='', help='Upload mode: default, folder or monthly')
+    parser.add_argument('--mode', type=str, default='', help='Upload mode: default, folder, monthly or sync (whole tree, new and changed files only); restore downloads upload_path to file_path')
     parser.add_argument('--re', type=str, default='', help='regex for daily backup file to extract filename and datetime')  # only need in customize case
 
     # parser.add_argument('--zip', action=argparse.BooleanOptionalAction, help='Zip the file or not')  # Only for python 3.9+
     parser.add_argument('--zip', action='store_true')
     parser.add_argument('--no-zip', dest='zip', action='store_false')
     parser.set_defaults(zip=True)
+    parser.add_argument('--zip-level', type=int, default=5, help='deflate level 0-9')
+    parser.add_argument('--zip-workers', type=int, default=1, help='processes compressing in parallel, 0 = number of cores')
+    parser.add_argument('--codec', type=str, default='deflate', choices=['deflate', 'auto'], help='auto: sample each file and store, skip, fast or high deflate it')
+    parser.add_argument('--stream', action='store_true', help='zip straight into the upload session, no temp zip on disk')
 
     parser.add_argument('--timeout', type=int, default=900)
-    parser.add_argument('--chunk', type=int, default=8, help='chunk size in MB')
+    parser.add_argument('--chunk', type=str, default='8', help='chunk size in MB, or auto to tune it from the measured throughput')
+    parser.add_argument('--bwlimit', type=str, default='', help='upload rate limit for the whole process, e.g. 2M (bytes/s)')
+    parser.add_argument('--bwschedule', type=str, default='', help='time-of-day limits overriding --bwlimit, e.g. 08:00-18:00=1M,18:00-08:00=0')
+    parser.add_argument('--parallel-chunks', type=int, default=1, help='chunks of one big file appended at once (concurrent upload session), byte ranges fetched at once in restore mode')
+    parser.add_argument('--date', type=str, default='', help='restore mode: revision holding the backup of this day, YYYY-MM-DD')
+    parser.add_argument('--rev', type=str, default='', help='restore mode: revision id to download')
+    parser.add_argument('--workers', type=int, default=1, help='number of files zipped and uploaded at once (folder and monthly modes)')
+    parser.add_argument('--buffers', type=int, default=0, help='chunk buffers shared by all uploads (peak memory ~ buffers x chunk), 0 = enough for workers and parallel chunks')
 
     # parser.add_argument('--pbar', action=argparse.BooleanOptionalAction, help='showing progress bar')  # Only for python 3.9+
     parser.add_argument('--pbar', action='store_true')
@@ -262,22 +939,287 @@ def main():
     parser.add_argument('--delete', action='store_true')
     parser.add_argument('--no-delete', dest='delete', action='store_false')
     parser.set_defaults(delete=False)
+
+    # Local hash/upload cache (sqlite)
+    parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_PATH, help='path to the local hash/upload cache')
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const='')
+    parser.add_argument('--cache-size', type=int, default=10000, help='max number of entries kept in the cache')
+    parser.add_argument('--invalidate-cache', action='store_true', help='drop every cache entry before running')
+    parser.add_argument('--history-dir', type=str, default=DEFAULT_HISTORY_DIR, help='local mirror of the upload history')
+    parser.add_argument('--compact-every', type=int, default=50, help='merge history segments into history.csv once there are this many')
+    parser.add_argument('--token-cache', type=str, default=DEFAULT_TOKEN_CACHE_PATH, help='file caching the short-lived access token')
+    parser.add_argument('--no-token-cache', dest='token_cache', action='store_const', const='')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help='do not checkpoint upload sessions to resume them on the next run')
+    parser.set_defaults(resume=True)
+    parser.add_argument('--retries', type=int, default=5, help='retries of transient errors per API call')
+    parser.add_argument('--dedup', action='store_true', help='skip content already on Dropbox, server-side copy content found at another path (folder and monthly modes)')
+    parser.add_argument('--no-remote-state', dest='remote_state', action='store_false', help='list the remote folder in full instead of using the stored cursor')
+    parser.set_defaults(remote_state=True)
+    parser.add_argument('--metrics-json', type=str, default='', help='write a JSON report of the run (time, bytes, API calls per phase and file)')
+    parser.add_argument('--metrics-prom', type=str, default='', help='write the run metrics for the Prometheus textfile collector (*.prom)')
+    parser.add_argument('--storage', type=str, default='file', choices=['file', 'chunks'], help='chunks (folder/monthly modes, restore): deduplicated content-defined chunks, one manifest per backup')
+    parser.add_argument('--gc', action='store_true', help='chunks storage: delete the packs no manifest uses anymore after the backup')
+    parser.add_argument('--keep-days', type=int, default=None, help='chunks storage with --gc: first delete the manifests older than this')
+    parser.add_argument('--keep', type=int, default=0, help='retention (folder and monthly modes): keep the newest KEEP dated backups of each name on Dropbox, older ones are deleted in batch (0 = keep all)')
+    parser.add_argument('--archive-path', type=str, default='', help='with --keep: move the older backups to this Dropbox folder instead of deleting them')
+    parser.add_argument('--propagate-deletes', action='store_true', help='sync mode: delete on Dropbox the files deleted from the local tree')
+    parser.add_argument('--scan-workers', type=int, default=8, help='sync mode: directories scanned at once')
+    parser.add_argument('--watch', action='store_true', help='daemon: keep watching file_path and upload every backup once it is completely written (folder and monthly modes)')
+    parser.add_argument('--settle', type=int, default=30, help='watch mode: seconds a closed file must stay unchanged before its upload')
+    parser.add_argument('--poll-interval', type=int, default=10, help='watch mode: seconds between folder rescans (network shares, no inotify)')
+    parser.add_argument('--metrics-job', type=str, default='', help='job label of the metrics, default: upload_path')
+    parser.add_argument('--scheduler', type=str, default=DEFAULT_SCHEDULER_DIR, help='absolute path of the folder shared by the runs of this host: job queue, locks and work folders (default: dbu_jobs in the system temp folder)')
+    parser.add_argument('--no-scheduler', dest='scheduler', action='store_const', const='')
+    parser.add_argument('--max-workers', type=int, default=8, help='scheduler: threads of all the running jobs (--workers x the larger of --parallel-chunks and --zip-workers), a job waits until its threads fit, a bigger job is scaled down (0 = no limit)')
+    parser.add_argument('--total-bwlimit', type=str, default='', help='scheduler: upload rate shared evenly by the running jobs, e.g. 10M (bytes/s)')
+    parser.add_argument('--deadline', type=str, default='', help='scheduler: HH:MM the job should start by, jobs with a deadline go first (earliest first), then the smallest')
+    parser.add_argument('--max-wait', type=int, default=3600, help='scheduler: seconds in the queue after which a job goes before the smaller ones')
     
     args = parser.parse_args()
+    if args.scheduler and not os.path.isabs(args.scheduler):
+        parser.error(f'--scheduler {args.scheduler}: use an absolute path, every run of the host must share it')
+    if not (args.metrics_json or args.metrics_prom):
+        return run(args)
+    metrics = Metrics(job=args.metrics_job or args.upload_path)
+    set_metrics(metrics)
+    success = False
+    try:
+        result = run(args)
+        success = True
+        return result
+    finally:
+        set_metrics(None)
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json, success)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom, success)
+
+
+def upload_and_record(dbu, args, cache, file_paths):
+    """ Upload file_paths (folder and monthly modes), then record them in the cache and the history, return [(path, meta)] """
+    update_history_rows = []
+    with admission(sum(os.path.getsize(path) for path, _ in file_paths if os.path.exists(path)), len(file_paths)):
+        results = dbu.UploadFiles(args.upload_path, file_paths, zip_files=args.zip, workers=args.workers, stream=args.stream)
+    for path, meta in results:
+        count('files_uploaded' if isinstance(meta, dropbox.files.FileMetadata) else 'files_failed')
+        if isinstance(meta, dropbox.files.FileMetadata):
+            update_history_rows.append({
+                'id': meta.id, 'original_name': path.split('/')[-1], 
+                'new_name': meta.name, 
+                # 'hash': dbu.FileHash('./temp.zip'), 
+                'hash': meta.content_hash,
+                'server_modified': meta.server_modified})
+            if cache is not None:
+                cache.put_upload(path, meta)
+            if args.delete:
+                # TODO []: can delete local uploaded file here
+                os.remove(path)
+                if cache is not None:
+                    cache.invalidate(path)
+                print('Remove uploaded local file: {}'.format(path))
+        else:
+            print('Upload not successfully.')
+
+    if update_history_rows:
+        history_meta = dbu.UpdateHistory(args.upload_path, update_history_rows)
+        if isinstance(history_meta, dropbox.files.FileMetadata):
+            print('History updated successfully!')
+        else:
+            print('Update history file not successfully!')
+
+    if dbu.dedup is not None:
+        print(dbu.dedup.report())
+    return results
+
+
+def watch_folder(dbu, args, cache):
+    """ Daemon: upload the files of args.file_path as soon as they are completely written, until SIGTERM/Ctrl-C
+        - dbu (its clients, history and remote state) and the caches stay warm from one file to the next
+        - files whose upload failed go back to the watcher and are retried with a backoff
+        - with the remote state, a thread long-polls the remote folder: a change there (e.g. a backup deleted
+          on Dropbox) makes the watcher report every local file again, FileNeedUpload sends what is missing
+    """
+    watcher = Watcher(args.file_path, settle=args.settle, poll_interval=args.poll_interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    print(f'Watching {args.file_path} ({watcher.method}), files settled for {args.settle}s => {args.upload_path} on Dropbox')
+    if dbu.remote_state is not None:
+        threading.Thread(target=watch_remote, args=(dbu, args.upload_path, watcher), daemon=True).start()
+    try:
+        for ready in watcher.batches():
+            ready_names = set(basename(p) for p in ready)
+            failed = ready
+            try:
+                file_paths = [pair for pair in dbu.FileNeedUpload(args.upload_path, args.file_path) if basename(pair[0]) in ready_names]
+                failed = [path for path, _ in file_paths]
+                if file_paths:
+                    results = upload_and_record(dbu, args, cache, file_paths)
+                    failed = [path for path, meta in results if not isinstance(meta, dropbox.files.FileMetadata)]
+                    if args.keep:
+                        dbu.Prune(args.upload_path, archive_path=args.archive_path or None)
+            except Exception as e:
+                print(f'Error while uploading {sorted(ready_names)}: {e}')  # keep watching, the next batch may work
+            failed_names = set(basename(p) for p in failed)
+            watcher.done([p for p in ready if basename(p) not in failed_names])
+            watcher.retry(failed)
+            metrics = get_metrics()
+            if metrics is not None:
+                if args.metrics_json:
+                    metrics.write_json(args.metrics_json)
+                if args.metrics_prom:
+                    metrics.write_prometheus(args.metrics_prom)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    print('Stopped watching', args.file_path)
+
+
+def watch_remote(dbu, upload_path, watcher, timeout=480):
+    """ Long-poll upload_path with the stored cursor until the watcher stops, a change triggers watcher.recheck()
+        - own client of this thread, its timeout covers the long-poll (plus up to 90s of jitter added by Dropbox)
+    """
+    while not watcher.stopped:
+        cursor = dbu.remote_state.cursor(upload_path)
+        try:
+            dbx = get_clients().client(timeout=timeout + 120)
+            changed = cursor is not None and dbu.remote_state.wait(dbx, upload_path, timeout=timeout, cursor=cursor)
+        except Exception as e:
+            print(f'Error while long-polling {upload_path}: {e}')
+            changed = False
+            watcher.sleep(watcher.poll_interval)
+        if changed and not watcher.stopped:
+            print(f'{upload_path} changed on Dropbox => check all local files')
+            watcher.recheck()
+        # the cursor moves with the next sync (FileNeedUpload), polling the old one would return at once
+        while not watcher.stopped and dbu.remote_state.cursor(upload_path) == cursor:
+            watcher.sleep(watcher.poll_interval)
+
+
+def job_threads(args):
+    """ Threads of a run: each of its workers zips with zip_workers processes or sends parallel_chunks chunks at once """
+    zip_workers = (args.zip_workers or os.cpu_count() or 1) if args.zip else 1
+    return args.workers * max(1, args.parallel_chunks, zip_workers)
+
+
+def fit_threads(args, threads):
+    """ Scale args.workers, then parallel_chunks and zip_workers, down to the threads granted by the scheduler """
+    if job_threads(args) <= threads:
+        return
+    per_worker = job_threads(args) // args.workers
+    args.workers = max(1, min(args.workers, threads // per_worker))
+    per_worker = max(1, threads // args.workers)
+    args.parallel_chunks = min(args.parallel_chunks, per_worker)
+    args.zip_workers = min(args.zip_workers or os.cpu_count() or 1, per_worker)
+    print(f'Scheduler grants {threads} threads => --workers {args.workers} --parallel-chunks {args.parallel_chunks} --zip-workers {args.zip_workers}')
+
+
+def run(args):
+    """ Body of main() once the arguments are parsed: uploads run as a job of the host scheduler (see scheduler) """
+    if not args.scheduler or args.mode == 'restore':
+        return run_job(args)
+    scheduler = Scheduler(args.scheduler, max_workers=args.max_workers, total_rate=parse_rate(args.total_bwlimit), max_wait=args.max_wait)
+    try:
+        job = scheduler.submit(job_key(args.mode, args.file_path, args.upload_path), workers=job_threads(args),
+                               deadline=parse_deadline(args.deadline))
+    except JobRunning as e:
+        print(f'{e} => skip this run')
+        return None
+    fit_threads(args, job.workers)
+    set_job(job)
+    try:
+        return run_job(args, job)
+    finally:
+        set_job(None)
+        job.close()
+
+
+def run_job(args, job=None):
+    """ One run, job: its scheduler Job (work folder, bandwidth share) or None """
+    work_dir = job.work_dir if job is not None else '.'
+    temp_zip_path = os.path.join(work_dir, 'temp.zip')
+    auto_chunk = args.chunk == 'auto'
+    zip_workers = args.zip_workers or os.cpu_count() or 1
+    args.chunk = 8 if auto_chunk else int(args.chunk)
+    set_buffer_pool(BufferPool(args.buffers or args.workers * (4 if args.stream else max(1, args.parallel_chunks))))
+    if args.bwlimit or args.bwschedule or args.total_bwlimit and job is not None:
+        set_limiter(TokenBucket(parse_rate(args.bwlimit), parse_schedule(args.bwschedule), share=job.rate_share if job is not None else None))
+
+    instrument_session(get_clients(token_cache_path=args.token_cache).session)
+    cache = None
+    remote_state = None
+    journal = None
+    codec = None
+    if args.cache:
+        cache = HashCache(args.cache, max_entries=args.cache_size)
+        if args.codec == 'auto':
+            codec = CodecSelector(CodecStats(args.cache), default_level=args.zip_level)
+        if args.resume:
+            journal = UploadJournal(args.cache)
+        if args.remote_state:
+            remote_state = RemoteState(args.cache)
+        if args.invalidate_cache:
+            cache.invalidate()
+            if remote_state is not None:
+                remote_state.invalidate()
+    elif args.codec == 'auto':
+        codec = CodecSelector(default_level=args.zip_level)
+
+    if args.mode == 'restore':
+        dbu = DropBoxUpload(timeout=args.timeout, chunk=args.chunk, show_pbar=args.pbar, cache=cache, parallel_chunks=args.parallel_chunks, retries=args.retries)
+        date = datetime.strptime(args.date.replace('-', ''), '%Y%m%d').date() if args.date else None
+        try:
+            if args.storage == 'chunks':
+                return dbu.RestoreChunks(args.upload_path, args.file_path, date=date)
+            return dbu.Restore(args.upload_path, args.file_path, date=date, rev=args.rev or None)
+        except Exception as e:
+            print('Error happen', e)
+            raise e
+
+    if args.mode == 'sync':
+        if not args.cache:
+            print('Sync mode keeps its manifest in the cache file, it cannot run with --no-cache')
+            return None
+        dbu = DropBoxUpload(timeout=args.timeout, chunk=args.chunk, show_pbar=args.pbar, cache=cache, parallel_chunks=args.parallel_chunks, journal=journal, retries=args.retries, dedup=Deduplicator() if args.dedup else None, auto_chunk=auto_chunk, zip_level=args.zip_level, zip_workers=zip_workers, codec=codec, work_dir=work_dir)
+        manifest = SyncManifest(args.cache)
+        if args.invalidate_cache:
+            manifest.invalidate(args.file_path, args.upload_path)
+        uploaded, failed, deleted = dbu.SyncFolder(args.upload_path, args.file_path, manifest, zip_files=args.zip, workers=args.workers, stream=args.stream, delete=args.propagate_deletes, scan_workers=args.scan_workers)
+        for path, meta in uploaded:
+            cache.put_upload(path, meta)
+        count('files_uploaded', len(uploaded))
+        count('files_failed', len(failed))
+        count('files_deleted', len(deleted))
+        print(f'Sync done: {len(uploaded)} uploaded, {len(failed)} failed, {len(deleted)} deleted on Dropbox')
+        if dbu.dedup is not None:
+            print(dbu.dedup.report())
+        return uploaded
 
     if args.mode in  ['folder', 'monthly']:
-        dbu = DropBoxUpload(timeout=args.timeout, chunk=args.chunk, monthly_mode=True if args.mode == 'monthly' else False, show_pbar=args.pbar)
+        dbu = DropBoxUpload(timeout=args.timeout, chunk=args.chunk, monthly_mode=True if args.mode == 'monthly' else False, show_pbar=args.pbar, cache=cache, parallel_chunks=args.parallel_chunks, remote_state=remote_state, history_dir=args.history_dir, compact_every=args.compact_every, journal=journal, retries=args.retries, dedup=Deduplicator() if args.dedup else None, auto_chunk=auto_chunk, zip_level=args.zip_level, zip_workers=zip_workers, codec=codec, keep=args.keep, work_dir=work_dir)
         # TODO [X]: Handle zip and upload for folder
         # TODO [X]: Handle delete on success
         delete_on_success = args.delete
+        if args.storage == 'chunks':
+            results = dbu.BackupChunks(args.upload_path, args.file_path)
+            for path, manifest in results:
+                count('files_uploaded' if manifest is not None else 'files_failed')
+                if manifest is not None and delete_on_success:
+                    os.remove(path)
+                    print('Remove uploaded local file: {}'.format(path))
+            if args.gc:
+                dbu.Chunks(args.upload_path).gc(keep_days=args.keep_days)
+            return results
         if args.mode == 'folder' and args.zip and os.path.isdir(args.file_path):
             dir_name = os.path.basename(args.file_path)
             print(dir_name, '=>', args.upload_path, 'on Dropbox', '=>', dir_name + '.zip')
             try:
-                dbu.ZipFile(args.file_path, './temp.zip')
-                meta = dbu.UpLoadFile(args.upload_path, './temp.zip', dir_name +'.zip')
+                with admission(sum(stat[0] for stat in scan_tree(args.file_path, ignore=[])[0].values())):
+                    if args.stream:
+                        return dbu.ZipUpLoadFile(args.upload_path, args.file_path, dir_name + '.zip')
+                    dbu.ZipFile(args.file_path, temp_zip_path)
+                    meta = dbu.UpLoadFile(args.upload_path, temp_zip_path, dir_name +'.zip')
                 if isinstance(meta, dropbox.files.FileMetadata):
-                    os.remove('./temp.zip')
+                    os.remove(temp_zip_path)
                     if delete_on_success:
                         pass
                 return meta
@@ -285,63 +1227,35 @@ def main():
                 print(f'Error while zipping and sending the zip file to Dropbox {e}')
                 raise e
         
-        file_paths = dbu.FileNeedUpload(args.upload_path, args.file_path)
-        update_history_rows = []
-        for path, new_name in file_paths:
-            print(path, '=>', path, 'on Dropbox', '=>', new_name)
-            if args.zip:
+        if args.watch:
+            return watch_folder(dbu, args, cache)
+        upload_and_record(dbu, args, cache, dbu.FileNeedUpload(args.upload_path, args.file_path))
+        if args.keep:
+            dbu.Prune(args.upload_path, archive_path=args.archive_path or None)
+
+    else:
+        dbu = DropBoxUpload(timeout=args.timeout, chunk=args.chunk, cache=cache, parallel_chunks=args.parallel_chunks, journal=journal, retries=args.retries, auto_chunk=auto_chunk, zip_level=args.zip_level, zip_workers=zip_workers, codec=codec, work_dir=work_dir)
+        meta = None
+        with admission(os.path.getsize(args.file_path)):
+            codec, level = dbu.ChooseCodec(args.file_path) if args.zip else ('skip', None)
+            if codec != 'skip' and args.stream:
                 try:
-                    dbu.ZipFile(path, './temp.zip')
-                    meta = dbu.UpLoadFile(args.upload_path, './temp.zip', new_name + '.zip')
-                    if isinstance(meta, dropbox.files.FileMetadata):
-                        os.remove('./temp.zip')
+                    meta = dbu.ZipUpLoadFile(args.upload_path, args.file_path, args.file_path.split('/')[-1] + '.zip', level=level)
+                except Exception as e:
+                    print('Error happen', e)
+            elif codec != 'skip':
+                try:
+                    dbu.ZipFile(args.file_path, temp_zip_path, level=level)
+                    dbu.LearnCodec(args.file_path, os.path.getsize(temp_zip_path), level)
+                    meta = dbu.UpLoadFile(args.upload_path, temp_zip_path, args.file_path.split('/')[-1] + '.zip')
+                    if isinstance(meta, dropbox.files.FileMetatdata):
+                        os.remove(temp_zip_path)
+                        if delete_on_success:
+                            os.remove(args.upload_path)
                 except Exception as e:
                     print('Error happen', e)
             else:
-                meta = dbu.UpLoadFile(args.upload_path, path, new_name)
-
-            if isinstance(meta, dropbox.files.FileMetadata):
-                update_history_rows.append({
-                    'id': meta.id, 'original_name': path.split('/')[-1], 
-                    'new_name': meta.name, 
-                    # 'hash': dbu.FileHash('./temp.zip'), 
-                    'hash': meta.content_hash,
-                    'server_modified': meta.server_modified})
-                if delete_on_success:
-                    # TODO []: can delete local uploaded file here
-                    os.remove(path)
-                    print('Remove uploaded local file: {}'.format(path))
-            else:
-                print('Upload not successfully.')
-
-        if update_history_rows:
-            history_meta = dbu.UpdateHistory(args.upload_path, update_history_rows)
-            if isinstance(history_meta, dropbox.files.FileMetadata):
-                print('History updated successfully!')
-            else:
-                print('Update history file not successfully!')
-
-        try:
-            os.remove('./temp_history.csv')
-            print('Cleanup done!')
-        except FileNotFoundError:
-            print('File not found', FileNotFoundError)
-
-    else:
-        dbu = DropBoxUpload(timeout=args.timeout, chunk=args.chunk)
-        meta = None
-        if args.zip:
-            try:
-                dbu.ZipFile(args.file_path, './temp.zip')
-                meta = dbu.UpLoadFile(args.upload_path, './temp.zip', args.file_path.split('/')[-1] + '.zip')
-                if isinstance(meta, dropbox.files.FileMetatdata):
-                    os.remove('./temp.zip')
-                    if delete_on_success:
-                        os.remove(args.upload_path)
-            except Exception as e:
-                print('Error happen', e)
-        else:
-            meta = dbu.UpLoadFile(args.upload_path, args.file_path)
+                meta = dbu.UpLoadFile(args.upload_path, args.file_path)
         if isinstance(meta, dropbox.files.FileMetadata):
             print('Successfully uploaded!')
         else:
@@ -0,0 +1,78 @@
+""" Content-hash deduplication before upload
+    - index of the remote content hashes already known in a run (current files and fetched revisions)
+    - same content already at the destination (or in one of its revisions) => skip the upload
+    - same content at another remote path => server-side copy (files_copy_v2) instead of an upload
+    - zipped uploads: two zips of the same file are never byte identical (arcname, mtime), the content hash of
+      the local file is mapped to the hashes of its uploaded zips and looked up before zipping
+    - counts the bytes that did not have to be sent
+"""
+
+import threading
+
+
+class Deduplicator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_hash = {}  # content_hash => path_display of a current remote file
+        self._paths = set()  # path_lower of the current remote files
+        self._revisions = {}  # content_hash => {path_lower: revision FileMetadata}
+        self._payloads = {}  # content_hash of a local file => {content_hash of an uploaded zip of it}
+        self.skipped = 0
+        self.copied = 0
+        self.bytes_saved = 0
+
+    def add_remote_files(self, files_list):
+        """ files_list: RemoteFile records as returned by dropbox_list_files / RemoteState.sync """
+        with self._lock:
+            for f in files_list:
+                self._by_hash.setdefault(f.hash, f.path_display)
+                self._paths.add(f.path_display.lower())
+
+    def add_revisions(self, file_path, revisions):
+        """ revisions: dicts as returned by dropbox_list_revisions """
+        with self._lock:
+            for r in revisions:
+                self._revisions.setdefault(r['hash'], {})[file_path.lower()] = r['metadata']
+
+    def record(self, meta):
+        """ Remember an uploaded FileMetadata, later files with the same content are copied from it """
+        with self._lock:
+            self._by_hash.setdefault(meta.content_hash, meta.path_display)
+            self._paths.add(meta.path_lower)
+
+    def record_payload(self, source_hash, payload_hash):
+        """ Remember that a zip with payload_hash was uploaded for the local content source_hash """
+        with self._lock:
+            self._payloads.setdefault(source_hash, set()).add(payload_hash)
+
+    def payloads(self, source_hash):
+        with self._lock:
+            return set(self._payloads.get(source_hash, ()))
+
+    def check(self, content_hash, dest_path):
+        """ Return ('skip', metadata_or_path), ('copy', source_path) or (None, None) """
+        dest_lower = dest_path.lower()
+        with self._lock:
+            revision = self._revisions.get(content_hash, {}).get(dest_lower)
+            if revision is not None:
+                return 'skip', revision
+            source = self._by_hash.get(content_hash)
+            if source is None:
+                return None, None
+            if source.lower() == dest_lower:
+                return 'skip', source
+            if dest_lower not in self._paths:  # files_copy_v2 cannot overwrite
+                return 'copy', source
+        return None, None
+
+    def saved(self, action, size):
+        with self._lock:
+            if action == 'skip':
+                self.skipped += 1
+            else:
+                self.copied += 1
+            self.bytes_saved += size
+
+    def report(self):
+        return 'Dedup: {} skipped, {} copied server-side, {:.2f} MB not uploaded'.format(
+            self.skipped, self.copied, self.bytes_saved / 1024 / 1024)
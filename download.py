@@ -0,0 +1,102 @@
+""" Streaming, parallel and hash-verified download
+    - the body is written to a .part file as it arrives, memory stays at one chunk per stream
+    - big files: byte ranges of a temporary link are fetched concurrently (Range requests on the
+      shared keep-alive session) and written in place with pwrite
+    - ranges are 4 MB aligned so the block digests of the Dropbox content hash are computed in-flight,
+      the .part file only replaces the destination when the hash matches
+"""
+
+import os, time, calendar, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from parallel_hasher import BLOCK_SIZE, combine_block_digests
+from retry import call_with_retry, ShortRead
+from progress import progress_bar
+
+STREAM_CHUNK = 1024 * 1024
+
+
+def _ranges(file_size, parallel, range_size):
+    """ [(offset, length)] covering the file, block aligned, about 4 ranges per worker for load balance """
+    if parallel <= 1:
+        return [(0, file_size)] if file_size else []
+    per_worker = -(-file_size // (parallel * 4))
+    range_size = -(-max(range_size, per_worker) // BLOCK_SIZE) * BLOCK_SIZE  # a block never spans two ranges
+    return [(offset, min(range_size, file_size - offset)) for offset in range(0, file_size, range_size)]
+
+
+def _fetch_range(session, link, fd, offset, length, pbar, timeout):
+    """ GET link[offset:offset + length] into fd at offset, return the digests of its 4 MB blocks
+        - a failed attempt takes its bytes back from the progress bar, the retry counts them again
+        - a body shorter than the range raises ShortRead (transient, see retry.is_transient)
+    """
+    headers = {'Range': 'bytes={}-{}'.format(offset, offset + length - 1)}
+    position = offset
+    try:
+        with session.get(link, headers=headers, stream=True, timeout=timeout) as res:
+            res.raise_for_status()
+            if res.status_code != 206 and (offset, length) != (0, int(res.headers.get('Content-Length', length))):
+                raise ValueError('Range request ignored by the server')
+            digests = []
+            block = hashlib.sha256()
+            filled = 0
+            for data in res.iter_content(STREAM_CHUNK):
+                view = memoryview(data)
+                while view:
+                    part = view[:BLOCK_SIZE - filled]
+                    block.update(part)
+                    filled += len(part)
+                    view = view[len(part):]
+                    if filled == BLOCK_SIZE:
+                        digests.append(block.digest())
+                        block = hashlib.sha256()
+                        filled = 0
+                os.pwrite(fd, data, position)
+                position += len(data)
+                pbar.update(len(data))
+            if position != offset + length:
+                raise ShortRead('Range {}-{} truncated at {}'.format(offset, offset + length - 1, position))
+            if filled:
+                digests.append(block.digest())
+            return digests
+    except Exception:
+        pbar.update(offset - position)
+        raise
+
+
+def download_file(dbx, session, path, local_file_path, parallel=1, range_size=8 * 1024 * 1024, retries=5,
+                  timeout=100, show_pbar=True):
+    """ Download path (a path, id: or rev:) to local_file_path, return the FileMetadata
+        - parallel > 1: ranges fetched at once, a failed range is retried alone (5xx/429, dropped connection, short body)
+        - raise ValueError when the content hash does not match, the destination is then left untouched
+    """
+    meta = call_with_retry(dbx.files_get_metadata, path, retries=retries)
+    link = call_with_retry(dbx.files_get_temporary_link, path, retries=retries).link
+    part_path = local_file_path + '.part'
+    pbar = progress_bar(meta.size, 'M', show_pbar)
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, meta.size)
+        ranges = _ranges(meta.size, parallel, range_size)
+
+        def fetch(r):
+            return call_with_retry(_fetch_range, session, link, fd, r[0], r[1], pbar, timeout, retries=retries)
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            digests = [d for range_digests in executor.map(fetch, ranges) for d in range_digests]
+        os.fsync(fd)
+    except Exception:
+        os.close(fd)
+        os.remove(part_path)
+        raise
+    finally:
+        pbar.close()
+    os.close(fd)
+    local_hash = combine_block_digests(digests)
+    if local_hash != meta.content_hash:
+        os.remove(part_path)
+        raise ValueError(f'Content hash mismatch for {path}: local {local_hash}, Dropbox {meta.content_hash}')
+    os.replace(part_path, local_file_path)
+    mtime = calendar.timegm(meta.client_modified.utctimetuple())  # naive UTC datetime
+    os.utime(local_file_path, (time.time(), mtime))
+    return meta
@@ -0,0 +1,103 @@
+""" Shared Dropbox clients
+    - one keep-alive requests session (connection pool) for the whole process
+    - one dropbox.Dropbox per thread (and timeout), all built on that session
+    - the short-lived access token is cached on disk until it expires, so cron runs
+      within its lifetime skip the OAuth refresh round-trip
+"""
+
+import os, json, time, calendar, threading
+from datetime import datetime
+
+import dropbox
+
+DEFAULT_TOKEN_CACHE_PATH = './.dbu_token.json'
+DEFAULT_TIMEOUT = 100
+TOKEN_MARGIN = 300  # seconds, refresh before the token really expires
+
+
+class DropboxClients:
+    def __init__(self, app_key, app_secret, refresh_token, token_cache_path=DEFAULT_TOKEN_CACHE_PATH, max_connections=16):
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.refresh_token = refresh_token
+        self.token_cache_path = token_cache_path
+        self.session = dropbox.create_session(max_connections=max_connections)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._access_token = None
+        self._expires_at = 0
+
+    def _load_token(self):
+        if not self.token_cache_path or not os.path.exists(self.token_cache_path):
+            return
+        try:
+            with open(self.token_cache_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get('app_key') == self.app_key and cached.get('expires_at', 0) - TOKEN_MARGIN > time.time():
+            self._access_token = cached['access_token']
+            self._expires_at = cached['expires_at']
+
+    def _save_token(self):
+        if not self.token_cache_path:
+            return
+        temp_path = self.token_cache_path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'app_key': self.app_key, 'access_token': self._access_token, 'expires_at': self._expires_at}, f)
+        os.replace(temp_path, self.token_cache_path)
+
+    def access_token(self):
+        """ Return a valid access token: from memory, from the disk cache, or refreshed (then cached) """
+        with self._lock:
+            if self._expires_at - TOKEN_MARGIN > time.time():
+                return self._access_token
+            self._load_token()
+            if self._expires_at - TOKEN_MARGIN > time.time():
+                return self._access_token
+            dbx = dropbox.Dropbox(app_key=self.app_key, app_secret=self.app_secret,
+                                  oauth2_refresh_token=self.refresh_token, session=self.session)
+            dbx.refresh_access_token()
+            self._access_token = dbx._oauth2_access_token
+            # the SDK keeps the expiration as a naive UTC datetime
+            self._expires_at = calendar.timegm(dbx._oauth2_access_token_expiration.utctimetuple())
+            self._save_token()
+            return self._access_token
+
+    def client(self, timeout=DEFAULT_TIMEOUT):
+        """ Dropbox client of the current thread, rebuilt when the shared access token was refreshed """
+        access_token = self.access_token()
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        dbx = clients.get(timeout)
+        if dbx is None or dbx._oauth2_access_token != access_token:
+            dbx = clients[timeout] = dropbox.Dropbox(
+                oauth2_access_token=access_token, oauth2_access_token_expiration=datetime.utcfromtimestamp(self._expires_at),
+                oauth2_refresh_token=self.refresh_token, app_key=self.app_key, app_secret=self.app_secret,
+                session=self.session, timeout=timeout)
+        return dbx
+
+    def invalidate_token(self):
+        """ Forget the cached access token (e.g. after an AuthError) """
+        with self._lock:
+            self._access_token = None
+            self._expires_at = 0
+            if self.token_cache_path and os.path.exists(self.token_cache_path):
+                os.remove(self.token_cache_path)
+
+
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def get_clients(env_path='./.env_dropbox', token_cache_path=DEFAULT_TOKEN_CACHE_PATH):
+    """ Process wide DropboxClients built from the app keys in env_path, read on the first call only """
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            from dotenv import dotenv_values
+            keys = dotenv_values(env_path)
+            _clients = DropboxClients(keys['APP_KEY'], keys['APP_SECRET'], keys['REFRESH_TOKEN'], token_cache_path)
+        return _clients
@@ -0,0 +1,116 @@
+""" Local hash/stat cache
+    - sqlite file keyed on path and validated with size, mtime_ns and inode
+    - stores the Dropbox content hash of the local file and the last upload (meta.id, server_modified)
+    - an entry whose stat does not match anymore is dropped on lookup
+    - a hash is only stored when the file kept the stat it had before hashing (no hash of a file being written)
+    - size bounded: least recently used entries are evicted above max_entries
+"""
+
+import os, time, sqlite3, threading
+
+DEFAULT_CACHE_PATH = './.dbu_cache.sqlite'
+
+
+class HashCache:
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_entries=10000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                content_hash TEXT,
+                uploaded_id TEXT,
+                uploaded_hash TEXT,
+                server_modified TEXT,
+                last_used REAL NOT NULL)''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)')
+
+    @staticmethod
+    def _key(local_file_path):
+        st = os.stat(local_file_path)
+        return os.path.abspath(local_file_path), st.st_size, st.st_mtime_ns, st.st_ino
+
+    @classmethod
+    def stat_key(cls, local_file_path):
+        """ (size, mtime_ns, inode) the entries are validated with, take it before reading the file """
+        return cls._key(local_file_path)[1:]
+
+    def lookup(self, local_file_path):
+        """ Return the cache entry as a dict, None if missing or the file changed since it was cached """
+        try:
+            path, size, mtime_ns, inode = self._key(local_file_path)
+        except FileNotFoundError:
+            self.invalidate(local_file_path)
+            return None
+        with self._lock:
+            cur = self._conn.execute('SELECT * FROM files WHERE path = ?', (path,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            entry = dict(zip([c[0] for c in cur.description], row))
+            if (entry['size'], entry['mtime_ns'], entry['inode']) != (size, mtime_ns, inode):
+                with self._conn:
+                    self._conn.execute('DELETE FROM files WHERE path = ?', (path,))
+                return None
+            with self._conn:
+                self._conn.execute('UPDATE files SET last_used = ? WHERE path = ?', (time.time(), path))
+        return entry
+
+    def _upsert(self, local_file_path, stat=None, **values):
+        """ stat: stat_key() taken before the values were computed, nothing is stored when the file changed since """
+        path, size, mtime_ns, inode = self._key(local_file_path)
+        if stat is not None and tuple(stat) != (size, mtime_ns, inode):
+            print(f'{local_file_path} changed while it was read => not cached')
+            return
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT size, mtime_ns, inode FROM files WHERE path = ?', (path,)).fetchone()
+            if row is None or tuple(row) != (size, mtime_ns, inode):
+                self._conn.execute('DELETE FROM files WHERE path = ?', (path,))
+                self._conn.execute('INSERT INTO files (path, size, mtime_ns, inode, last_used) VALUES (?, ?, ?, ?, ?)',
+                                   (path, size, mtime_ns, inode, time.time()))
+            columns = ', '.join(f'{k} = ?' for k in values)
+            self._conn.execute(f'UPDATE files SET {columns}, last_used = ? WHERE path = ?',
+                               list(values.values()) + [time.time(), path])
+            self._evict()
+
+    def get_hash(self, local_file_path):
+        entry = self.lookup(local_file_path)
+        return entry and entry['content_hash']
+
+    def put_hash(self, local_file_path, content_hash, stat=None):
+        self._upsert(local_file_path, stat, content_hash=content_hash)
+
+    def put_upload(self, local_file_path, meta):
+        """ Remember the last upload of a local file, meta is the returned dropbox.files.FileMetadata """
+        self._upsert(local_file_path, uploaded_id=meta.id, uploaded_hash=meta.content_hash,
+                     server_modified=str(meta.server_modified))
+
+    def uploaded_hashes(self, content_hash):
+        """ Content hashes of the last uploads (e.g. zips) of the local files whose content hash is content_hash """
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT uploaded_hash FROM files WHERE content_hash = ? AND uploaded_hash IS NOT NULL',
+                                      (content_hash,)).fetchall()
+        return {row[0] for row in rows}
+
+    def invalidate(self, local_file_path=None):
+        """ Drop the entry of a file, or every entry when no path is given """
+        with self._lock, self._conn:
+            if local_file_path is None:
+                self._conn.execute('DELETE FROM files')
+            else:
+                self._conn.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(local_file_path),))
+
+    def _evict(self):
+        count = self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute('DELETE FROM files WHERE path IN '
+                               '(SELECT path FROM files ORDER BY last_used ASC LIMIT ?)', (count - self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
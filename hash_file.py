@@ -2,26 +2,19 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # A command-line program that computes the Dropbox-Content-Hash of the given file.
 
-import sys
+import argparse
 
-from dropbox_content_hasher import DropboxContentHasher
+from parallel_hasher import content_hash_file
 
 def main():
-    prog_name, args = sys.argv[0], sys.argv[1:]
-    if len(args) != 1:
-        sys.stderr.write("Expecting exactly one argument, got {}.\n".format(len(args)))
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Compute the Dropbox content hash of a file')
+    parser.add_argument('file', type=str, help='path to the file to hash')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='hashing threads, default to number of cores')
+    parser.add_argument('--no-mmap', dest='mmap', action='store_false', help='read with readinto buffers instead of mmap')
+    parser.set_defaults(mmap=True)
+    args = parser.parse_args()
 
-    fn = args[0]
-
-    hasher = DropboxContentHasher()
-    with open(fn, 'rb') as f:
-        while True:
-            chunk = f.read(1024)  # or whatever chunk size you want
-            if len(chunk) == 0:
-                break
-            hasher.update(chunk)
-    print(hasher.hexdigest())
+    print(content_hash_file(args.file, jobs=args.jobs, use_mmap=args.mmap))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,140 @@
+""" Indexed, append-only upload history
+    - remote layout: {folder}/history.csv is the compacted base (same schema as before => existing
+      history files are used as they are), {folder}/history/seg-*.csv are small append-only deltas
+    - a local mirror keeps the base and the segments, a run only downloads what it does not have yet
+    - rows are indexed by hash and by original_name, lookups do not scan the history
+    - compact() merges the segments into a new base once there are compact_every of them
+"""
+
+import os, csv, time, uuid, shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import dropbox
+
+from parallel_hasher import content_hash_file
+from remote_ops import delete_batch, is_gone
+from up_to_dropbox import dropbox_list_folder
+
+FIELD_NAMES = ['id', 'original_name', 'new_name', 'hash', 'server_modified']
+DEFAULT_HISTORY_DIR = './.dbu_history'
+
+
+def read_rows(csv_path):
+    with open(csv_path, 'r', newline='') as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def write_rows(csv_path, rows):
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=FIELD_NAMES, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+class HistoryStore:
+    def __init__(self, dbx, remote_folder_path, local_dir=DEFAULT_HISTORY_DIR, compact_every=50, workers=8):
+        self.dbx = dbx
+        self.remote_folder_path = remote_folder_path
+        self.remote_base_path = f'{remote_folder_path}/history.csv'
+        self.remote_segments_path = f'{remote_folder_path}/history'
+        self.local_dir = os.path.join(local_dir, remote_folder_path.strip('/').replace('/', '__') or '_root')
+        self.local_base_path = os.path.join(self.local_dir, 'history.csv')
+        self.local_segments_dir = os.path.join(self.local_dir, 'segments')
+        self.compact_every = compact_every
+        self.workers = workers
+        self.segments = []
+        self._reset_index()
+
+    def _reset_index(self):
+        self.rows = []
+        self._keys = set()
+        self._by_hash = {}
+        self._by_name = {}
+
+    def _index(self, rows):
+        for row in rows:
+            key = (row['id'], row['original_name'], row['hash'])
+            if key in self._keys:  # a segment already merged in the base (compaction interrupted)
+                continue
+            self._keys.add(key)
+            self.rows.append(row)
+            self._by_hash.setdefault(row['hash'], []).append(row)
+            self._by_name.setdefault(row['original_name'], []).append(row)
+
+    def load(self):
+        """ Sync the local mirror with Dropbox (download only a changed base and new segments) and index it """
+        os.makedirs(self.local_segments_dir, exist_ok=True)
+        try:
+            base_meta = self.dbx.files_get_metadata(self.remote_base_path)
+        except dropbox.exceptions.ApiError:
+            base_meta = None
+        if base_meta is None:
+            if os.path.exists(self.local_base_path):
+                os.remove(self.local_base_path)
+        elif not os.path.exists(self.local_base_path) or content_hash_file(self.local_base_path, jobs=1) != base_meta.content_hash:
+            print('Getting uploaded history...')
+            self.dbx.files_download_to_file(self.local_base_path, self.remote_base_path)
+
+        try:
+            remote_segments = sorted(f.name for f in dropbox_list_folder(self.remote_segments_path, self.dbx) if f.name.endswith('.csv'))
+        except dropbox.exceptions.ApiError:
+            remote_segments = []
+        for name in set(os.listdir(self.local_segments_dir)) - set(remote_segments):
+            os.remove(os.path.join(self.local_segments_dir, name))  # compacted by another run
+        missing = [n for n in remote_segments if not os.path.exists(os.path.join(self.local_segments_dir, n))]
+        if missing:
+            print(f'Getting {len(missing)} history segments...')
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(lambda n: self.dbx.files_download_to_file(os.path.join(self.local_segments_dir, n),
+                                                                             f'{self.remote_segments_path}/{n}'), missing))
+        self.segments = remote_segments
+
+        self._reset_index()
+        if os.path.exists(self.local_base_path):
+            self._index(read_rows(self.local_base_path))
+        for name in self.segments:
+            self._index(read_rows(os.path.join(self.local_segments_dir, name)))
+        return self
+
+    def by_hash(self, content_hash):
+        return self._by_hash.get(content_hash, [])
+
+    def by_name(self, original_name):
+        return self._by_name.get(original_name, [])
+
+    def uploaded_names(self, remote_hashes):
+        """ original_name of every row whose uploaded content is one of remote_hashes """
+        return set(row['original_name'] for h in remote_hashes for row in self._by_hash.get(h, []))
+
+    def append(self, values):
+        """ Upload values (list of dict(id, original_name, new_name, hash, server_modified)) as a new segment """
+        name = 'seg-{}-{}.csv'.format(time.strftime('%Y%m%d%H%M%S', time.gmtime()), uuid.uuid4().hex[:8])
+        local_path = os.path.join(self.local_segments_dir, name)
+        os.makedirs(self.local_segments_dir, exist_ok=True)
+        write_rows(local_path, values)
+        with open(local_path, 'rb') as f:
+            meta = self.dbx.files_upload(f.read(), f'{self.remote_segments_path}/{name}', mode=dropbox.files.WriteMode('add'))
+        self.segments.append(name)
+        self._index(read_rows(local_path))
+        if len(self.segments) >= self.compact_every:
+            self.compact()
+        return meta
+
+    def compact(self):
+        """ Merge the base and the segments into a new base, then delete the merged segments """
+        print(f'Compact history: {len(self.segments)} segments...')
+        merged = self.segments
+        temp_path = self.local_base_path + '.tmp'
+        write_rows(temp_path, self.rows)
+        with open(temp_path, 'rb') as f:
+            meta = self.dbx.files_upload(f.read(), self.remote_base_path, mode=dropbox.files.WriteMode('overwrite'))
+        shutil.move(temp_path, self.local_base_path)
+        results = delete_batch(self.dbx, [f'{self.remote_segments_path}/{name}' for name in merged])
+        for name, result in zip(merged, results):
+            if not is_gone(result):
+                print('Error deleting history segment', name, result)
+            local_path = os.path.join(self.local_segments_dir, name)
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        self.segments = []
+        return meta
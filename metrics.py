@@ -0,0 +1,179 @@
+""" Per-phase run metrics
+    - phases (list, history, revisions, hash, zip, upload, commit, ...) are timed with their bytes,
+      per file when a file is given, plus counters (API calls per route, retries, bytes saved...)
+    - written at the end of a run as a JSON report and as a Prometheus textfile-collector file
+    - disabled by default: phase() hands out a shared no-op context and count() returns at once,
+      nothing is recorded until set_metrics(Metrics()) is called
+"""
+
+import os, re, json, time, inspect, functools, threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+
+class _Phase:
+    __slots__ = ('bytes',)
+
+    def __init__(self, nbytes=0):
+        self.bytes = nbytes
+
+    def add(self, n):
+        self.bytes += n
+
+
+class _NoopPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, n):
+        pass
+
+
+_NOOP = _NoopPhase()
+
+
+class Metrics:
+    def __init__(self, job=''):
+        self.job = job  # label telling the cron jobs apart in Prometheus
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.phases = {}  # name => {'calls', 'seconds', 'bytes', 'errors'}
+        self.files = []  # one record per phase run on a file
+        self.counters = {}
+        self.api_calls = {}  # route => number of HTTP requests
+
+    @contextmanager
+    def phase(self, name, file=None, nbytes=0):
+        p = _Phase(nbytes)
+        since = time.monotonic()
+        error = False
+        try:
+            yield p
+        except BaseException:
+            error = True
+            raise
+        finally:
+            seconds = time.monotonic() - since
+            with self._lock:
+                stats = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+                stats['calls'] += 1
+                stats['seconds'] += seconds
+                stats['bytes'] += p.bytes
+                stats['errors'] += error
+                if file is not None:
+                    self.files.append({'phase': name, 'file': file, 'seconds': round(seconds, 3), 'bytes': p.bytes,
+                                       'mb_per_s': round(p.bytes / 1024 / 1024 / seconds, 2) if seconds else None,
+                                       'error': error})
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def api_call(self, response):
+        route = urlsplit(response.url).path
+        if not route.startswith(('/2/', '/oauth2/')):
+            route = 'temporary_link'
+        with self._lock:
+            self.api_calls[route] = self.api_calls.get(route, 0) + 1
+
+    def report(self, success=True):
+        with self._lock:
+            phases = {name: dict(stats, seconds=round(stats['seconds'], 3),
+                                 mb_per_s=round(stats['bytes'] / 1024 / 1024 / stats['seconds'], 2) if stats['seconds'] else None)
+                      for name, stats in self.phases.items()}
+            return {'job': self.job, 'started': self.started, 'seconds': round(time.time() - self.started, 3),
+                    'success': success, 'phases': phases, 'counters': dict(self.counters),
+                    'api_calls': dict(self.api_calls), 'files': list(self.files)}
+
+    def write_json(self, path, success=True):
+        _write_atomic(path, json.dumps(self.report(success), indent=2))
+
+    def write_prometheus(self, path, success=True):
+        """ Textfile collector format (node_exporter --collector.textfile.directory) """
+        report = self.report(success)
+        job = self.job.replace('\\', '\\\\').replace('"', '\\"')
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f'# HELP dbu_{name} {help_text}')
+            lines.append(f'# TYPE dbu_{name} gauge')
+            for labels, value in samples:
+                labels = ','.join([f'job="{job}"'] + [f'{k}="{v}"' for k, v in labels.items()])
+                lines.append(f'dbu_{name}{{{labels}}} {value}')
+
+        phases = report['phases']
+        metric('phase_seconds', 'Seconds spent in each phase of the last run', [({'phase': k}, v['seconds']) for k, v in phases.items()])
+        metric('phase_bytes', 'Bytes processed by each phase of the last run', [({'phase': k}, v['bytes']) for k, v in phases.items()])
+        metric('phase_calls', 'Times each phase ran in the last run', [({'phase': k}, v['calls']) for k, v in phases.items()])
+        metric('phase_errors', 'Failed runs of each phase in the last run', [({'phase': k}, v['errors']) for k, v in phases.items()])
+        metric('api_calls', 'Dropbox API requests of the last run', [({'route': k}, v) for k, v in report['api_calls'].items()])
+        for name, value in report['counters'].items():
+            metric(re.sub(r'[^a-zA-Z0-9_]', '_', name), f'{name} in the last run', [({}, value)])
+        metric('run_seconds', 'Duration of the last run', [({}, report['seconds'])])
+        metric('run_success', '1 if the last run ended without error', [({}, int(success))])
+        metric('run_timestamp_seconds', 'End time of the last run', [({}, round(time.time(), 3))])
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def _write_atomic(path, text):
+    temp_path = path + '.tmp'  # not *.prom => never read half written by the collector
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+_metrics = None
+
+
+def set_metrics(metrics):
+    global _metrics
+    _metrics = metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def phase(name, file=None, nbytes=0):
+    """ Context timing a phase, .add(n) counts bytes; a shared no-op when metrics are disabled """
+    if _metrics is None:
+        return _NOOP
+    return _metrics.phase(name, file, nbytes)
+
+
+def count(name, n=1):
+    if _metrics is not None:
+        _metrics.count(name, n)
+
+
+def timed(name, file_arg=None):
+    """ Decorator timing every call as phase name, file_arg names the parameter holding the local file
+        (its size is counted as the phase bytes)
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return fn(*args, **kwargs)
+            file = signature.bind(*args, **kwargs).arguments.get(file_arg) if file_arg else None
+            nbytes = os.path.getsize(file) if isinstance(file, str) and os.path.isfile(file) else 0
+            with _metrics.phase(name, file, nbytes):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _api_call(response, *args, **kwargs):
+    if _metrics is not None:
+        _metrics.api_call(response)
+
+
+def instrument_session(session):
+    """ Count the API requests made through a requests session (e.g. DropboxClients.session), hooked once """
+    if _api_call not in session.hooks['response']:
+        session.hooks['response'].append(_api_call)
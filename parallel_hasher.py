@@ -0,0 +1,108 @@
+""" Block-parallel Dropbox content hash
+    - The content hash is sha256 over the concatenated sha256 of every 4 MB block,
+      so the blocks can be hashed independently and combined in order.
+    - hashlib releases the GIL on large buffers => a thread pool scales with cores.
+    - ref: https://www.dropbox.com/developers/reference/content-hash
+"""
+
+import os, mmap, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from dropbox_content_hasher import DropboxContentHasher
+
+BLOCK_SIZE = DropboxContentHasher.BLOCK_SIZE
+
+
+def default_jobs():
+    return min(32, os.cpu_count() or 1)
+
+
+def combine_block_digests(digests):
+    """Combine the ordered raw sha256 digests of the 4 MB blocks into the content hash"""
+    overall = hashlib.sha256()
+    for digest in digests:
+        overall.update(digest)
+    return overall.hexdigest()
+
+
+def _block_digest(buf):
+    return hashlib.sha256(buf).digest()
+
+
+def _digests_mmap(f, file_size, executor, progress):
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        def block(offset):
+            part = view[offset:offset + BLOCK_SIZE]
+            try:
+                return _block_digest(part)
+            finally:
+                part.release()
+                if progress:
+                    progress(min(BLOCK_SIZE, file_size - offset))
+        return list(executor.map(block, range(0, file_size, BLOCK_SIZE)))
+    finally:
+        view.release()
+        mm.close()
+
+
+def _digests_readinto(f, executor, progress, buffer_blocks):
+    """ Fallback when the file cannot be mapped (pipes, some network mounts)
+        - double buffering: read the next buffer while the previous one is being hashed
+        - memory is bounded to 2 * buffer_blocks * 4 MB
+    """
+    digests = []
+    buffers = [bytearray(BLOCK_SIZE * buffer_blocks) for _ in range(2)]
+    pending = []
+    turn = 0
+    while True:
+        buf = buffers[turn % 2]
+        n = f.readinto(buf)
+        for future, size in pending:
+            digests.append(future.result())
+            if progress:
+                progress(size)
+        pending = []
+        if not n:
+            break
+        view = memoryview(buf)[:n]
+        for i in range(0, n, BLOCK_SIZE):
+            block = view[i:i + BLOCK_SIZE]
+            pending.append((executor.submit(_block_digest, block), len(block)))
+        turn += 1
+    return digests
+
+
+def content_hash_file(file_path, jobs=None, progress=None, use_mmap=True, buffer_blocks=8):
+    """ Return the Dropbox content hash of a local file, hashing 4 MB blocks in parallel
+        - jobs: number of hashing threads (default: number of cores)
+        - progress: optional callable receiving the number of bytes hashed
+        - use_mmap: map the file; fall back to large readinto buffers when not possible
+    """
+    jobs = jobs or default_jobs()
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        if file_size == 0:
+            return combine_block_digests([])
+        if jobs == 1:
+            digests = []
+            buf = bytearray(BLOCK_SIZE)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                digests.append(_block_digest(view[:n]))
+                if progress:
+                    progress(n)
+            return combine_block_digests(digests)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            if use_mmap:
+                try:
+                    digests = _digests_mmap(f, file_size, executor, progress)
+                    return combine_block_digests(digests)
+                except (ValueError, OSError):
+                    f.seek(0)
+            digests = _digests_readinto(f, executor, progress, buffer_blocks)
+    return combine_block_digests(digests)
@@ -0,0 +1,145 @@
+""" Multi-core zip compression
+    - every file is cut in blocks compressed by a process pool, pigz-style: each block is raw deflate
+      primed with the previous 32 KB (zdict) and ended with a sync flush, the last one with Z_FINISH,
+      so the concatenated blocks are one standard deflate stream
+    - small files are a single block => a folder compresses its members in parallel
+    - members are written in order with a data descriptor, the output does not need to be seekable
+      (a temp zip or an UploadSessionWriter)
+    - ref: https://github.com/madler/pigz, crc32_combine from zlib's crc32.c
+"""
+
+import os, struct, zlib
+from collections import deque
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP64_LIMIT
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DICT_SIZE = 32 * 1024
+_DD_SIGNATURE = 0x08074b50
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_combine(crc1, crc2, len2):
+    """ CRC-32 of A + B from crc32(A), crc32(B) and len(B) """
+    if len2 <= 0:
+        return crc1
+    odd = [0xedb88320] + [1 << n for n in range(31)]  # operator for one zero bit
+    even = _gf2_matrix_square(odd)  # two zero bits
+    odd = _gf2_matrix_square(even)  # four zero bits
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+def _compress_block(path, offset, length, level, last):
+    """ Pool worker: raw deflate of path[offset:offset + length], return (compressed, crc32, length) """
+    with open(path, 'rb') as f:
+        start = max(0, offset - DICT_SIZE)
+        f.seek(start)
+        zdict = f.read(offset - start)
+        data = f.read(length)
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, zlib.crc32(data), len(data)
+
+
+def zip_members(local_path):
+    """ (file path, arcname) pairs, same layout as DropBoxUpload.ZipFile """
+    if os.path.isfile(local_path):
+        return [(local_path, os.path.basename(local_path))]
+    members = []
+    for root, dirs, files in os.walk(local_path):
+        for file in files:
+            path = os.path.join(root, file)
+            members.append((path, os.path.relpath(path, os.path.join(local_path, '..'))))
+    return members
+
+
+def _blocks(members, block_size):
+    for index, (path, arcname) in enumerate(members):
+        size = os.path.getsize(path)
+        offsets = list(range(0, size, block_size)) or [0]
+        for offset in offsets:
+            yield index, path, offset, min(block_size, size - offset), offset == offsets[-1]
+
+
+def parallel_zip(local_path, zip_file, level=5, workers=None, block_size=DEFAULT_BLOCK_SIZE, progress=None):
+    """ Zip a file or a folder into zip_file (path or writable file object) with a process pool
+        - level: deflate level, workers: processes (default: number of cores)
+        - progress: optional callable receiving the number of bytes compressed
+    """
+    from concurrent.futures import ProcessPoolExecutor  # multiprocessing is only loaded by runs that compress in parallel
+    members = zip_members(local_path)
+    workers = workers or os.cpu_count() or 1
+    with ZipFile(zip_file, 'w', ZIP_DEFLATED, compresslevel=level) as zf, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        blocks = _blocks(members, block_size)
+        current = None  # [zinfo, zip64, crc, compress_size, file_size] of the member being written
+
+        def submit():
+            block = next(blocks, None)
+            if block is None:
+                return False
+            index, path, offset, length, last = block
+            window.append((index, last, executor.submit(_compress_block, path, offset, length, level, last)))
+            return True
+
+        for _ in range(workers * 4):  # bounded read-ahead
+            if not submit():
+                break
+        while window:
+            index, last, future = window.popleft()
+            out, crc, length = future.result()
+            submit()
+            if current is None:
+                path, arcname = members[index]
+                zinfo = ZipInfo.from_file(path, arcname)
+                zinfo.compress_type = ZIP_DEFLATED
+                zinfo.flag_bits |= _MASK_USE_DATA_DESCRIPTOR
+                zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+                zinfo.header_offset = zf.fp.tell()
+                zf.fp.write(zinfo.FileHeader(zip64))
+                current = [zinfo, zip64, 0, 0, 0]
+            current[2] = crc32_combine(current[2], crc, length) if current[4] else crc
+            current[3] += len(out)
+            current[4] += length
+            zf.fp.write(out)
+            if progress:
+                progress(length)
+            if last:
+                zinfo, zip64, zinfo.CRC, zinfo.compress_size, zinfo.file_size = current
+                fmt = '<LLQQ' if zip64 else '<LLLL'
+                zf.fp.write(struct.pack(fmt, _DD_SIGNATURE, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+                zf.filelist.append(zinfo)
+                zf.NameToInfo[zinfo.filename] = zinfo
+                zf.start_dir = zf.fp.tell()
+                current = None
@@ -0,0 +1,25 @@
+""" Progress bars
+    - tqdm is only imported when a bar is shown, --no-pbar (cron) runs never load it
+"""
+
+
+class _NoBar:
+    def update(self, n=1):
+        pass
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_NO_BAR = _NoBar()
+
+
+def progress_bar(total=None, unit='M', show=True):
+    """ tqdm bar (unit label, binary scaling), a shared no-op bar when show is False """
+    if not show:
+        return _NO_BAR
+    from tqdm import tqdm
+    return tqdm(unit=unit, unit_scale=True, unit_divisor=1024, total=total)
@@ -0,0 +1,104 @@
+""" Batched remote file operations
+    - move, copy and delete many paths with files_move_batch_v2 / files_copy_batch_v2 / files_delete_batch:
+      one launch per 1000 entries (Dropbox limit), then the async job is polled until it completes
+      => a rotation or a cleanup of N files costs a few calls instead of N blocking ones
+    - move with overwrite: the entries failing on an existing destination file get it deleted (one batch)
+      and are moved again (one batch), no exception handling per file
+    - every function returns, in the order of its input, the Metadata of each entry or its error
+      (RelocationBatchErrorEntry, DeleteError, or None when the whole job failed)
+"""
+
+import time
+
+import dropbox
+
+from metrics import count
+from retry import call_with_retry
+
+BATCH_LIMIT = 1000  # entries per batch call
+
+
+def _run_batch(launch, check, entries, retries=5, poll_interval=1):
+    """ [entry result] of launch(entries) for every slice of BATCH_LIMIT entries, async jobs polled with check(async_job_id) """
+    results = []
+    for i in range(0, len(entries), BATCH_LIMIT):
+        part = entries[i:i + BATCH_LIMIT]
+        job = call_with_retry(launch, part, retries=retries)
+        count('batch_calls')
+        if job.is_async_job_id():
+            async_job_id = job.get_async_job_id()
+            while True:
+                time.sleep(poll_interval)
+                job = call_with_retry(check, async_job_id, retries=retries)
+                if not job.is_in_progress():
+                    break
+        if job.is_complete():
+            results += job.get_complete().entries
+        else:  # failed or other: the job did not run any entry
+            print('Batch job failed:', job)
+            results += [None] * len(part)
+    return results
+
+
+def _relocation_results(entries):
+    return [e.get_success() if e is not None and e.is_success() else (e.get_failure() if e is not None else None) for e in entries]
+
+
+def is_conflict(error):
+    """ True for a RelocationBatchErrorEntry of a destination that is an existing file """
+    if not isinstance(error, dropbox.files.RelocationBatchErrorEntry) or not error.is_relocation_error():
+        return False
+    error = error.get_relocation_error()
+    return error.is_to() and error.get_to().is_conflict() and error.get_to().get_conflict().is_file()
+
+
+def is_not_found(error):
+    """ True for the error of an entry whose source (or path to delete) does not exist """
+    if isinstance(error, dropbox.files.RelocationBatchErrorEntry) and error.is_relocation_error():
+        error = error.get_relocation_error()
+        return error.is_from_lookup() and error.get_from_lookup().is_not_found()
+    if isinstance(error, dropbox.files.DeleteError):
+        return error.is_path_lookup() and error.get_path_lookup().is_not_found()
+    return False
+
+
+def delete_batch(dbx, paths, retries=5, poll_interval=1):
+    """ Delete paths, return [Metadata or DeleteError or None] """
+    if not paths:
+        return []
+    entries = _run_batch(dbx.files_delete_batch, dbx.files_delete_batch_check,
+                         [dropbox.files.DeleteArg(path) for path in paths], retries, poll_interval)
+    return [e.get_success().metadata if e is not None and e.is_success() else (e.get_failure() if e is not None else None)
+            for e in entries]
+
+
+def is_gone(result):
+    """ True for a delete_batch result whose path is deleted or was already missing """
+    return isinstance(result, dropbox.files.Metadata) or is_not_found(result)
+
+
+def copy_batch(dbx, pairs, retries=5, poll_interval=1):
+    """ Server-side copy of [(from_path, to_path)], return [Metadata or RelocationBatchErrorEntry or None] """
+    if not pairs:
+        return []
+    return _relocation_results(_run_batch(dbx.files_copy_batch_v2, dbx.files_copy_batch_check_v2,
+                                          [dropbox.files.RelocationPath(*pair) for pair in pairs], retries, poll_interval))
+
+
+def move_batch(dbx, pairs, overwrite=False, retries=5, poll_interval=1):
+    """
+        - Move [(from_path, to_path)], return [Metadata or RelocationBatchErrorEntry or None]
+        - overwrite: an existing file at to_path is deleted and the move retried, both in one batch for all the conflicts
+    """
+    if not pairs:
+        return []
+    results = _relocation_results(_run_batch(dbx.files_move_batch_v2, dbx.files_move_batch_check_v2,
+                                             [dropbox.files.RelocationPath(*pair) for pair in pairs], retries, poll_interval))
+    conflicts = [i for i, result in enumerate(results) if is_conflict(result)]
+    if overwrite and conflicts:
+        print(f'{len(conflicts)} destination files exist => delete them first')
+        deleted = delete_batch(dbx, [pairs[i][1] for i in conflicts], retries, poll_interval)
+        conflicts = [i for i, result in zip(conflicts, deleted) if is_gone(result)]
+        for i, result in zip(conflicts, move_batch(dbx, [pairs[i] for i in conflicts], retries=retries, poll_interval=poll_interval)):
+            results[i] = result
+    return results
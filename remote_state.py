@@ -0,0 +1,129 @@
+""" Local mirror of remote Dropbox folders
+    - the first sync lists the whole folder, the list_folder cursor is stored with the files
+    - later syncs only apply what changed since the cursor (files_list_folder_continue)
+    - an expired/reset cursor falls back to a full resync
+    - wait() long-polls the cursor, for a daemon that reacts to remote changes
+"""
+
+import time, sqlite3, threading
+from datetime import datetime
+
+import dropbox
+
+from hash_cache import DEFAULT_CACHE_PATH
+from up_to_dropbox import RemoteFile
+
+
+class RemoteState:
+    def __init__(self, db_path=DEFAULT_CACHE_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS remote_folders (
+                folder TEXT PRIMARY KEY,
+                cursor TEXT NOT NULL,
+                synced_at REAL NOT NULL)''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS remote_files (
+                folder TEXT NOT NULL,
+                path_lower TEXT NOT NULL,
+                id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                path_display TEXT NOT NULL,
+                client_modified TEXT,
+                server_modified TEXT,
+                hash TEXT,
+                size INTEGER,
+                PRIMARY KEY (folder, path_lower))''')
+
+    @staticmethod
+    def _folder_key(folder):
+        return folder.rstrip('/').lower()
+
+    def cursor(self, folder):
+        """ Stored cursor of folder (None before its first sync), safe to call while another thread syncs """
+        with self._lock:
+            return self._cursor(folder)
+
+    def _cursor(self, folder):
+        row = self._conn.execute('SELECT cursor FROM remote_folders WHERE folder = ?', (self._folder_key(folder),)).fetchone()
+        return row and row[0]
+
+    def _apply(self, folder, entries, cursor):
+        key = self._folder_key(folder)
+        with self._conn:
+            for entry in entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    self._conn.execute('INSERT OR REPLACE INTO remote_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                       (key, entry.path_lower, entry.id, entry.name, entry.path_display,
+                                        entry.client_modified.isoformat(), entry.server_modified.isoformat(),
+                                        entry.content_hash, entry.size))
+                elif isinstance(entry, dropbox.files.DeletedMetadata):
+                    self._conn.execute('DELETE FROM remote_files WHERE folder = ? AND path_lower = ?', (key, entry.path_lower))
+            self._conn.execute('INSERT OR REPLACE INTO remote_folders VALUES (?, ?, ?)', (key, cursor, time.time()))
+
+    def _full_sync(self, dbx, folder):
+        print(f'Full listing of {folder}...')
+        key = self._folder_key(folder)
+        with self._conn:
+            self._conn.execute('DELETE FROM remote_files WHERE folder = ?', (key,))
+            self._conn.execute('DELETE FROM remote_folders WHERE folder = ?', (key,))
+        result = dbx.files_list_folder(folder)
+        self._apply(folder, result.entries, result.cursor)
+        return result
+
+    def sync(self, dbx, folder):
+        """ Bring the mirror of folder up to date and return its files (same records as dropbox_list_files) """
+        with self._lock:
+            cursor = self._cursor(folder)
+            if cursor is None:
+                result = self._full_sync(dbx, folder)
+            else:
+                try:
+                    result = dbx.files_list_folder_continue(cursor)
+                    self._apply(folder, result.entries, result.cursor)
+                except dropbox.exceptions.ApiError as e:
+                    if not (isinstance(e.error, dropbox.files.ListFolderContinueError) and e.error.is_reset()):
+                        raise
+                    print('Remote cursor expired => full resync')
+                    result = self._full_sync(dbx, folder)
+            while result.has_more:
+                result = dbx.files_list_folder_continue(result.cursor)
+                self._apply(folder, result.entries, result.cursor)
+        return self.files(folder)
+
+    def files(self, folder):
+        with self._lock:
+            rows = self._conn.execute('SELECT id, name, path_display, client_modified, server_modified, hash, size '
+                                      'FROM remote_files WHERE folder = ? ORDER BY server_modified DESC',
+                                      (self._folder_key(folder),)).fetchall()
+        files_list = []
+        for file_id, name, path_display, client_modified, server_modified, content_hash, size in rows:
+            files_list.append(RemoteFile(file_id, name, path_display, datetime.fromisoformat(client_modified),
+                                         datetime.fromisoformat(server_modified), content_hash, size))
+        return files_list
+
+    def wait(self, dbx, folder, timeout=480, cursor=None):
+        """ Long-poll the stored cursor (or cursor), return True when the folder changed (then call sync) """
+        cursor = cursor or self.cursor(folder)
+        if cursor is None:
+            return True
+        result = dbx.files_list_folder_longpoll(cursor, timeout=timeout)
+        if result.backoff:
+            time.sleep(result.backoff)
+        return result.changes
+
+    def invalidate(self, folder=None):
+        """ Forget a folder (or every folder), the next sync lists it in full """
+        with self._lock, self._conn:
+            if folder is None:
+                self._conn.execute('DELETE FROM remote_files')
+                self._conn.execute('DELETE FROM remote_folders')
+            else:
+                key = self._folder_key(folder)
+                self._conn.execute('DELETE FROM remote_files WHERE folder = ?', (key,))
+                self._conn.execute('DELETE FROM remote_folders WHERE folder = ?', (key,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
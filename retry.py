@@ -0,0 +1,42 @@
+""" Retry with exponential backoff for transient Dropbox/network errors """
+
+import time, random
+
+import requests
+import dropbox
+
+from metrics import count
+
+
+class ShortRead(IOError):
+    """ A response body ended before its expected length (connection dropped mid-transfer) """
+
+
+def is_transient(e):
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError,
+                      ShortRead, dropbox.exceptions.InternalServerError, dropbox.exceptions.RateLimitError)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:  # plain requests, e.g. temporary links
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return isinstance(e, dropbox.exceptions.HttpError) and e.status_code >= 500
+
+
+def call_with_retry(fn, *args, retries=5, backoff=1, max_backoff=60, on_retry=None, **kwargs):
+    """ Call fn(*args, **kwargs), retry transient errors up to `retries` times with jittered exponential backoff
+        - on_retry: optional callable receiving the exception before each retry
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            # RateLimitError tells how long to wait
+            wait = getattr(e, 'backoff', None) or min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1)
+            attempt += 1
+            count('retries')
+            print(f'Transient error ({e.__class__.__name__}: {e}) => retry {attempt}/{retries} in {wait:.1f}s')
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(wait)
@@ -0,0 +1,200 @@
+""" Cross-job scheduler: the dbu.py runs of one host (overlapping cron entries) share a worker and bandwidth budget
+    - no daemon: every run registers a job file in a shared folder and keeps an exclusive flock on it for
+      its lifetime => a second run of the same job is refused, a crashed run frees its job by itself
+    - before uploading, a job queues with the size of what it will send and waits until it is first in the
+      queue (deadline first, then smallest size, jobs waiting for more than max_wait count as due) and the
+      workers (threads: upload workers x parallel chunks or zip processes) of the running jobs plus its
+      own fit in max_workers; queue decisions are taken under one lock file
+    - a job asking for more than max_workers is granted max_workers, the run scales its settings down to Job.workers
+    - the host-wide bandwidth (total_rate) is split evenly between the running jobs, each process paces
+      its uploads to its share (see throttle.TokenBucket)
+    - every job gets its own work folder for temp zips and packs, nothing is shared through ./temp.zip
+"""
+
+import os, json, time, fcntl, hashlib, tempfile, threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+DEFAULT_SCHEDULER_DIR = os.path.join(tempfile.gettempdir(), 'dbu_jobs')  # one per host, whatever the cwd of the run
+SHARE_REFRESH = 5  # seconds between two reads of the running jobs for the bandwidth share
+
+
+class JobRunning(Exception):
+    """ The same job already runs in another process """
+
+
+def job_key(mode, local_path, remote_path):
+    """ File name of a job: readable prefix + hash of what identifies it """
+    prefix = ''.join(c if c.isalnum() else '_' for c in os.path.basename(local_path.rstrip('/')))[:32]
+    identity = '\n'.join([mode, os.path.abspath(local_path), remote_path.rstrip('/').lower()])
+    return '{}-{}'.format(prefix, hashlib.sha1(identity.encode()).hexdigest()[:12])
+
+
+def parse_deadline(value, now=None):
+    """ 'HH:MM' => timestamp of its next occurrence, '' => None """
+    if not value:
+        return None
+    now = now or datetime.now()
+    hour, minute = (int(v) for v in value.split(':'))
+    deadline = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if deadline < now:
+        deadline += timedelta(days=1)
+    return deadline.timestamp()
+
+
+class Scheduler:
+    def __init__(self, root=DEFAULT_SCHEDULER_DIR, max_workers=8, total_rate=None, max_wait=3600, poll_interval=2):
+        if not os.path.isabs(root):
+            raise ValueError(f'Scheduler folder {root} must be an absolute path: runs started from other folders would not see its jobs')
+        self.root = root
+        self.max_workers = max_workers  # workers of all the running jobs, 0 => no limit
+        self.total_rate = total_rate  # bytes/s shared by the running jobs, None => unlimited
+        self.max_wait = max_wait  # seconds in the queue after which a job goes before the smaller ones
+        self.poll_interval = poll_interval
+        self.jobs_dir = os.path.join(root, 'jobs')
+        self.work_root = os.path.join(root, 'work')
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        os.makedirs(self.work_root, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """ Global lock of the queue decisions """
+        with open(os.path.join(self.root, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def jobs(self):
+        """ [job dict] of the live jobs, files left by dead processes (flock free) are removed; call under _locked() """
+        jobs = []
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                with open(path, 'r') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:  # held by its owner
+                        jobs.append(json.loads(f.read()))
+                        continue
+                    os.remove(path)
+            except (OSError, ValueError):
+                continue
+        return jobs
+
+    def submit(self, key, workers=1, deadline=None):
+        """ Register the job key (JobRunning when it already runs), return its Job with workers clamped to max_workers """
+        path = os.path.join(self.jobs_dir, key + '.json')
+        workers = min(workers, self.max_workers) if self.max_workers else workers
+        with self._locked():
+            f = open(path, 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                raise JobRunning(f'Job {key} is already running')
+            return Job(self, key, f, workers, deadline)
+
+    def priority(self, job, now):
+        deadline = job['deadline']
+        if deadline is None and now - job['queued'] >= self.max_wait:
+            deadline = job['queued'] + self.max_wait
+        return (deadline is None, deadline or 0, job['size'], job['queued'])
+
+
+class Job:
+    def __init__(self, scheduler, key, f, workers, deadline):
+        self.scheduler = scheduler
+        self.key = key
+        self.workers = workers
+        self.deadline = deadline
+        self.work_dir = os.path.join(scheduler.work_root, key)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._file = f
+        self._admitted = 0  # nested admissions
+        self._lock = threading.Lock()
+        self._share = (0, None)  # (time read, rate)
+        self._write('idle')  # submit() holds the queue lock
+
+    def _write(self, state, size=0):
+        record = {'key': self.key, 'pid': os.getpid(), 'state': state, 'size': size, 'workers': self.workers,
+                  'deadline': self.deadline, 'queued': time.time()}
+        self._file.seek(0)
+        self._file.truncate()
+        json.dump(record, self._file)
+        self._file.flush()
+
+    def wait_turn(self, size):
+        """ Queue with size (bytes to upload) until the job may run """
+        scheduler = self.scheduler
+        with scheduler._locked():
+            self._write('waiting', size)
+        since = time.monotonic()
+        while True:
+            with scheduler._locked():
+                jobs = scheduler.jobs()
+                now = time.time()
+                busy = sum(j['workers'] for j in jobs if j['state'] == 'running')
+                waiting = sorted((j for j in jobs if j['state'] == 'waiting'), key=lambda j: scheduler.priority(j, now))
+                fits = not scheduler.max_workers or busy == 0 or busy + self.workers <= scheduler.max_workers
+                if waiting and waiting[0]['key'] == self.key and fits:
+                    self._write('running', size)
+                    break
+            time.sleep(scheduler.poll_interval)
+        waited = time.monotonic() - since
+        if waited >= scheduler.poll_interval:
+            print(f'Job {self.key} waited {waited:.0f}s for its turn')
+
+    def release(self):
+        with self.scheduler._locked():
+            self._write('idle')
+
+    def rate_share(self):
+        """ Bandwidth of this job: total_rate / running jobs (None => unlimited), re-read every SHARE_REFRESH seconds """
+        if self.scheduler.total_rate is None:
+            return None
+        with self._lock:
+            read_at, rate = self._share
+            if time.monotonic() - read_at >= SHARE_REFRESH:
+                with self.scheduler._locked():
+                    running = sum(1 for j in self.scheduler.jobs() if j['state'] == 'running' and j['key'] != self.key)
+                rate = self.scheduler.total_rate / (running + 1)
+                self._share = (time.monotonic(), rate)
+            return rate
+
+    def close(self):
+        """ Unregister the job (its work folder is kept: temp zips of interrupted uploads are resumed from there) """
+        path = os.path.join(self.scheduler.jobs_dir, self.key + '.json')
+        with self.scheduler._locked():
+            if os.path.exists(path):
+                os.remove(path)
+        self._file.close()
+
+
+_job = None
+
+
+def set_job(job):
+    global _job
+    _job = job
+
+
+@contextmanager
+def admission(size, files=1):
+    """ Run the block uploading files (size bytes) as the process job once admitted by the scheduler
+        - no-op without a job, when already admitted, or for files == 0 (nothing to upload, no need to queue)
+    """
+    job = _job
+    if job is None or not files:
+        yield
+        return
+    if not job._admitted:
+        job.wait_turn(size)
+    job._admitted += 1
+    try:
+        yield
+    finally:
+        job._admitted -= 1
+        if not job._admitted:
+            job.release()
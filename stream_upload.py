@@ -0,0 +1,120 @@
+""" Streaming upload session
+    - UploadSessionWriter is a write-only, unseekable file object: every chunk_size bytes written to it
+      are sent to an upload session by a background thread while the producer keeps writing
+    - ZipFile can write straight into it (zip entries then use data descriptors), so compression
+      and network transfer overlap and no temp file is needed
+    - written bytes are copied into buffers of the process wide pool (see buffer_pool), a full buffer
+      is queued as is and goes back to the pool once sent => memory is bounded by the pool
+"""
+
+import queue, threading
+
+import dropbox
+
+from retry import call_with_retry
+from throttle import throttle
+from buffer_pool import buffer_pool, payload
+from progress import progress_bar
+
+
+class UploadSessionWriter:
+    def __init__(self, dbx, dest_path, chunk_size, queue_chunks=2, show_pbar=True, retries=5):
+        self.dbx = dbx
+        self.dest_path = dest_path
+        self.chunk_size = chunk_size
+        self.retries = retries  # retries of transient errors per API call
+        self._buffers = buffer_pool()
+        self._buf = None  # pool buffer being filled
+        self._filled = 0
+        self._queue = queue.Queue(maxsize=queue_chunks)
+        self._error = None
+        self._session_id = None
+        self._offset = 0
+        self._closed = False
+        self._pbar = progress_bar(show=show_pbar)
+        self._thread = threading.Thread(target=self._upload_chunks, daemon=True)
+        self._thread.start()
+
+    def _upload_chunks(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                return
+            try:
+                if self._error is not None:
+                    continue  # drain so that the producer never blocks
+                chunk = throttle(memoryview(buf)[:self.chunk_size])
+                if self._session_id is None:
+                    self._session_id = call_with_retry(self.dbx.files_upload_session_start, payload(chunk), retries=self.retries).session_id
+                else:
+                    cursor = dropbox.files.UploadSessionCursor(session_id=self._session_id, offset=self._offset)
+                    call_with_retry(self.dbx.files_upload_session_append_v2, payload(chunk), cursor, retries=self.retries)
+                self._offset += len(chunk)
+                self._pbar.update(len(chunk))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._buffers.release(buf)
+
+    def _put(self, buf):
+        if self._error is not None:
+            self._buffers.release(buf)
+            raise self._error
+        self._queue.put(buf)
+
+    def write(self, b):
+        if self._closed:
+            raise ValueError('write to a closed UploadSessionWriter')
+        data = memoryview(b).cast('B')
+        while data:
+            if self._buf is None:
+                self._buf = self._buffers.acquire(self.chunk_size)
+                self._filled = 0
+            n = min(len(data), self.chunk_size - self._filled)
+            self._buf[self._filled:self._filled + n] = data[:n]
+            self._filled += n
+            data = data[n:]
+            if self._filled == self.chunk_size:
+                buf, self._buf = self._buf, None
+                self._put(buf)
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def _stop(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._pbar.close()
+
+    def _take_rest(self):
+        """ bytes written since the last full chunk, the buffer goes back to the pool """
+        if self._buf is None:
+            return b''
+        data = payload(memoryview(self._buf)[:self._filled])
+        self._buffers.release(self._buf)
+        self._buf = None
+        return data
+
+    def close(self):
+        """ Send what is left and commit the session, return the FileMetadata """
+        if self._closed:
+            raise ValueError('UploadSessionWriter already closed')
+        self._stop()
+        data = self._take_rest()
+        if self._error is not None:
+            raise self._error
+        throttle(data)
+        mode = dropbox.files.WriteMode("overwrite")
+        if self._session_id is None:
+            return call_with_retry(self.dbx.files_upload, data, self.dest_path, mode=mode, retries=self.retries)
+        cursor = dropbox.files.UploadSessionCursor(session_id=self._session_id, offset=self._offset)
+        commit = dropbox.files.CommitInfo(path=self.dest_path, mode=mode)
+        return call_with_retry(self.dbx.files_upload_session_finish, data, cursor, commit, retries=self.retries)
+
+    def abort(self):
+        """ Stop the background thread without committing, the session expires on Dropbox """
+        if not self._closed:
+            self._stop()
+            self._take_rest()
@@ -0,0 +1,115 @@
+""" Recursive folder sync: local tree scan and manifest of what was uploaded
+    - scan_tree walks the tree with os.scandir, every subdirectory is scanned by a thread pool task
+      (stat calls on NFS/SMB mounts overlap instead of adding up)
+    - the manifest (sqlite, same file as the hash cache) keeps size, mtime_ns, inode, content hash and the
+      remote path of every synced file => unchanged files are skipped without reading them, a file whose stat
+      changed but whose hash did not (touched, copied back) only gets its stat refreshed
+"""
+
+import os, time, fnmatch, sqlite3, threading, posixpath
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from hash_cache import DEFAULT_CACHE_PATH
+from watch import DEFAULT_IGNORE
+
+
+def _scan_dir(root, rel_dir, ignore):
+    """ ({rel_path: (size, mtime_ns, inode)}, [rel subdirectories], rel_dir if it could not be read) of one directory """
+    files = {}
+    subdirs = []
+    try:
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                if any(fnmatch.fnmatch(entry.name, pattern) for pattern in ignore):
+                    continue
+                rel_path = posixpath.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(rel_path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[rel_path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    except OSError as e:
+        print(f'Cannot scan {os.path.join(root, rel_dir)}: {e}')
+        return files, subdirs, rel_dir
+    return files, subdirs, None
+
+
+def scan_tree(root, workers=8, ignore=None):
+    """ Return ({relative path ('/' separated): (size, mtime_ns, inode)} of every file under root,
+        [relative directories that could not be read]) => their files must not be taken as deleted
+    """
+    ignore = DEFAULT_IGNORE if ignore is None else ignore
+    files = {}
+    failed_dirs = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = {executor.submit(_scan_dir, root, '', ignore)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, subdirs, failed_dir = future.result()
+                files.update(dir_files)
+                if failed_dir is not None:
+                    failed_dirs.append(failed_dir)
+                pending.update(executor.submit(_scan_dir, root, d, ignore) for d in subdirs)
+    return files, failed_dirs
+
+
+class SyncManifest:
+    def __init__(self, db_path=DEFAULT_CACHE_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS sync_manifest (
+                job TEXT NOT NULL,
+                rel_path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                content_hash TEXT,
+                remote_path TEXT,
+                remote_id TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (job, rel_path))''')
+
+    @staticmethod
+    def _job_key(local_root, remote_root):
+        """ One manifest per (local folder, remote folder) pair """
+        return os.path.abspath(local_root) + '\n' + remote_root.rstrip('/').lower()
+
+    def entries(self, local_root, remote_root):
+        """ {rel_path: entry dict} of the files synced from local_root to remote_root """
+        with self._lock:
+            cur = self._conn.execute('SELECT * FROM sync_manifest WHERE job = ?', (self._job_key(local_root, remote_root),))
+            columns = [c[0] for c in cur.description]
+            return {row[1]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+    def put(self, local_root, remote_root, rel_path, stat, content_hash, remote_path=None, remote_id=None):
+        """ Record a synced file, stat is (size, mtime_ns, inode) as returned by scan_tree """
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO sync_manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (self._job_key(local_root, remote_root), rel_path, *stat, content_hash,
+                                remote_path, remote_id, time.time()))
+
+    def touch(self, local_root, remote_root, rel_path, stat):
+        """ New stat of a file whose content did not change """
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE sync_manifest SET size = ?, mtime_ns = ?, inode = ?, updated = ? WHERE job = ? AND rel_path = ?',
+                               (*stat, time.time(), self._job_key(local_root, remote_root), rel_path))
+
+    def remove(self, local_root, remote_root, rel_paths):
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM sync_manifest WHERE job = ? AND rel_path = ?',
+                                   [(self._job_key(local_root, remote_root), p) for p in rel_paths])
+
+    def invalidate(self, local_root=None, remote_root=None):
+        """ Forget a job (or every job), the next sync hashes and uploads everything again """
+        with self._lock, self._conn:
+            if local_root is None:
+                self._conn.execute('DELETE FROM sync_manifest')
+            else:
+                self._conn.execute('DELETE FROM sync_manifest WHERE job = ?', (self._job_key(local_root, remote_root),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,21 @@
+import os, sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+import dropbox_client
+from fake_dropbox import FakeDropboxServer, install
+
+
+@pytest.fixture
+def fake_dropbox(tmp_path, monkeypatch):
+    """ FakeDropboxServer answering the process Dropbox clients, the test runs in tmp_path """
+    monkeypatch.chdir(tmp_path)
+    server = FakeDropboxServer().start()
+    clients = dropbox_client.DropboxClients('key', 'secret', 'token', token_cache_path='')
+    install(clients.session, server.url)
+    monkeypatch.setattr(dropbox_client, '_clients', clients)
+    yield server
+    server.stop()
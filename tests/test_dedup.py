@@ -0,0 +1,45 @@
+import os
+
+from dbu import DropBoxUpload
+from dedup import Deduplicator
+from hash_cache import HashCache
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def uploads(server):
+    return sum(n for route, n in server.requests.items() if route.startswith('/2/files/upload'))
+
+
+def test_zip_of_known_content_is_copied_not_uploaded(fake_dropbox, tmp_path):
+    data = os.urandom(200000)
+    first = write(tmp_path / 'db_20230101.bak', data)
+    second = write(tmp_path / 'db_copy.bak', data)
+    dbu = DropBoxUpload(show_pbar=False, dedup=Deduplicator())
+
+    results = dbu.UploadFiles('/backup', [(first, 'db_20230101.bak'), (second, 'db_copy.bak')])
+
+    assert [meta.name for _, meta in results] == ['db_20230101.bak.zip', 'db_copy.bak.zip']
+    assert uploads(fake_dropbox) == 1
+    assert fake_dropbox.requests['/2/files/copy_v2'] == 1
+    assert dbu.dedup.copied == 1
+
+
+def test_zip_dedup_across_runs_through_the_hash_cache(fake_dropbox, tmp_path):
+    path = write(tmp_path / 'db_20230101.bak', os.urandom(200000))
+    cache = HashCache(str(tmp_path / 'cache.sqlite'))
+    meta = DropBoxUpload(show_pbar=False, cache=cache).UploadFiles('/backup', [(path, 'db.bak')])[0][1]
+    cache.put_upload(path, meta)
+    before = uploads(fake_dropbox)
+
+    dedup = Deduplicator()
+    dedup.record(meta)  # what the listing of /backup gives the next run
+    results = DropBoxUpload(show_pbar=False, cache=cache, dedup=dedup).UploadFiles('/backup', [(path, 'db.bak')])
+
+    assert results[0][1].content_hash == meta.content_hash
+    assert uploads(fake_dropbox) == before
+    assert dedup.skipped == 1
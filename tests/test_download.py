@@ -0,0 +1,96 @@
+import os, types
+from datetime import datetime
+
+import dropbox
+import requests
+
+import download
+import retry
+from dbu import DropBoxUpload
+from download import _ranges
+from dropbox_content_hasher import DropboxContentHasher
+from parallel_hasher import BLOCK_SIZE
+
+MB = 1024 * 1024
+
+
+def test_ranges_are_block_aligned_for_any_chunk_size():
+    ranges = _ranges(21 * MB, 4, 5 * MB)
+    assert all(offset % BLOCK_SIZE == 0 for offset, _ in ranges)
+    assert sum(length for _, length in ranges) == 21 * MB
+    assert ranges[0] == (0, 8 * MB)
+
+
+def test_restore_with_chunk_not_multiple_of_block_size(fake_dropbox, tmp_path):
+    path = tmp_path / 'db.bak'
+    path.write_bytes(os.urandom(21 * MB))
+    dbu = DropBoxUpload(show_pbar=False, chunk=5, parallel_chunks=4)
+    meta = dbu.UpLoadFile('/backup', str(path), 'db.bak')
+    os.makedirs(tmp_path / 'out')
+
+    restored = dbu.Restore('/backup/db.bak', str(tmp_path / 'out'))
+
+    assert restored.content_hash == meta.content_hash
+    assert (tmp_path / 'out' / 'db.bak').read_bytes() == path.read_bytes()
+
+
+class Response:
+    def __init__(self, status, body, content_length):
+        self.status_code = status
+        self.body = body
+        self.headers = {'Content-Length': str(content_length)}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code} error', response=self)
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FlakyLink:
+    """ Temporary link answering 503, then a truncated body, then the file """
+
+    def __init__(self, data):
+        self.responses = [Response(503, b'', 0), Response(200, data[:len(data) // 2], len(data)), Response(200, data, len(data))]
+
+    def get(self, link, headers=None, stream=False, timeout=None):
+        return self.responses.pop(0)
+
+
+class Counter:
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n=1):
+        self.n += n
+
+    def close(self):
+        pass
+
+
+def test_range_retried_on_5xx_and_short_body_without_double_counting(tmp_path, monkeypatch):
+    data = os.urandom(3 * MB)
+    hasher = DropboxContentHasher()
+    hasher.update(data)
+    meta = dropbox.files.FileMetadata(name='db.bak', size=len(data), content_hash=hasher.hexdigest(),
+                                      client_modified=datetime(2023, 1, 1))
+    dbx = types.SimpleNamespace(files_get_metadata=lambda path: meta,
+                                files_get_temporary_link=lambda path: types.SimpleNamespace(link='https://link'))
+    pbar = Counter()
+    monkeypatch.setattr(download, 'progress_bar', lambda *args: pbar)
+    monkeypatch.setattr(retry.time, 'sleep', lambda seconds: None)
+    session = FlakyLink(data)
+
+    download.download_file(dbx, session, '/backup/db.bak', str(tmp_path / 'db.bak'), retries=3)
+
+    assert session.responses == []
+    assert (tmp_path / 'db.bak').read_bytes() == data
+    assert pbar.n == len(data)
@@ -0,0 +1,21 @@
+import dropbox
+
+import dropbox_client
+from remote_ops import copy_batch, is_not_found
+
+
+def test_copy_batch_polls_the_async_job_to_completion(fake_dropbox):
+    dbx = dropbox_client.get_clients().client()
+    for name in ('a', 'b', 'c'):
+        dbx.files_upload(name.encode() * 100, f'/src/{name}.bak')
+
+    results = copy_batch(dbx, [('/src/a.bak', '/dst/a.bak'), ('/src/b.bak', '/dst/b.bak'),
+                               ('/src/c.bak', '/dst/c.bak'), ('/src/missing.bak', '/dst/missing.bak')], poll_interval=0.01)
+
+    assert [r.path_display for r in results[:3]] == ['/dst/a.bak', '/dst/b.bak', '/dst/c.bak']
+    assert is_not_found(results[3])
+    assert fake_dropbox.requests['/2/files/copy_batch_v2'] == 1
+    assert fake_dropbox.requests['/2/files/copy_batch/check_v2'] >= 1
+    _, res = dbx.files_download('/dst/b.bak')
+    assert res.content == b'b' * 100
+    assert isinstance(dbx.files_get_metadata('/src/a.bak'), dropbox.files.FileMetadata)  # a copy keeps its source
@@ -0,0 +1,49 @@
+import threading
+
+from dbu import DropBoxUpload, watch_remote
+from remote_state import RemoteState
+from watch import Watcher
+
+
+def test_remote_change_makes_the_watcher_recheck(fake_dropbox, tmp_path):
+    (tmp_path / 'local').mkdir()
+    (tmp_path / 'db.bak').write_bytes(b'x' * 1000)
+    dbu = DropBoxUpload(show_pbar=False, remote_state=RemoteState(str(tmp_path / 'cache.sqlite')))
+    meta = dbu.UpLoadFile('/backup', str(tmp_path / 'db.bak'), 'db.bak')
+    dbu.remote_state.sync(dbu.dbx, '/backup')
+    watcher = Watcher(str(tmp_path / 'local'), poll_interval=0.05, use_inotify=False)
+    rechecked = threading.Event()
+    watcher.recheck = rechecked.set
+    thread = threading.Thread(target=watch_remote, args=(dbu, '/backup', watcher, 30), daemon=True)
+    thread.start()
+
+    dbu.dbx.files_delete_v2(meta.path_display)  # a backup deleted on Dropbox
+
+    assert rechecked.wait(10)
+    watcher.stop()
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_recheck_reports_uploaded_files_again(tmp_path):
+    (tmp_path / 'db_20230101.bak').write_bytes(b'x' * 1000)
+    watcher = Watcher(str(tmp_path), settle=0, poll_interval=0.05, use_inotify=False)
+    threading.Timer(5, watcher.stop).start()
+    batches = []
+    for ready in watcher.batches():
+        batches.append(ready)
+        if len(batches) == 1:
+            watcher.recheck()
+        else:
+            watcher.stop()
+
+    assert batches == [[str(tmp_path / 'db_20230101.bak')]] * 2
+
+
+def test_cursor_waits_for_a_sync_in_progress(tmp_path):
+    state = RemoteState(str(tmp_path / 'cache.sqlite'))
+    read = threading.Event()
+    with state._lock:  # what sync() holds while it applies a page
+        threading.Thread(target=lambda: (state.cursor('/backup'), read.set()), daemon=True).start()
+        assert not read.wait(0.2)
+    assert read.wait(5)
@@ -0,0 +1,61 @@
+import os, argparse, threading
+
+import pytest
+
+import dbu
+from dbu import job_threads, fit_threads
+from scheduler import Scheduler, DEFAULT_SCHEDULER_DIR
+
+
+def job_args(workers=1, parallel_chunks=1, zip_workers=1, zip=False):
+    return argparse.Namespace(workers=workers, parallel_chunks=parallel_chunks, zip_workers=zip_workers, zip=zip)
+
+
+def test_job_threads_count_parallel_chunks_and_zip_workers():
+    assert job_threads(job_args(workers=2, parallel_chunks=4)) == 8
+    assert job_threads(job_args(workers=3, zip_workers=2, zip=True)) == 6
+    assert job_threads(job_args(workers=3, zip_workers=2)) == 3
+
+
+def test_fit_threads_scales_the_settings_down():
+    args = job_args(workers=4, parallel_chunks=4)
+    fit_threads(args, 8)
+    assert (args.workers, args.parallel_chunks) == (2, 4)
+    args = job_args(workers=1, parallel_chunks=16, zip_workers=16, zip=True)
+    fit_threads(args, 8)
+    assert (args.workers, args.parallel_chunks, args.zip_workers) == (1, 8, 8)
+    assert job_threads(args) <= 8
+
+
+def test_jobs_whose_threads_exceed_max_workers_run_one_after_the_other(tmp_path):
+    scheduler = Scheduler(str(tmp_path), max_workers=8, poll_interval=0.05)
+    first = scheduler.submit('first', workers=job_threads(job_args(workers=2, parallel_chunks=4)))
+    second = scheduler.submit('second', workers=job_threads(job_args(workers=1, parallel_chunks=4)))
+    first.wait_turn(100)
+    admitted = threading.Event()
+    thread = threading.Thread(target=lambda: (second.wait_turn(10), admitted.set()), daemon=True)
+    thread.start()
+
+    assert not admitted.wait(0.5)  # 8 + 4 threads > 8
+    first.release()
+    assert admitted.wait(5)
+    second.release()
+    first.close()
+    second.close()
+
+
+def test_run_uses_the_threads_granted_to_the_job(tmp_path, monkeypatch):
+    seen = []
+    monkeypatch.setattr(dbu, 'run_job', lambda args, job=None: seen.append((args.workers, args.parallel_chunks, job.workers)))
+    args = job_args(workers=4, parallel_chunks=4)
+    args.__dict__.update(scheduler=str(tmp_path), mode='folder', file_path=str(tmp_path), upload_path='/backup',
+                         max_workers=8, total_bwlimit='', max_wait=3600, deadline='')
+    dbu.run(args)
+
+    assert seen == [(2, 4, 8)]
+
+
+def test_scheduler_folder_is_host_wide():
+    assert os.path.isabs(DEFAULT_SCHEDULER_DIR)
+    with pytest.raises(ValueError):
+        Scheduler('.dbu_jobs')
@@ -0,0 +1,37 @@
+import pytest
+import requests
+
+import retry
+from stream_upload import UploadSessionWriter
+
+
+class FlakyDropbox:
+    """ files_upload fails with a connection error the first `failures` times """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def files_upload(self, data, path, mode=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise requests.exceptions.ConnectionError('connection reset')
+        return path
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry.time, 'sleep', lambda seconds: None)
+
+
+@pytest.mark.parametrize('retries, failures, ok', [(0, 1, False), (3, 2, True), (3, 4, False)])
+def test_writer_retries_as_configured(retries, failures, ok):
+    dbx = FlakyDropbox(failures)
+    writer = UploadSessionWriter(dbx, '/backup/db.bak.zip', 1024, show_pbar=False, retries=retries)
+    writer.write(b'x' * 100)
+    if ok:
+        assert writer.close() == '/backup/db.bak.zip'
+    else:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            writer.close()
+    assert dbx.calls == min(failures, retries) + 1
@@ -0,0 +1,53 @@
+import os
+
+import dropbox
+import pytest
+
+from dbu import DropBoxUpload
+from upload_journal import UploadJournal
+
+MB = 1024 * 1024
+
+
+def appends(server):
+    return server.requests['/2/files/upload_session/append_v2']
+
+
+def test_parallel_upload_resumes_the_missing_chunks(fake_dropbox, tmp_path, monkeypatch):
+    path = tmp_path / 'db.bak'
+    path.write_bytes(os.urandom(6 * 4 * MB + 1000))  # 7 chunks of 4 MB
+    journal = UploadJournal(str(tmp_path / 'cache.sqlite'))
+    dbu = DropBoxUpload(show_pbar=False, chunk=4, parallel_chunks=2, journal=journal, retries=0)
+    append = dropbox.Dropbox.files_upload_session_append_v2
+
+    def interrupted(self, f, cursor, close=False):
+        if cursor.offset >= 3 * 4 * MB:
+            raise RuntimeError('interrupted')
+        return append(self, f, cursor, close=close)
+
+    monkeypatch.setattr(dropbox.Dropbox, 'files_upload_session_append_v2', interrupted)
+    with pytest.raises(RuntimeError):
+        dbu.UpLoadFile('/backup', str(path), 'db.bak')
+    assert journal.chunks('/backup/db.bak') == {0, 4 * MB, 8 * MB}
+    monkeypatch.setattr(dropbox.Dropbox, 'files_upload_session_append_v2', append)
+    before = appends(fake_dropbox)
+
+    meta = DropBoxUpload(show_pbar=False, chunk=4, parallel_chunks=2, journal=journal).UpLoadFile('/backup', str(path), 'db.bak')
+
+    assert appends(fake_dropbox) - before == 4
+    assert fake_dropbox.requests['/2/files/upload_session/start'] == 1
+    _, res = dbu.dbx.files_download(meta.path_display)
+    assert res.content == path.read_bytes()
+    assert journal.lookup('/backup/db.bak', str(path)) is None
+
+
+def test_new_session_forgets_the_chunks_of_the_previous_one(tmp_path):
+    path = tmp_path / 'db.bak'
+    path.write_bytes(b'x' * 1000)
+    journal = UploadJournal(str(tmp_path / 'cache.sqlite'))
+    journal.start('/backup/db.bak', str(path), 'session', 0, chunk_size=4 * MB)
+    journal.add_chunk('/backup/db.bak', 0)
+    journal.start('/backup/db.bak', str(path), 'other', 0)
+
+    assert journal.lookup('/backup/db.bak', str(path))['chunk_size'] is None
+    assert journal.chunks('/backup/db.bak') == set()
@@ -0,0 +1,69 @@
+import time, threading
+
+from watch import Watcher
+
+
+def test_failed_upload_is_reported_again_after_backoff(tmp_path):
+    (tmp_path / 'db_20230101.bak').write_bytes(b'x' * 1000)
+    watcher = Watcher(str(tmp_path), settle=0, poll_interval=0.05, use_inotify=False, retry_delay=0.3)
+    threading.Timer(5, watcher.stop).start()  # never hang the suite
+    batches = []
+    for ready in watcher.batches():
+        batches.append((time.monotonic(), ready))
+        if len(batches) == 1:
+            watcher.retry(ready)  # the upload failed
+        else:
+            watcher.done(ready)
+            watcher.stop()
+
+    assert [ready for _, ready in batches] == [[str(tmp_path / 'db_20230101.bak')]] * 2
+    assert batches[1][0] - batches[0][0] >= 0.3
+
+
+def test_uploaded_file_is_not_reported_again(tmp_path):
+    (tmp_path / 'db_20230101.bak').write_bytes(b'x' * 1000)
+    watcher = Watcher(str(tmp_path), settle=0, poll_interval=0.05, use_inotify=False)
+    threading.Timer(0.5, watcher.stop).start()
+    batches = list(watcher.batches())
+
+    assert batches == [[str(tmp_path / 'db_20230101.bak')]]
+
+
+def test_watch_folder_retries_a_failed_upload(tmp_path, monkeypatch):
+    import argparse
+    import dropbox
+    import dbu
+
+    path = str(tmp_path / 'db_20230101.bak')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000)
+    calls = []
+
+    def upload_and_record(uploader, args, cache, file_paths):
+        calls.append(file_paths)
+        if len(calls) == 1:
+            return [(p, None) for p, _ in file_paths]
+        watchers[0].stop()
+        return [(p, dropbox.files.FileMetadata(name=n)) for p, n in file_paths]
+
+    class FastRetryWatcher(Watcher):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, use_inotify=False, retry_delay=0.1, **kwargs)
+            watchers.append(self)
+            threading.Timer(5, self.stop).start()
+
+    class Uploader:
+        remote_state = None
+
+        def FileNeedUpload(self, upload_path, file_path):
+            return [(path, 'db_20230101.bak')]
+
+    watchers = []
+    monkeypatch.setattr(dbu, 'upload_and_record', upload_and_record)
+    monkeypatch.setattr(dbu, 'Watcher', FastRetryWatcher)
+    monkeypatch.setattr(dbu.signal, 'signal', lambda *args: None)
+    args = argparse.Namespace(file_path=str(tmp_path), upload_path='/backup', settle=0, poll_interval=0.05, keep=0,
+                              archive_path='', metrics_json='', metrics_prom='')
+    dbu.watch_folder(Uploader(), args, None)
+
+    assert calls == [[(path, 'db_20230101.bak')]] * 2
@@ -0,0 +1,124 @@
+""" Bandwidth shaping and adaptive chunk sizing
+    - TokenBucket: process wide rate limiter shared by every concurrent upload, the rate can follow a
+      time-of-day schedule (e.g. slow during business hours) and be capped by a host-wide budget shared
+      with the other jobs (see scheduler)
+    - the SDK needs each request body as bytes, so the bucket is paid per chunk before sending:
+      the average rate is respected, small chunks shape it more smoothly
+    - ChunkSizer: grows or shrinks the chunk size from the measured per-chunk throughput, 4 MB aligned
+      and below the Dropbox limit of 150 MB per request
+"""
+
+import re, time, threading
+from datetime import datetime
+
+BLOCK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 148 * 1024 * 1024  # Dropbox rejects requests over 150 MB
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    """ '2M' => 2097152 bytes/s, '0' or '' => None (unlimited) """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:B|B/s)?\s*', value or '0', re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Invalid rate: {value}')
+    rate = float(match.group(1)) * UNITS[match.group(2).upper()]
+    return rate or None
+
+
+def parse_schedule(value):
+    """ '08:00-18:00=1M,18:00-08:00=0' => [(start_minute, end_minute, rate)] """
+    schedule = []
+    for part in filter(None, (p.strip() for p in (value or '').split(','))):
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)', part)
+        if not match:
+            raise ValueError(f'Invalid schedule entry: {part}')
+        h1, m1, h2, m2, rate = match.groups()
+        schedule.append((int(h1) * 60 + int(m1), int(h2) * 60 + int(m2), parse_rate(rate)))
+    return schedule
+
+
+class TokenBucket:
+    def __init__(self, rate=None, schedule=None, burst_seconds=1, share=None):
+        self.default_rate = rate  # bytes/s, None => unlimited
+        self.schedule = schedule or []
+        self.share = share  # callable => bytes/s this process may use of a budget shared with other processes, None => unlimited
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._last = time.monotonic()
+
+    def rate(self, now=None):
+        """ Rate in effect at now (datetime), from the first matching schedule entry, capped by the shared budget """
+        rate = self.scheduled_rate(now)
+        shared = self.share() if self.share is not None else None
+        if shared is not None:
+            rate = shared if rate is None else min(rate, shared)
+        return rate
+
+    def scheduled_rate(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.default_rate
+
+    def consume(self, n):
+        """ Block until n bytes may be sent """
+        while True:
+            rate = self.rate()
+            if rate is None:
+                return
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(rate * self.burst_seconds, self._tokens + (now - self._last) * rate)
+                self._last = now
+                # a chunk bigger than the burst is let through once the bucket is full and paid as debt
+                if self._tokens >= min(n, rate * self.burst_seconds):
+                    self._tokens -= n
+                    return
+                wait = (min(n, rate * self.burst_seconds) - self._tokens) / rate
+            time.sleep(min(wait, 60))  # re-read the schedule at least every minute
+
+
+_limiter = None
+
+
+def set_limiter(limiter):
+    global _limiter
+    _limiter = limiter
+
+
+def throttle(data):
+    """ Pay for data in the process wide bucket (no-op without limiter), return data """
+    if _limiter is not None:
+        _limiter.consume(len(data))
+    return data
+
+
+class ChunkSizer:
+    """ Per-upload chunk size: aim for each request to last between min_seconds and max_seconds """
+
+    def __init__(self, chunk_size, auto=False, min_seconds=2, max_seconds=10):
+        self.auto = auto
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.size = self._align(chunk_size) if auto else chunk_size
+
+    @staticmethod
+    def _align(size):
+        return max(BLOCK_SIZE, min(MAX_CHUNK_SIZE, size // BLOCK_SIZE * BLOCK_SIZE))
+
+    def update(self, n, seconds):
+        """ Record that n bytes took seconds (network time only) """
+        if not self.auto or n < self.size:
+            return
+        if seconds < self.min_seconds:
+            self.size = self._align(self.size * 2)
+        elif seconds > self.max_seconds:
+            self.size = self._align(self.size // 2)
+
+    def failed(self):
+        """ A retry happened: smaller chunks make the next retries cheaper """
+        if self.auto:
+            self.size = self._align(self.size // 2)
@@ -2,83 +2,135 @@
 # REF: https://stackoverflow.com/a/71794390
 
 import pathlib
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import dropbox
 from dropbox.exceptions import AuthError
-from dotenv import dotenv_values
 
-keys = dotenv_values('./.env_dropbox')
-APP_KEY = keys['APP_KEY']
-APP_SECRET = keys['APP_SECRET']
-REFRESH_TOKEN = keys['REFRESH_TOKEN']
+from dropbox_client import get_clients
+from buffer_pool import buffer_pool, payload
+
+class RemoteFile:
+    """Metadata of a file in a Dropbox folder, as returned by dropbox_list_files and RemoteState.sync."""
+
+    __slots__ = ('id', 'name', 'path_display', 'client_modified', 'server_modified', 'hash', 'size', 'revisions')
+
+    def __init__(self, id, name, path_display, client_modified, server_modified, hash, size, revisions=None):
+        self.id = id
+        self.name = name
+        self.path_display = path_display
+        self.client_modified = client_modified
+        self.server_modified = server_modified
+        self.hash = hash
+        self.size = size
+        self.revisions = revisions or []  # revision dicts, see dropbox_list_revisions
+
+    @classmethod
+    def from_metadata(cls, file):
+        return cls(file.id, file.name, file.path_display, file.client_modified, file.server_modified, file.content_hash, file.size)
+
+    @property
+    def hashs(self):
+        """Content hashes of the revisions and of the file itself."""
+        return [r['hash'] for r in self.revisions] + [self.hash]
+
+    def __repr__(self):
+        return 'RemoteFile({!r}, {!r}, {})'.format(self.path_display, self.hash, self.server_modified)
 
 def dropbox_connect():
-    """Create a connection to Dropbox."""
+    """Return the Dropbox client of the current thread, shared session and cached access token (see dropbox_client)."""
 
     try:
         # dbx = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
-        dbx = dropbox.Dropbox(app_key=APP_KEY, app_secret=APP_SECRET, oauth2_refresh_token=REFRESH_TOKEN)
+        dbx = get_clients().client()
     except AuthError as e:
         print('Error connecting to Dropbox with access token: ' + str(e))
+        raise e
     return dbx
 
-def dropbox_list_files(path):
-    """Return a Pandas dataframe of files in a given Dropbox folder path in the Apps directory.
+def dropbox_list_folder(path, dbx=None):
+    """Yield the FileMetadata of a Dropbox folder, following files_list_folder_continue until has_more is False."""
+
+    dbx = dbx or dropbox_connect()
+    result = dbx.files_list_folder(path)
+    while True:
+        for entry in result.entries:
+            if isinstance(entry, dropbox.files.FileMetadata):
+                yield entry
+        if not result.has_more:
+            break
+        result = dbx.files_list_folder_continue(result.cursor)
+
+def dropbox_list_revisions(file_paths, dbx=None, workers=8, limit=31):
+    """Return {file_path: [revision dict]} for the given Dropbox files, fetched concurrently by a bounded pool."""
+
+    dbx = dbx or dropbox_connect()
+
+    def revisions(file_path):
+        try:
+            entries = dbx.files_list_revisions(file_path, limit=limit).entries
+        except dropbox.exceptions.ApiError as e:
+            print('Error getting revisions of {}: {}'.format(file_path, e))
+            entries = []
+        return [{'id': r.id, 'name': r.name, 'hash': r.content_hash, 'metadata': r} for r in entries]
+
+    file_paths = list(file_paths)
+    if not file_paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(file_paths)))) as executor:
+        return dict(zip(file_paths, executor.map(revisions, file_paths)))
+
+def dropbox_list_files(path, revisions=False, workers=8):
+    """Return the files (RemoteFile) of a given Dropbox folder path in the Apps directory, last modified first.
+
+    Args:
+        path (str): The Dropbox folder, every page of the listing is fetched.
+        revisions (bool): Also fetch the revisions of every file (concurrently), otherwise
+            'revisions' is left empty and can be filled lazily with dropbox_list_revisions.
+        workers (int): Concurrent files_list_revisions calls.
     """
 
     dbx = dropbox_connect()
 
     try:
-        files = dbx.files_list_folder(path).entries
-        files_list = []
-        for file in files:
-            if isinstance(file, dropbox.files.FileMetadata):
-                revisions = dbx.files_list_revisions(path + '/' + file.name, limit=31).entries
-                metadata = {
-                    'id': file.id,
-                    'name': file.name,
-                    'path_display': file.path_display,
-                    'client_modified': file.client_modified,
-                    'server_modified': file.server_modified,
-                    'hash': file.content_hash,
-                    'size': file.size,
-                    'revisions': [{
-                         'id': r.id,
-                         'name': r.name,
-                         'hash': r.content_hash,
-                     } for r in revisions]
-                }
-                metadata['hashs'] = [r['hash'] for r in metadata['revisions']] + [metadata['hash']]
-                files_list.append(metadata)
-
-        df = pd.DataFrame.from_records(files_list)
-        return df.sort_values(by='server_modified', ascending=False)
+        files_list = [RemoteFile.from_metadata(file) for file in dropbox_list_folder(path, dbx)]
+
+        if revisions:
+            file_revisions = dropbox_list_revisions([f.path_display for f in files_list], dbx, workers)
+            for f in files_list:
+                f.revisions = file_revisions[f.path_display]
+
+        return sorted(files_list, key=lambda f: f.server_modified, reverse=True)
 
     except Exception as e:
         print('Error getting list of files from Dropbox: ' + str(e))
 
 def dropbox_download_file(dropbox_file_path, local_file_path):
-    """Download a file from Dropbox to the local machine."""
+    """Download a file from Dropbox to the local machine, streamed to disk chunk by chunk."""
 
     try:
         dbx = dropbox_connect()
 
         with open(local_file_path, 'wb') as f:
             metadata, result = dbx.files_download(path=dropbox_file_path)
-            f.write(result.content)
+            with result:
+                for chunk in result.iter_content(1024 * 1024):
+                    f.write(chunk)
+            return metadata
     except Exception as e:
         print('Error downloading file from Dropbox: ' + str(e))
         if isinstance(e, dropbox.exceptions.ApiError):
             print(type(e.error))
         raise e
 
-def dropbox_upload_file(local_path, local_file, dropbox_file_path):
+def dropbox_upload_file(local_path, local_file, dropbox_file_path, chunk_size=8 * 1024 * 1024):
     """Upload a file from the local machine to a path in the Dropbox app directory.
 
     Args:
         local_path (str): The path to the local file.
         local_file (str): The name of the local file.
         dropbox_file_path (str): The path to the file in the Dropbox app directory.
+        chunk_size (int): Files bigger than this go through an upload session, one pooled
+            buffer at a time (see buffer_pool), never the whole file in memory.
 
     Example:
         dropbox_upload_file('.', 'test.csv', '/stuff/test.csv')
@@ -92,10 +144,22 @@ def dropbox_upload_file(local_path, local_file, dropbox_file_path):
 
         local_file_path = pathlib.Path(local_path) / local_file
 
+        mode = dropbox.files.WriteMode("overwrite")
+        buffers = buffer_pool()
         with local_file_path.open("rb") as f:
-            meta = dbx.files_upload(f.read(), dropbox_file_path, mode=dropbox.files.WriteMode("overwrite"))
-
-            return meta
+            with buffers.read(f, chunk_size) as chunk:
+                if len(chunk) < chunk_size:
+                    return dbx.files_upload(payload(chunk), dropbox_file_path, mode=mode)
+                session_id = dbx.files_upload_session_start(payload(chunk)).session_id
+                offset = len(chunk)
+            while True:
+                cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset)
+                with buffers.read(f, chunk_size) as chunk:
+                    if len(chunk) < chunk_size:
+                        commit = dropbox.files.CommitInfo(path=dropbox_file_path, mode=mode)
+                        return dbx.files_upload_session_finish(payload(chunk), cursor, commit)
+                    dbx.files_upload_session_append_v2(payload(chunk), cursor)
+                    offset += len(chunk)
     except Exception as e:
         print('Error uploading file to Dropbox: ' + str(e))
 
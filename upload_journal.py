@@ -0,0 +1,135 @@
+""" Upload session journal
+    - checkpoints the session_id and acknowledged offset of chunked uploads in sqlite
+    - the source file identity (size, mtime_ns, inode) is stored too: a changed file never resumes
+    - for zipped uploads the original file identity is kept, so a later run can reuse the temp zip
+      instead of compressing again
+    - concurrent sessions (UpLoadFileParallel) complete their chunks out of order: the chunk size and the
+      offset of every acknowledged chunk are kept, a resume only sends the missing chunks
+    - upload sessions expire on Dropbox after about a week => older checkpoints are dropped
+"""
+
+import os, time, sqlite3, threading
+
+from hash_cache import DEFAULT_CACHE_PATH
+
+MAX_SESSION_AGE = 6 * 24 * 3600
+
+
+def file_identity(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class UploadJournal:
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_age=MAX_SESSION_AGE):
+        self.db_path = db_path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS upload_sessions (
+                dest_path TEXT PRIMARY KEY,
+                file_path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                origin_path TEXT,
+                origin_size INTEGER,
+                origin_mtime_ns INTEGER,
+                origin_inode INTEGER,
+                session_id TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                closed INTEGER NOT NULL DEFAULT 0,
+                started_at REAL NOT NULL)''')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(upload_sessions)')]
+            if 'chunk_size' not in columns:  # journals written before concurrent sessions were checkpointed
+                self._conn.execute('ALTER TABLE upload_sessions ADD COLUMN chunk_size INTEGER')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS upload_chunks (
+                dest_path TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                PRIMARY KEY (dest_path, offset))''')
+
+    def _row(self, dest_path):
+        cur = self._conn.execute('SELECT * FROM upload_sessions WHERE dest_path = ?', (dest_path,))
+        row = cur.fetchone()
+        return row and dict(zip([c[0] for c in cur.description], row))
+
+    def lookup(self, dest_path, file_path):
+        """ Checkpoint of an upload of file_path to dest_path, None if missing, expired or the file changed """
+        with self._lock:
+            entry = self._row(dest_path)
+            if entry is None:
+                return None
+            try:
+                same_file = (entry['file_path'] == os.path.abspath(file_path)
+                             and (entry['size'], entry['mtime_ns'], entry['inode']) == file_identity(file_path))
+            except FileNotFoundError:
+                same_file = False
+            if not same_file or time.time() - entry['started_at'] > self.max_age:
+                with self._conn:
+                    self._delete(dest_path)
+                return None
+            return entry
+
+    def resumable_zip(self, dest_path, origin_path):
+        """ Temp zip of an interrupted upload of origin_path to dest_path, if both are unchanged """
+        with self._lock:
+            entry = self._row(dest_path)
+        if entry is None or entry['origin_path'] != os.path.abspath(origin_path):
+            return None
+        try:
+            if (entry['origin_size'], entry['origin_mtime_ns'], entry['origin_inode']) != file_identity(origin_path):
+                return None
+        except FileNotFoundError:
+            return None
+        return entry['file_path'] if self.lookup(dest_path, entry['file_path']) else None
+
+    def start(self, dest_path, file_path, session_id, offset, origin_path=None, chunk_size=None):
+        """ chunk_size: set for a concurrent session, its chunks are then recorded with add_chunk """
+        size, mtime_ns, inode = file_identity(file_path)
+        origin = file_identity(origin_path) if origin_path and os.path.isfile(origin_path) else (None, None, None)
+        with self._lock, self._conn:
+            self._delete(dest_path)
+            self._conn.execute('INSERT INTO upload_sessions (dest_path, file_path, size, mtime_ns, inode, origin_path, origin_size, '
+                               'origin_mtime_ns, origin_inode, session_id, offset, closed, started_at, chunk_size) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)',
+                               (dest_path, os.path.abspath(file_path), size, mtime_ns, inode,
+                                origin_path and os.path.abspath(origin_path), *origin,
+                                session_id, offset, time.time(), chunk_size))
+
+    def add_chunk(self, dest_path, offset):
+        """ Chunk at offset acknowledged in the concurrent session of dest_path """
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO upload_chunks VALUES (?, ?)', (dest_path, offset))
+
+    def chunks(self, dest_path):
+        """ Offsets of the chunks acknowledged in the concurrent session of dest_path """
+        with self._lock:
+            return {row[0] for row in self._conn.execute('SELECT offset FROM upload_chunks WHERE dest_path = ?', (dest_path,))}
+
+    def update(self, dest_path, offset, closed=False):
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE upload_sessions SET offset = ?, closed = ? WHERE dest_path = ?',
+                               (offset, int(closed), dest_path))
+
+    def _delete(self, dest_path):
+        self._conn.execute('DELETE FROM upload_sessions WHERE dest_path = ?', (dest_path,))
+        self._conn.execute('DELETE FROM upload_chunks WHERE dest_path = ?', (dest_path,))
+
+    def remove(self, dest_path):
+        with self._lock, self._conn:
+            self._delete(dest_path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def correct_offset(e):
+    """ Offset the server expects when an append/finish ApiError reports an incorrect offset, else None """
+    err = getattr(e, 'error', None)
+    if hasattr(err, 'is_lookup_failed') and err.is_lookup_failed():
+        err = err.get_lookup_failed()
+    if hasattr(err, 'is_incorrect_offset') and err.is_incorrect_offset():
+        return err.get_incorrect_offset().correct_offset
+    return None
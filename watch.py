@@ -0,0 +1,203 @@
+""" Watch a backup folder and report files once they are completely written
+    - Linux: inotify through ctypes (no extra package), a file written locally is complete after its
+      close_write (or moved_to) event followed by settle seconds without any change
+    - files not seen through events (already there at start, written over SMB/NFS where inotify is
+      blind) or without inotify at all: complete once size and mtime stayed the same for settle seconds,
+      the folder is rescanned every poll_interval seconds
+    - a file whose upload failed is handed back with retry() and reported again after a backoff
+      (retry_delay doubled at each failure up to max_retry_delay)
+    - recheck() (thread safe) reports every file of the folder again once settled, e.g. after a remote change
+"""
+
+import os, sys, time, struct, select, fnmatch, threading
+import ctypes, ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+DEFAULT_IGNORE = ['.*', '*.tmp', '*.part', '~*']
+
+
+class Inotify:
+    """ Minimal inotify binding: one watched folder, events as (mask, name) """
+
+    def __init__(self, folder, mask=WATCH_MASK):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed on {folder}')
+
+    def read(self, timeout):
+        """ Events received within timeout seconds """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    def __init__(self, folder, settle=30, poll_interval=10, use_inotify=True, ignore=None, retry_delay=60, max_retry_delay=3600):
+        self.folder = folder
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.ignore = DEFAULT_IGNORE if ignore is None else ignore
+        self._candidates = {}  # name => {'key': (size, mtime_ns), 'since', 'closed', 'events'}
+        self._reported = {}  # name => key when yielded, a file comes back only once rewritten or handed back
+        self._failures = {}  # name => (failed uploads in a row, monotonic time of the next try)
+        self._stop = threading.Event()
+        self._recheck = threading.Event()
+        self.inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self.inotify = Inotify(folder)
+            except OSError as e:
+                print(f'inotify not available ({e}) => polling {folder}')
+        self.method = 'inotify' if self.inotify is not None else 'polling'
+
+    def _ignored(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def _touch(self, name, closed=None, event=False):
+        if self._ignored(name):
+            return
+        try:
+            st = os.stat(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            self._forget(name)
+            return
+        key = (st.st_size, st.st_mtime_ns)
+        if self._reported.get(name) == key:
+            self._candidates.pop(name, None)
+            return
+        candidate = self._candidates.get(name)
+        if candidate is None:
+            candidate = self._candidates[name] = {'key': key, 'since': time.monotonic(), 'closed': False, 'events': False}
+        elif candidate['key'] != key:
+            candidate.update(key=key, since=time.monotonic())
+        if event:
+            candidate['events'] = True
+        if closed is not None:
+            candidate['closed'] = closed
+
+    def _forget(self, name):
+        self._candidates.pop(name, None)
+        self._reported.pop(name, None)
+        self._failures.pop(name, None)
+
+    def retry(self, paths):
+        """ Hand back reported files whose upload failed, they are reported again after the backoff """
+        now = time.monotonic()
+        for path in paths:
+            name = os.path.basename(path)
+            failures = self._failures.get(name, (0, now))[0] + 1
+            delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+            self._failures[name] = (failures, now + delay)
+            self._reported.pop(name, None)
+            print(f'{name}: upload failed {failures} time(s) => retry in {delay}s')
+            self._touch(name, closed=True)
+
+    def recheck(self):
+        """ Report all the files again, e.g. the remote folder changed and a backup may be missing there """
+        self._recheck.set()
+
+    def done(self, paths):
+        """ Reported files uploaded (or not needing it): reset their backoff """
+        for path in paths:
+            self._failures.pop(os.path.basename(path), None)
+
+    def _scan(self):
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and (entry.name not in self._candidates or self.inotify is None):
+                self._touch(entry.name)
+
+    def _handle(self, events):
+        for mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self._scan()
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._forget(name)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._touch(name, closed=True, event=True)
+            elif name:
+                self._touch(name, closed=False, event=True)
+
+    def _ready(self):
+        now = time.monotonic()
+        ready = []
+        for name, candidate in list(self._candidates.items()):
+            if candidate['events'] and not candidate['closed']:
+                continue  # still open for writing
+            if self._failures.get(name, (0, now))[1] > now:
+                continue  # backoff after a failed upload
+            self._touch(name)  # the stat must not have moved since the last look
+            candidate = self._candidates.get(name)
+            if candidate is not None and now - candidate['since'] >= self.settle:
+                ready.append(os.path.join(self.folder, name))
+                self._reported[name] = candidate['key']
+                del self._candidates[name]
+        return ready
+
+    def batches(self):
+        """ Yield lists of complete files until stop() is called, existing files are candidates too """
+        self._scan()
+        last_scan = time.monotonic()
+        while not self._stop.is_set():
+            if self.inotify is not None:
+                self._handle(self.inotify.read(min(self.poll_interval, self.settle or self.poll_interval)))
+            else:
+                self._stop.wait(self.poll_interval)
+            if self._recheck.is_set():
+                self._recheck.clear()
+                self._reported.clear()
+                last_scan = 0
+            if self.inotify is None or time.monotonic() - last_scan >= self.poll_interval:
+                self._scan()
+                last_scan = time.monotonic()
+            ready = self._ready()
+            if ready:
+                yield ready
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def sleep(self, seconds):
+        """ Sleep, cut short by stop() """
+        self._stop.wait(seconds)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None